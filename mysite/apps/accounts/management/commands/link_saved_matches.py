@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mysite.apps.accounts.models import SavedMatch
+from mysite.apps.accounts.saved_matches import get_saved_match_cache, saved_courses_cache_key
+from mysite.apps.coursefinder.models import Course
+
+
+class Command(BaseCommand):
+    help = "Links saved matches that only have the copied course details to the course they were saved from"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="How many rows to update per query")
+    # enddef
+
+    def handle(self, *args, **options):
+        unlinked = list(
+            SavedMatch.objects.filter(course_ref__isnull=True).values_list('id', 'user_id', 'university', 'course')
+        )
+        if not unlinked:
+            self.stdout.write("No unlinked saved matches")
+            return
+        # endif
+
+        # one query for every course that could match, keyed the same way courses are unique (university + name)
+        course_ids = {}
+        candidates = Course.objects.filter(
+            university__name__in={university for _, _, university, _ in unlinked},
+            name__in={course for _, _, _, course in unlinked},
+        ).values_list('id', 'university__name', 'name')
+        for course_id, university, name in candidates:
+            course_ids[(university, name)] = course_id
+        # endfor
+
+        # courses users have already linked, so we don't break the (user, course) unique constraint
+        taken = set(SavedMatch.objects.filter(course_ref__isnull=False).values_list('user_id', 'course_ref_id'))
+
+        to_update = []
+        duplicates = 0
+        for saved_id, user_id, university, course in unlinked:
+            course_id = course_ids.get((university, course))
+            if course_id is None:
+                continue
+            # endif
+            if (user_id, course_id) in taken:
+                # the user saved the same course twice (e.g. with an old link), leave this copy alone
+                duplicates += 1
+                continue
+            # endif
+            taken.add((user_id, course_id))
+            to_update.append(SavedMatch(id=saved_id, course_ref_id=course_id))
+        # endfor
+
+        with transaction.atomic():
+            SavedMatch.objects.bulk_update(to_update, ['course_ref'], batch_size=options["batch_size"])
+        # endwith
+
+        # cached saved matches still have these rows as unlinked
+        get_saved_match_cache().delete_many([saved_courses_cache_key(user_id) for _, user_id, _, _ in unlinked])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Linked {len(to_update)} of {len(unlinked)} saved matches "
+            f"({len(unlinked) - len(to_update) - duplicates} courses not found, {duplicates} duplicates skipped)"
+        ))
+    # enddef
+# endclass
@@ -0,0 +1,64 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_saved_matches(apps, schema_editor):
+    # saves used to be keyed on every column, so the same course could be saved more than once
+    # (e.g. after its requirements text changed), keep the oldest copy so the unique constraint can be added
+    SavedMatch = apps.get_model("accounts", "SavedMatch")
+    duplicates = (
+        SavedMatch.objects.values("user", "university", "course", "course_link")
+        .annotate(keep=Min("id"), copies=Count("id"))
+        .filter(copies__gt=1)
+    )
+    for duplicate in duplicates:
+        SavedMatch.objects.filter(
+            user=duplicate["user"],
+            university=duplicate["university"],
+            course=duplicate["course"],
+            course_link=duplicate["course_link"],
+        ).exclude(pk=duplicate["keep"]).delete()
+    # endfor
+
+
+# enddef
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("accounts", "0005_alter_savedmatch_course_link"),
+        ("coursefinder", "0010_course_requirements_display"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="savedmatch",
+            name="course_ref",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="saved_matches",
+                to="coursefinder.course",
+            ),
+        ),
+        migrations.RunPython(remove_duplicate_saved_matches, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="savedmatch",
+            constraint=models.UniqueConstraint(
+                fields=("user", "university", "course", "course_link"),
+                name="unique_saved_match_per_user",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="savedmatch",
+            constraint=models.UniqueConstraint(
+                fields=("user", "course_ref"), name="unique_saved_course_per_user"
+            ),
+        ),
+    ]
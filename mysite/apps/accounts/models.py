@@ -4,6 +4,13 @@ from django.contrib.auth.models import User
 
 class SavedMatch(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="saved_matches")
+
+    # the saved course (None for old rows not linked yet, or if the course was removed by an import)
+    course_ref = models.ForeignKey(
+        "coursefinder.Course", null=True, blank=True, on_delete=models.SET_NULL, related_name="saved_matches"
+    )
+
+    # snapshot of the course when it was saved, shown if the course is gone
     university = models.CharField(max_length=200)
     course = models.CharField(max_length=200)
     course_type = models.CharField(max_length=100)
@@ -16,7 +23,11 @@ class SavedMatch(models.Model):
             models.UniqueConstraint(
                 fields=["user", "university", "course", "course_link"],
                 name="unique_saved_match_per_user"
-            )
+            ),
+            models.UniqueConstraint(
+                fields=["user", "course_ref"],
+                name="unique_saved_course_per_user"
+            ),
         ]
     #endclass
 
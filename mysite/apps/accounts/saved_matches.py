@@ -0,0 +1,276 @@
+"""
+Cached record of the courses each user has saved
+
+Search results are marked as saved by looking their course id up in a set,
+so marking a page is one set lookup per row instead of comparing every row
+with every saved match. The set is loaded with one query and cached until
+save_match/unsave_match change it.
+
+Saved matches from before they were linked to a course (see the
+link_saved_matches command) are still matched on (university, course,
+course_link).
+
+The cache is the one named by ACCOUNTS_SAVED_MATCH_CACHE. With more than one
+worker process it needs to be shared (e.g. Redis), otherwise other workers
+only see a change once their copy times out.
+"""
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Q
+
+from .models import SavedMatch
+from ..coursefinder.models import Course
+
+SavedKey = Tuple[str, str, str]
+
+
+class SavedCourses(NamedTuple):
+    """
+    Everything a user has saved, in the form the lookups need.
+    """
+    course_ids: FrozenSet[int]
+    legacy_keys: FrozenSet[SavedKey]  # (university, course, course_link) of rows not linked to a course
+
+    def contains(self, course_id: Optional[int], key: SavedKey) -> bool:
+        """
+        Checks if a course is saved.
+
+        :param course_id: Id of the course, or None if it isn't known
+        :param key: (university, course, course_link) of the course
+        :return: True if the user has saved it
+        """
+        if course_id is not None and course_id in self.course_ids:
+            return True
+        # endif
+        return bool(self.legacy_keys) and key in self.legacy_keys
+    # enddef
+# endclass
+
+
+def get_saved_match_cache():
+    """
+    Gets the cache backend used for saved matches.
+
+    :return: Django cache object
+    """
+    return caches[getattr(settings, "ACCOUNTS_SAVED_MATCH_CACHE", "default")]
+
+
+# enddef
+
+
+def saved_courses_cache_key(user_id: int) -> str:
+    """
+    Builds the cache key holding a user's saved courses.
+
+    :param user_id: Id of the user
+    :return: Cache key
+    """
+    return f"saved-matches:{user_id}"
+
+
+# enddef
+
+
+def get_saved_courses(user) -> SavedCourses:
+    """
+    Gets the ids of the courses the user has saved (plus any unlinked saved matches).
+
+    :param user: Django user object (must be authenticated)
+    :return: SavedCourses for the user
+    """
+    cache = get_saved_match_cache()
+    cache_key = saved_courses_cache_key(user.pk)
+
+    saved = cache.get(cache_key)
+    if saved is None:
+        course_ids = set()
+        legacy_keys = set()
+        rows = SavedMatch.objects.filter(user=user).values_list('course_ref_id', 'university', 'course', 'course_link')
+        for course_id, university, course, course_link in rows:
+            if course_id is not None:
+                course_ids.add(course_id)
+            else:
+                legacy_keys.add((university, course, course_link))
+            # endif
+        # endfor
+
+        saved = SavedCourses(frozenset(course_ids), frozenset(legacy_keys))
+        cache.set(cache_key, saved, timeout=getattr(settings, "ACCOUNTS_SAVED_MATCH_CACHE_TIMEOUT", 300))
+    # endif
+
+    return saved
+
+
+# enddef
+
+
+def save_course(user, course) -> SavedMatch:
+    """
+    Saves a course for the user, linking an older unlinked copy of it if there is one.
+
+    :param user: Django user object
+    :param course: Course object (with university selected)
+    :return: The SavedMatch for the course
+    """
+    saved_match = SavedMatch.objects.filter(user=user, course_ref=course).first()
+    if saved_match is not None:
+        return saved_match
+    # endif
+
+    # keyed on the snapshot columns so an unlinked row for the same course gets linked instead of duplicated
+    saved_match, was_created = SavedMatch.objects.update_or_create(
+        user=user,
+        university=course.university.name,
+        course=course.name,
+        course_link=course.link or "#",
+        defaults={
+            'course_ref': course,
+            'course_type': course.course_type,
+            'duration': course.duration,
+            'requirements': course.requirements_display,
+        },
+    )
+    return saved_match
+
+
+# enddef
+
+
+def course_keys(course_ids: List[int]) -> Dict[int, SavedKey]:
+    """
+    Gets the (university, course, course_link) key saved matches use for each course.
+
+    :param course_ids: Ids of the courses
+    :return: Dictionary mapping course id to its key (ids that don't exist are left out)
+    """
+    rows = Course.objects.filter(pk__in=course_ids).values_list('id', 'university__name', 'name', 'link')
+    return {course_id: (university, name, link or "#") for course_id, university, name, link in rows}
+
+
+# enddef
+
+
+def unsave_courses(user, course_ids: List[int]) -> int:
+    """
+    Deletes the user's saved matches for the given courses.
+
+    Unlinked saved matches from before course_ref are deleted too when their
+    (university, course, course_link) is the course's, as SavedCourses.contains
+    shows those as saved.
+
+    :param user: Django user object
+    :param course_ids: Ids of the courses to unsave
+    :return: Number of saved matches deleted
+    """
+    matches = Q(course_ref_id__in=course_ids)
+
+    # only look the courses up if the user still has unlinked rows
+    legacy_keys = get_saved_courses(user).legacy_keys
+    if legacy_keys:
+        for university, course, course_link in course_keys(course_ids).values():
+            if (university, course, course_link) in legacy_keys:
+                matches |= Q(course_ref__isnull=True, university=university, course=course, course_link=course_link)
+            # endif
+        # endfor
+    # endif
+
+    removed, _ = SavedMatch.objects.filter(user=user).filter(matches).delete()
+    return removed
+
+
+# enddef
+
+
+def sync_saved_courses(user, changes: Dict[int, bool]) -> Tuple[List[int], int]:
+    """
+    Applies a batch of saves and unsaves in one transaction.
+
+    Saves are one INSERT ... ON CONFLICT DO NOTHING (so saving something twice,
+    e.g. from a double click, is harmless) and unsaves are one DELETE. A save
+    of a course with an older unlinked copy links that row instead, like
+    save_course.
+
+    :param user: Django user object
+    :param changes: Dictionary mapping course id to True (save) or False (unsave), already coalesced
+    :return: Tuple of (ids of the courses newly saved, number of saved matches removed)
+    """
+    save_ids = [course_id for course_id, saved in changes.items() if saved]
+    unsave_ids = [course_id for course_id, saved in changes.items() if not saved]
+
+    # snapshot columns for the new rows, loaded in one query (ids that don't exist are skipped)
+    new_matches = [
+        SavedMatch(
+            user=user,
+            course_ref_id=course_id,
+            university=university,
+            course=name,
+            course_type=course_type,
+            duration=duration,
+            requirements=requirements,
+            course_link=link or "#",
+        )
+        for course_id, university, name, course_type, duration, requirements, link in
+        Course.objects.filter(pk__in=save_ids).values_list(
+            'id', 'university__name', 'name', 'course_type', 'duration', 'requirements_display', 'link'
+        )
+    ]
+    legacy_keys = get_saved_courses(user).legacy_keys
+
+    with transaction.atomic():
+        removed = 0
+        if unsave_ids:
+            removed = unsave_courses(user, unsave_ids)
+        # endif
+
+        saved_ids = []
+        if new_matches:
+            already_saved = set(SavedMatch.objects.filter(
+                user=user, course_ref_id__in=[match.course_ref_id for match in new_matches]
+            ).values_list('course_ref_id', flat=True))
+
+            inserts = []
+            for match in new_matches:
+                if match.course_ref_id in already_saved:
+                    continue
+                # endif
+                if (match.university, match.course, match.course_link) in legacy_keys:
+                    # it's saved already, just not linked (inserting would hit the unique key and be skipped)
+                    SavedMatch.objects.filter(
+                        user=user, course_ref__isnull=True, university=match.university, course=match.course,
+                        course_link=match.course_link
+                    ).update(course_ref_id=match.course_ref_id)
+                    continue
+                # endif
+                inserts.append(match)
+            # endfor
+
+            if inserts:
+                SavedMatch.objects.bulk_create(inserts, ignore_conflicts=True)
+
+                # conflicting rows are skipped without telling us, so read back which ones went in
+                saved_ids = list(SavedMatch.objects.filter(
+                    user=user, course_ref_id__in=[match.course_ref_id for match in inserts]
+                ).values_list('course_ref_id', flat=True))
+            # endif
+        # endif
+    # endwith
+
+    invalidate_saved_courses(user)
+    return saved_ids, removed
+
+
+# enddef
+
+
+def invalidate_saved_courses(user) -> None:
+    """
+    Forgets the cached saved courses after the user saves or unsaves something.
+
+    :param user: Django user object
+    """
+    get_saved_match_cache().delete(saved_courses_cache_key(user.pk))
+# enddef
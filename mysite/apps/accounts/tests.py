@@ -1,3 +1,229 @@
+import io
+import json
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command
 from django.test import TestCase
+from django.urls import reverse
+
+from .models import SavedMatch
+from .saved_matches import get_saved_courses, get_saved_match_cache
+from ..coursefinder.models import Course, University
+from ..coursefinder.results import format_course
+from ..coursefinder.views import mark_saved_matches
+
+
+class SavedMatchTestCase(TestCase):
+    """
+    A user with two courses to save, one of them saved before saved matches were linked to courses.
+    """
+
+    def setUp(self):
+        # user ids get reused between tests, so don't let one test see another's cached saved courses
+        get_saved_match_cache().clear()
+
+        self.user = get_user_model().objects.create_user(username="student", password="password")
+        self.client.force_login(self.user)
+
+        university = University.objects.create(name="Test University", location="London")
+        self.course = Course.objects.create(university=university, name="Physics", link="https://example.com/physics")
+        self.legacy_course = Course.objects.create(university=university, name="Chemistry")
+
+        # unlinked row, matched on (university, course, course_link)
+        SavedMatch.objects.create(
+            user=self.user, university="Test University", course="Chemistry", course_type="", duration="",
+            requirements="", course_link="#"
+        )
+    # enddef
+
+    def post_json(self, name: str, data: dict):
+        return self.client.post(reverse(name), json.dumps(data), content_type="application/json")
+    # enddef
+
+    def is_saved(self, course: Course) -> bool:
+        return get_saved_courses(self.user).contains(course.id, (course.university.name, course.name, course.link or "#"))
+    # enddef
+# endclass
+
+
+class SavedCoursesTests(SavedMatchTestCase):
+    """
+    Cached set of saved courses used to mark results.
+    """
+
+    def test_loaded_once_until_something_changes(self):
+        with self.assertNumQueries(1):
+            get_saved_courses(self.user)
+        # endwith
+        with self.assertNumQueries(0):
+            saved = get_saved_courses(self.user)
+        # endwith
+        self.assertEqual(saved.course_ids, frozenset())
+        self.assertEqual(saved.legacy_keys, {("Test University", "Chemistry", "#")})
+
+        self.post_json("accounts:save_match", {"course_id": self.course.id})
+        self.assertEqual(get_saved_courses(self.user).course_ids, {self.course.id})
+    # enddef
+
+    def test_mark_saved_matches(self):
+        self.post_json("accounts:save_match", {"course_id": self.course.id})
+        other = Course.objects.create(university=self.course.university, name="Biology")
+        results = [format_course(course) for course in (self.course, self.legacy_course, other)]
+
+        mark_saved_matches(results, self.user)
+        self.assertEqual([result.is_saved for result in results], [True, True, False])
+
+        # nothing to look up for guests
+        results = [format_course(self.course)]
+        with self.assertNumQueries(0):
+            mark_saved_matches(results, AnonymousUser())
+        # endwith
+        self.assertFalse(results[0].is_saved)
+    # enddef
+
+    def test_check_saved_batch(self):
+        self.post_json("accounts:save_match", {"course_id": self.course.id})
+        courses = [
+            {"course_id": self.course.id, "university": "Test University", "course": "Physics", "course_link": ""},
+            # no id, so matched on the unlinked row's university, course and link
+            {"course_id": None, "university": "Test University", "course": "Chemistry", "course_link": "#"},
+            {"course_id": None, "university": "Test University", "course": "Biology", "course_link": "#"},
+        ]
+        response = self.post_json("accounts:check_saved_batch", {"courses": courses})
+        self.assertEqual(response.json(), {"saved": [True, True, False]})
+    # enddef
+# endclass
+
+
+class UnsaveMatchTests(SavedMatchTestCase):
+    """
+    unsave_match view.
+    """
+
+    def test_unsave_linked_course(self):
+        self.post_json("accounts:save_match", {"course_id": self.course.id})
+        self.assertTrue(self.is_saved(self.course))
+
+        response = self.post_json("accounts:unsave_match", {"course_id": self.course.id})
+        self.assertEqual(response.json(), {"status": "unsaved", "deleted": 1})
+        self.assertFalse(self.is_saved(self.course))
+    # enddef
+
+    def test_unsave_unlinked_course_by_id(self):
+        self.assertTrue(self.is_saved(self.legacy_course))
+
+        response = self.post_json("accounts:unsave_match", {"course_id": self.legacy_course.id})
+        self.assertEqual(response.json(), {"status": "unsaved", "deleted": 1})
+        self.assertFalse(self.is_saved(self.legacy_course))
+        self.assertFalse(SavedMatch.objects.filter(user=self.user).exists())
+    # enddef
+
+    def test_unsave_course_that_is_not_saved(self):
+        response = self.post_json("accounts:unsave_match", {"course_id": self.course.id})
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(self.is_saved(self.legacy_course))
+    # enddef
+# endclass
+
+
+class SyncSavedMatchesTests(SavedMatchTestCase):
+    """
+    sync_saved_matches view (sync_saved_courses).
+    """
+
+    def sync(self, operations: list) -> dict:
+        return self.post_json("accounts:sync_saved_matches", {"operations": operations}).json()
+    # enddef
+
+    def test_save_and_unsave(self):
+        response = self.sync([{"course_id": self.course.id, "saved": True}])
+        self.assertEqual(response, {"status": "synced", "saved": [self.course.id], "removed": 0})
+        self.assertTrue(self.is_saved(self.course))
+
+        # saving again doesn't insert anything
+        response = self.sync([{"course_id": self.course.id, "saved": True}])
+        self.assertEqual(response["saved"], [])
+
+        response = self.sync([{"course_id": self.course.id, "saved": False}])
+        self.assertEqual(response, {"status": "synced", "saved": [], "removed": 1})
+        self.assertFalse(self.is_saved(self.course))
+    # enddef
+
+    def test_last_operation_for_a_course_wins(self):
+        response = self.sync([
+            {"course_id": self.course.id, "saved": True},
+            {"course_id": self.course.id, "saved": False},
+        ])
+        self.assertEqual(response, {"status": "synced", "saved": [], "removed": 0})
+        self.assertFalse(self.is_saved(self.course))
+    # enddef
+
+    def test_unsave_unlinked_course(self):
+        response = self.sync([{"course_id": self.legacy_course.id, "saved": False}])
+        self.assertEqual(response["removed"], 1)
+        self.assertFalse(self.is_saved(self.legacy_course))
+    # enddef
+
+    def test_save_unlinked_course_links_it(self):
+        response = self.sync([{"course_id": self.legacy_course.id, "saved": True}])
+        # already saved, so nothing new was inserted
+        self.assertEqual(response["saved"], [])
+        self.assertEqual(SavedMatch.objects.get(user=self.user).course_ref_id, self.legacy_course.id)
+        self.assertTrue(self.is_saved(self.legacy_course))
+    # enddef
+# endclass
+
+
+class LinkSavedMatchesTests(SavedMatchTestCase):
+    """
+    link_saved_matches command, and saved matches outliving their course.
+    """
+
+    def link(self) -> str:
+        out = io.StringIO()
+        call_command("link_saved_matches", stdout=out)
+        return out.getvalue()
+    # enddef
+
+    def test_links_unlinked_rows(self):
+        # not found, so left unlinked
+        SavedMatch.objects.create(
+            user=self.user, university="Test University", course="Gone", course_type="", duration="",
+            requirements="", course_link="#"
+        )
+        self.assertEqual(get_saved_courses(self.user).course_ids, frozenset())
+
+        self.assertIn("Linked 1 of 2 saved matches (1 courses not found, 0 duplicates skipped)", self.link())
+        linked = SavedMatch.objects.get(course="Chemistry")
+        self.assertEqual(linked.course_ref, self.legacy_course)
+        self.assertIsNone(SavedMatch.objects.get(course="Gone").course_ref)
+        # the cached copy is dropped
+        self.assertEqual(get_saved_courses(self.user).course_ids, {self.legacy_course.id})
+
+        self.assertIn("Linked 0 of 1 saved matches", self.link())
+    # enddef
+
+    def test_skips_courses_already_linked(self):
+        # the same course saved again later with a different link
+        SavedMatch.objects.create(
+            user=self.user, course_ref=self.legacy_course, university="Test University", course="Chemistry",
+            course_type="", duration="", requirements="", course_link="https://example.com/chemistry"
+        )
+        self.assertIn("Linked 0 of 1 saved matches (0 courses not found, 1 duplicates skipped)", self.link())
+    # enddef
+
+    def test_no_unlinked_rows(self):
+        SavedMatch.objects.all().delete()
+        self.assertIn("No unlinked saved matches", self.link())
+    # enddef
+
+    def test_removed_course_keeps_the_saved_match(self):
+        self.post_json("accounts:save_match", {"course_id": self.course.id})
+        self.course.delete()
 
-# Create your tests here.
+        saved_match = SavedMatch.objects.get(course="Physics")
+        self.assertIsNone(saved_match.course_ref)
+        self.assertEqual(saved_match.course_link, "https://example.com/physics")
+    # enddef
+# endclass
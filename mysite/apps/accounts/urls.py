@@ -25,4 +25,6 @@ urlpatterns = [
     path('save-match/', views.save_match, name='save_match'),
     path('unsave-match/', views.unsave_match, name='unsave_match'),
     path('check-saved/', views.check_saved, name='check_saved'),
+    path('check-saved-batch/', views.check_saved_batch, name='check_saved_batch'),
+    path('saved-matches/sync/', views.sync_saved_matches, name='sync_saved_matches'),
 ]
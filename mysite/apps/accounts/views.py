@@ -20,10 +20,18 @@ from django.conf import settings
 
 from .forms import CustomUserCreationForm
 from .models import SavedMatch
+from .saved_matches import get_saved_courses, invalidate_saved_courses, save_course, sync_saved_courses, unsave_courses
+from ..coursefinder.models import Course
 from .tokens import account_activation_token
 
 User = get_user_model()
 
+# most courses check_saved_batch will look at in one request (a page is 50)
+MAX_BATCH_CHECK = 500
+
+# most save/unsave operations sync_saved_matches will apply in one request
+MAX_SYNC_OPERATIONS = 500
+
 
 def register_view(request):
     """
@@ -246,14 +254,43 @@ def saved_matches_view(request):
     :param request: Django HTTP request object
     :return: Rendered HTML response for saved matches page
     """
-    saved_matches = SavedMatch.objects.filter(user=request.user)
+    saved_matches = SavedMatch.objects.filter(user=request.user).select_related('course_ref__university')
     # Add is_saved property to each saved match for template consistency
     for match in saved_matches:
         match.is_saved = True
+        match.course_id = match.course_ref_id
+
+        # show the course as it is now, the saved copy is only used if the course is gone
+        if match.course_ref is not None:
+            course = match.course_ref
+            match.university = course.university.name
+            match.course = course.name
+            match.course_type = course.course_type
+            match.duration = course.duration
+            match.requirements = course.requirements_display
+            match.course_link = course.link or "#"
+        # endif
     # endfor
     return render(request, 'accounts/saved_matches.html', {'results': saved_matches})
 
 
+# enddef
+
+
+def get_course_id(data):
+    """
+    Gets the course id sent with a save/unsave/check request.
+
+    :param data: Decoded JSON body of the request
+    :return: Course id as an integer, or None if it wasn't sent (older pages)
+    """
+    course_id = data.get('course_id')
+    if course_id in (None, ''):
+        return None
+    # endif
+    return int(course_id)
+
+
 # enddef
 
 @login_required
@@ -268,25 +305,34 @@ def save_match(request):
         try:
             # Get the course data from the request
             data = json.loads(request.body)
+            course_id = get_course_id(data)
 
-            # Remove extra whitespace from the data to make sure matching works properly
-            university = data['university'].strip()
-            course = data['course'].strip()
-            course_type = data['course_type'].strip()
-            duration = data['duration'].strip()
-            requirements = data['requirements'].strip()
-            course_link = data['course_link'].strip()
-
-            # Save the match to the database (or get it if it already exists)
-            saved_match, was_created = SavedMatch.objects.get_or_create(
-                user=request.user,
-                university=university,
-                course=course,
-                course_type=course_type,
-                duration=duration,
-                requirements=requirements,
-                course_link=course_link,
-            )
+            if course_id is not None:
+                saved_match = save_course(request.user, Course.objects.select_related('university').get(pk=course_id))
+            else:
+                # Remove extra whitespace from the data to make sure matching works properly
+                university = data['university'].strip()
+                course = data['course'].strip()
+                course_type = data['course_type'].strip()
+                duration = data['duration'].strip()
+                requirements = data['requirements'].strip()
+                course_link = data['course_link'].strip()
+
+                # Save the match to the database (or get it if it already exists)
+                # looked up on the columns that are unique per user, the rest are only shown
+                saved_match, was_created = SavedMatch.objects.get_or_create(
+                    user=request.user,
+                    university=university,
+                    course=course,
+                    course_link=course_link,
+                    defaults={
+                        'course_type': course_type,
+                        'duration': duration,
+                        'requirements': requirements,
+                    },
+                )
+            # endif
+            invalidate_saved_courses(request.user)
 
             # Send back success response
             return JsonResponse({'status': 'saved', 'id': saved_match.id})
@@ -311,26 +357,27 @@ def unsave_match(request):
         try:
             # Get the course data from the request
             data = json.loads(request.body)
+            course_id = get_course_id(data)
 
-            # Remove extra whitespace from the data
-            university = data['university'].strip()
-            course = data['course'].strip()
-            course_link = data['course_link'].strip()
-
-            # Find all saved matches with these details and delete them
-            # We only check university, course, and link to make sure it matches properly
-            matches_to_delete = SavedMatch.objects.filter(
-                user=request.user,
-                university=university,
-                course=course,
-                course_link=course_link,
-            )
-
-            # Count how many we're deleting
-            count = matches_to_delete.count()
-
-            # Delete them
-            matches_to_delete.delete()
+            if course_id is not None:
+                # also removes an older unlinked copy of the course
+                count = unsave_courses(request.user, [course_id])
+            else:
+                # Remove extra whitespace from the data
+                university = data['university'].strip()
+                course = data['course'].strip()
+                course_link = data['course_link'].strip()
+
+                # Find all saved matches with these details and delete them
+                # We only check university, course, and link to make sure it matches properly
+                count, _ = SavedMatch.objects.filter(
+                    user=request.user,
+                    university=university,
+                    course=course,
+                    course_link=course_link,
+                ).delete()
+            # endif
+            invalidate_saved_courses(request.user)
 
             # Check if we actually deleted anything
             if count > 0:
@@ -366,14 +413,10 @@ def check_saved(request):
             course = data['course'].strip()
             course_link = data['course_link'].strip()
 
-            # Check if this course is in the user's saved matches
-            # We only check university, course, and link
-            is_saved = SavedMatch.objects.filter(
-                user=request.user,
-                university=university,
-                course=course,
-                course_link=course_link,
-            ).exists()
+            # Check if this course is in the user's saved matches (by id, or university, course and link)
+            is_saved = get_saved_courses(request.user).contains(
+                get_course_id(data), (university, course, course_link)
+            )
 
             # Send back whether it's saved or not
             return JsonResponse({'is_saved': is_saved})
@@ -383,3 +426,79 @@ def check_saved(request):
 
     return JsonResponse({'status': 'error'}, status=400)
 # enddef
+
+
+@login_required
+def check_saved_batch(request):
+    """
+    Checks which of a list of courses are in the user's saved matches, all in one go.
+
+    The body is {"courses": [{"course_id": ..., "university": ..., "course": ..., "course_link": ...}, ...]}
+    (course_id can be null for rows without one).
+
+    :param request: Django HTTP request object containing the list of courses in JSON body
+    :return: JSON response with a list of is_saved booleans in the same order as the courses
+    """
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            courses = data['courses']
+            if len(courses) > MAX_BATCH_CHECK:
+                return JsonResponse({'status': 'error', 'message': 'Too many courses'}, status=400)
+            # endif
+
+            # one (cached) lookup of everything the user saved, then a set check per course
+            saved = get_saved_courses(request.user)
+            results = []
+            for course_data in courses:
+                key = (
+                    course_data.get('university', '').strip(),
+                    course_data.get('course', '').strip(),
+                    course_data.get('course_link', '').strip(),
+                )
+                results.append(saved.contains(get_course_id(course_data), key))
+            # endfor
+
+            return JsonResponse({'saved': results})
+        except Exception as e:
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    # endtry
+
+    return JsonResponse({'status': 'error'}, status=400)
+# enddef
+
+
+@login_required
+def sync_saved_matches(request):
+    """
+    Applies a batch of heart clicks (saves and unsaves) in one request.
+
+    The body is {"operations": [{"course_id": 12, "saved": true}, ...]}. If a
+    course shows up more than once the last operation wins, so the page can
+    send every click since its last sync.
+
+    :param request: Django HTTP request object containing the operations in JSON body
+    :return: JSON response with the ids of the courses newly saved and how many saved matches were removed
+    """
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            operations = data['operations']
+            if len(operations) > MAX_SYNC_OPERATIONS:
+                return JsonResponse({'status': 'error', 'message': 'Too many operations'}, status=400)
+            # endif
+
+            # only the final state of each course matters
+            changes = {}
+            for operation in operations:
+                changes[int(operation['course_id'])] = bool(operation['saved'])
+            # endfor
+
+            saved_ids, removed = sync_saved_courses(request.user, changes)
+            return JsonResponse({'status': 'synced', 'saved': saved_ids, 'removed': removed})
+        except Exception as e:
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    # endtry
+
+    return JsonResponse({'status': 'error'}, status=400)
+# enddef
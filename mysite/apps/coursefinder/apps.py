@@ -1,7 +1,19 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CoursefinderConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mysite.apps.coursefinder'
+
+    def ready(self):
+        # connect the signal handlers
+        from . import signals  # noqa: F401
+
+        # load the NLP parsers now instead of on the first search (opt-in)
+        if getattr(settings, "COURSEFINDER_WARM_UP", False):
+            from .warmup import warm_up_search
+            warm_up_search()
+        # endif
+    # enddef
 # endclass
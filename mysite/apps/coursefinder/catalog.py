@@ -0,0 +1,154 @@
+"""
+Catalog version tracking so caches know when course data has changed
+"""
+import threading
+from contextlib import contextmanager
+
+from django.db import connection
+from django.db.models import F
+
+from .models import CatalogVersion
+
+# the version always lives in this row
+CATALOG_VERSION_ID = 1
+
+# postgres advisory lock key held while an import runs (any number, as long as every import uses the same one)
+CATALOG_IMPORT_LOCK_ID = 7_401_202
+
+
+class CatalogImportRunning(Exception):
+    """
+    Raised when another import is already running.
+    """
+
+_state = threading.local()
+
+
+def get_catalog_version() -> int:
+    """
+    Gets the current catalog version from the database.
+
+    :return: Catalog version number
+    """
+    version = CatalogVersion.objects.filter(pk=CATALOG_VERSION_ID).values_list('version', flat=True).first()
+    if version is None:
+        # nothing has bumped it yet
+        return 1
+    # endif
+    return version
+
+
+# enddef
+
+
+def bump_catalog_version() -> int:
+    """
+    Increases the catalog version so everything cached for the old catalog is ignored.
+
+    :return: New catalog version number
+    """
+    updated = CatalogVersion.objects.filter(pk=CATALOG_VERSION_ID).update(version=F('version') + 1)
+    if not updated:
+        # first change ever, so go straight from the default of 1 to 2
+        CatalogVersion.objects.get_or_create(pk=CATALOG_VERSION_ID, defaults={'version': 2})
+    # endif
+    return get_catalog_version()
+
+
+# enddef
+
+
+def mark_catalog_changed() -> None:
+    """
+    Records that course data changed. Bumps the version straight away unless
+    we're inside catalog_update(), which bumps once at the end instead.
+    """
+    if getattr(_state, "depth", 0):
+        _state.changed = True
+        return
+    # endif
+
+    bump_catalog_version()
+
+
+# enddef
+
+
+@contextmanager
+def catalog_update():
+    """
+    Groups lots of catalog changes (like an import) into a single version bump.
+
+    Usage:
+        with catalog_update():
+            ... create/update courses ...
+    """
+    depth = getattr(_state, "depth", 0)
+    if depth == 0:
+        _state.changed = False
+    # endif
+    _state.depth = depth + 1
+
+    try:
+        yield
+    finally:
+        _state.depth = depth
+
+        # only the outermost block bumps (even after an error, as some rows may be saved)
+        if depth == 0 and _state.changed:
+            _state.changed = False
+            bump_catalog_version()
+        # endif
+    # endtry
+
+
+# enddef
+
+
+@contextmanager
+def catalog_import_lock():
+    """
+    Stops two imports running at once (with a Postgres session advisory
+    lock, so it's released even if the import process dies) and marks this
+    thread as importing (see is_importing).
+
+    Usage:
+        with catalog_import_lock():
+            ... import ...
+    """
+    locked = connection.vendor == "postgresql"
+    if locked:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [CATALOG_IMPORT_LOCK_ID])
+            if not cursor.fetchone()[0]:
+                raise CatalogImportRunning("Another catalog import is already running")
+            # endif
+        # endwith
+    # endif
+
+    _state.importing = True
+    try:
+        yield
+    finally:
+        _state.importing = False
+        if locked:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", [CATALOG_IMPORT_LOCK_ID])
+            # endwith
+        # endif
+    # endtry
+
+
+# enddef
+
+
+def is_importing() -> bool:
+    """
+    Checks if this thread is running a catalog import (inside catalog_import_lock).
+
+    Signal handlers use it to skip work the import does itself in bulk.
+
+    :return: True during an import
+    """
+    return getattr(_state, "importing", False)
+# enddef
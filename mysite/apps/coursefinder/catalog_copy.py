@@ -0,0 +1,484 @@
+"""
+Staged catalog import for Postgres, built in parallel and merged in one short transaction
+
+import_catalog builds every row in one Python process and writes it with
+INSERTs straight into the catalog, so a big import is CPU bound, round-trip
+bound and holds its transaction open the whole time. bulk_load_catalog
+instead builds the rows in a pool of worker processes (with
+build_university, so the normalized columns and content hashes are the
+same as a normal import) and streams them into temporary tables with COPY
+FROM STDIN. Nothing in the catalog is touched while that happens.
+
+The staged rows are then checked (see validate_staging) and merged with a
+few set-based statements in one short transaction, matching courses to
+universities by name and requirements to courses by (university name,
+course name), and only writing rows whose content hash changed. Searches
+see the old catalog until that transaction commits and the new one after.
+The tables aren't swapped by renaming, since saved matches and requirements
+point at course rows by id. An advisory lock stops two imports running at once.
+
+SubjectRequirement isn't loaded, as the scraper file has no subject
+requirements (import_catalog doesn't load them either).
+"""
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .catalog import catalog_import_lock, catalog_update, mark_catalog_changed
+from .catalog_import import COURSE_FIELDS, REQUIREMENT_FIELDS, UNIVERSITY_FIELDS, ImportStats, build_university
+from .catalog_import import CatalogValidationError, check_removed_courses
+from .full_text_search import update_search_documents
+from .models import Course, EntryRequirement, University
+from .regions import update_course_regions
+from .search_index import get_search_engine, rebuild_search_index
+from .search_view import refresh_search_view
+
+# how many universities each worker builds at a time
+WORKER_CHUNK_SIZE = 50
+
+# longest the merge waits for a row lock before giving up
+MERGE_LOCK_TIMEOUT = "10s"
+
+
+# columns of the temporary tables (position is the university's place in the file, so the last copy wins)
+STAGED_UNIVERSITY_COLUMNS = ['position', 'name'] + UNIVERSITY_FIELDS
+STAGED_COURSE_COLUMNS = ['position', 'university_name', 'name'] + COURSE_FIELDS
+STAGED_REQUIREMENT_COLUMNS = ['position', 'university_name', 'course_name'] + REQUIREMENT_FIELDS
+
+CREATE_STAGING_TABLES = """
+    CREATE TEMPORARY TABLE import_university (
+        position integer, name text, location text, website text, all_courses_url text,
+        region text, content_hash text
+    );
+    CREATE TEMPORARY TABLE import_course (
+        position integer, university_name text, name text, course_type text, duration text, mode text,
+        location text, start_date text, link text, duration_years smallint, study_mode smallint,
+        qualification text, region text, requirements_display text, content_hash text
+    );
+    CREATE TEMPORARY TABLE import_requirement (
+        position integer, university_name text, course_name text, min_ucas_points integer,
+        min_grade_required text, display_grades text, btec_grades text, accepts_ucas boolean,
+        has_requirements boolean
+    );
+"""
+
+DROP_STAGING_TABLES = "DROP TABLE IF EXISTS import_university, import_course, import_requirement"
+
+# keeps only the last copy of a university listed more than once
+DEDUPLICATE_STAGING = """
+    DELETE FROM import_university a USING import_university b WHERE a.name = b.name AND a.position < b.position;
+    DELETE FROM import_course c WHERE NOT EXISTS (SELECT 1 FROM import_university u WHERE u.position = c.position);
+    DELETE FROM import_requirement r
+        WHERE NOT EXISTS (SELECT 1 FROM import_university u WHERE u.position = r.position);
+    CREATE INDEX ON import_course (university_name, name);
+    CREATE INDEX ON import_requirement (university_name, course_name);
+    ANALYZE import_university;
+    ANALYZE import_course;
+    ANALYZE import_requirement;
+"""
+
+# universities whose own details changed, so all their courses need a new region and search document
+MOVED_UNIVERSITIES = """
+    SELECT u.id FROM coursefinder_university u JOIN import_university s ON s.name = u.name
+    WHERE (u.location, u.website, u.all_courses_url) IS DISTINCT FROM (s.location, s.website, s.all_courses_url)
+"""
+
+# courses at changed universities that aren't in the file any more
+REMOVED_COURSES = """
+    SELECT c.id FROM coursefinder_course c
+    JOIN coursefinder_university u ON u.id = c.university_id
+    JOIN import_university s ON s.name = u.name AND s.content_hash IS DISTINCT FROM u.content_hash
+    WHERE NOT EXISTS (SELECT 1 FROM import_course i WHERE i.university_name = u.name AND i.name = c.name)
+"""
+
+# requirements of changed courses that the file says have none now
+DROPPED_REQUIREMENTS = """
+    SELECT r.id FROM coursefinder_entryrequirement r
+    JOIN coursefinder_course c ON c.id = r.course_id
+    JOIN coursefinder_university u ON u.id = c.university_id
+    JOIN import_course i ON i.university_name = u.name AND i.name = c.name
+        AND i.content_hash IS DISTINCT FROM c.content_hash
+    WHERE NOT EXISTS (
+        SELECT 1 FROM import_requirement s WHERE s.university_name = u.name AND s.course_name = c.name
+    )
+"""
+
+# (courses now, courses the merge would delete) when universities missing from the file are deleted
+COUNT_REMOVED_COURSES = """
+    SELECT count(*), count(*) FILTER (WHERE NOT EXISTS (
+        SELECT 1 FROM import_course i WHERE i.university_name = u.name AND i.name = c.name
+    ))
+    FROM coursefinder_course c JOIN coursefinder_university u ON u.id = c.university_id
+"""
+
+MISSING_UNIVERSITIES = """
+    SELECT u.id FROM coursefinder_university u
+    WHERE NOT EXISTS (SELECT 1 FROM import_university s WHERE s.name = u.name)
+"""
+
+
+def upsert_sql(table: str, conflict: List[str], columns: List[str], select: str, returning: str) -> str:
+    """
+    Builds an INSERT ... SELECT that updates existing rows only when their content hash changed.
+
+    :param table: Table to write to
+    :param conflict: Columns of the unique constraint to match existing rows on
+    :param columns: Columns to insert, in the same order as the SELECT
+    :param select: SELECT ... FROM the temporary tables
+    :param returning: RETURNING expressions
+    :return: SQL string
+    """
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns if column not in conflict)
+    only_changed = f"WHERE {table}.content_hash IS DISTINCT FROM EXCLUDED.content_hash" if "content_hash" in columns else ""
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) {select} "
+        f"ON CONFLICT ({', '.join(conflict)}) DO UPDATE SET {updates} {only_changed} "
+        f"RETURNING {returning}"
+    )
+
+
+# enddef
+
+
+UPSERT_UNIVERSITIES = upsert_sql(
+    "coursefinder_university", ["name"], ["name"] + UNIVERSITY_FIELDS,
+    f"SELECT name, {', '.join(UNIVERSITY_FIELDS)} FROM import_university",
+    "xmax = 0",  # true for inserted rows, false for updated ones
+)
+UPSERT_COURSES = upsert_sql(
+    "coursefinder_course", ["university_id", "name"], ["university_id", "name"] + COURSE_FIELDS,
+    f"SELECT u.id, i.name, {', '.join('i.' + field for field in COURSE_FIELDS)} FROM import_course i "
+    f"JOIN coursefinder_university u ON u.name = i.university_name",
+    "id, xmax = 0",
+)
+# only for the courses written above (passed in as an array of ids)
+UPSERT_REQUIREMENTS = upsert_sql(
+    "coursefinder_entryrequirement", ["course_id"], ["course_id"] + REQUIREMENT_FIELDS,
+    f"SELECT c.id, {', '.join('r.' + field for field in REQUIREMENT_FIELDS)} FROM import_requirement r "
+    f"JOIN coursefinder_university u ON u.name = r.university_name "
+    f"JOIN coursefinder_course c ON c.university_id = u.id AND c.name = r.course_name "
+    f"WHERE c.id = ANY(%s)",
+    "id",
+)
+
+
+def build_rows(batch: List[Tuple[int, Dict]]) -> Tuple[List[tuple], List[tuple], List[tuple]]:
+    """
+    Builds the temporary table rows for some universities (runs in a worker process).
+
+    :param batch: List of (position in the file, university dictionary)
+    :return: Tuple of (university rows, course rows, requirement rows) in the STAGED_*_COLUMNS order
+    """
+    university_rows = []
+    course_rows = []
+    requirement_rows = []
+    for position, data in batch:
+        university, courses, requirements = build_university(data)
+        university_rows.append((position, university.name) + tuple(getattr(university, f) for f in UNIVERSITY_FIELDS))
+        for course, requirement in zip(courses, requirements):
+            course_rows.append((position, university.name, course.name) + tuple(getattr(course, f) for f in COURSE_FIELDS))
+            if requirement is not None:
+                requirement_rows.append(
+                    (position, university.name, course.name) + tuple(getattr(requirement, f) for f in REQUIREMENT_FIELDS)
+                )
+            # endif
+        # endfor
+    # endfor
+    return university_rows, course_rows, requirement_rows
+
+
+# enddef
+
+
+def chunked(items: Iterable, size: int) -> Iterator[List]:
+    """
+    Splits an iterable into lists of up to size items without reading it all first.
+    """
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        # endif
+        yield chunk
+    # endwhile
+
+
+# enddef
+
+
+def map_in_order(pool: Executor, function: Callable, chunks: Iterable, max_pending: int) -> Iterator:
+    """
+    Like pool.map, but only reads ahead max_pending chunks so the whole file isn't queued up at once.
+
+    :param pool: Executor to run the function in
+    :param function: Function to call on each chunk
+    :param chunks: Iterable of arguments
+    :param max_pending: Most chunks submitted and not yet collected
+    :return: Iterator of results, in the same order as the chunks
+    """
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.submit(function, chunk))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        # endif
+    # endfor
+    while pending:
+        yield pending.popleft().result()
+    # endwhile
+
+
+# enddef
+
+
+def copy_rows(cursor, table: str, columns: List[str], rows: List[tuple]) -> None:
+    """
+    Streams rows into a table with COPY FROM STDIN.
+
+    :param cursor: psycopg cursor (not Django's wrapper)
+    :param table: Table to copy into
+    :param columns: Column names, in the same order as the rows
+    :param rows: Rows to copy
+    """
+    if not rows:
+        return
+    # endif
+    with cursor.copy(f"COPY {table} ({', '.join(columns)}) FROM STDIN") as copy:
+        for row in rows:
+            copy.write_row(row)
+        # endfor
+    # endwith
+
+
+# enddef
+
+
+def select_ids(cursor, sql: str) -> List[int]:
+    cursor.execute(sql)
+    return [row[0] for row in cursor.fetchall()]
+
+
+# enddef
+
+
+def stage_catalog(cursor, universities: Iterable[Dict], workers: int) -> None:
+    """
+    Builds the rows in worker processes and copies them into the temporary tables.
+
+    :param cursor: psycopg cursor
+    :param universities: University dictionaries (e.g. from iter_json_array)
+    :param workers: Number of worker processes
+    """
+    cursor.execute(DROP_STAGING_TABLES)
+    cursor.execute(CREATE_STAGING_TABLES)
+
+    # fork so the workers already have Django set up (they never use the database connection)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        # workers build the rows while this process copies the finished ones into the temporary tables
+        chunks = chunked(enumerate(universities), WORKER_CHUNK_SIZE)
+        for university_rows, course_rows, requirement_rows in map_in_order(pool, build_rows, chunks, workers * 2):
+            copy_rows(cursor, "import_university", STAGED_UNIVERSITY_COLUMNS, university_rows)
+            copy_rows(cursor, "import_course", STAGED_COURSE_COLUMNS, course_rows)
+            copy_rows(cursor, "import_requirement", STAGED_REQUIREMENT_COLUMNS, requirement_rows)
+        # endfor
+    # endwith
+
+    cursor.execute(DEDUPLICATE_STAGING)
+
+
+# enddef
+
+
+def validate_staging(cursor, delete_missing: bool, max_removed_fraction: Optional[float]) -> None:
+    """
+    Checks the staged rows before anything in the catalog is touched.
+
+    :param cursor: psycopg cursor
+    :param delete_missing: Whether the merge will delete universities that aren't in the file
+    :param max_removed_fraction: Most of the current courses the import may remove, or None for no limit
+    :raises CatalogValidationError: If the staged rows can't or shouldn't be merged
+    """
+    cursor.execute("SELECT count(*) FROM import_university")
+    if not cursor.fetchone()[0]:
+        raise CatalogValidationError("The file has no universities")
+    # endif
+
+    # values the catalog columns can't hold, which would otherwise fail half way through the merge
+    problems = []
+    for table, model, columns in [
+        ("import_university", University, ['name'] + UNIVERSITY_FIELDS),
+        ("import_course", Course, ['name'] + COURSE_FIELDS),
+        ("import_requirement", EntryRequirement, REQUIREMENT_FIELDS),
+    ]:
+        checks = [("name", "name = ''")] if 'name' in columns else []
+        for column in columns:
+            max_length = getattr(model._meta.get_field(column), "max_length", None)
+            if max_length:
+                checks.append((column, f"length({column}) > {max_length}"))
+            # endif
+        # endfor
+        if not checks:
+            continue
+        # endif
+
+        counts = ", ".join(f"count(*) FILTER (WHERE {condition})" for _, condition in checks)
+        cursor.execute(f"SELECT {counts} FROM {table}")
+        for (column, condition), count in zip(checks, cursor.fetchone()):
+            if count:
+                problems.append(f"{count} rows in {table} with {condition}")
+            # endif
+        # endfor
+    # endfor
+    if problems:
+        raise CatalogValidationError("Bad rows in the file: " + "; ".join(problems))
+    # endif
+
+    # a broken scrape shouldn't be able to empty the catalog
+    if delete_missing and max_removed_fraction is not None:
+        cursor.execute(COUNT_REMOVED_COURSES)
+        current, removed = cursor.fetchone()
+        check_removed_courses(current, removed, max_removed_fraction)
+    # endif
+
+
+# enddef
+
+
+def merge_staging(cursor, delete_missing: bool) -> ImportStats:
+    """
+    Merges the staged rows into the catalog (run inside the merge transaction).
+
+    :param cursor: psycopg cursor
+    :param delete_missing: Whether to delete universities that aren't in the file
+    :return: ImportStats counting what was added, changed, removed and unchanged
+    """
+    stats = ImportStats()
+
+    cursor.execute("SELECT (SELECT count(*) FROM import_university), (SELECT count(*) FROM import_course)")
+    staged_universities, staged_courses = cursor.fetchone()
+
+    moved_university_ids = select_ids(cursor, MOVED_UNIVERSITIES)
+
+    # deleted before the upserts, so nothing deleted can clobber a row written below
+    removed_course_ids = select_ids(cursor, REMOVED_COURSES)
+    Course.objects.filter(pk__in=removed_course_ids).delete()
+    stats.removed['courses'] += len(removed_course_ids)
+    EntryRequirement.objects.filter(pk__in=select_ids(cursor, DROPPED_REQUIREMENTS)).delete()
+
+    if delete_missing:
+        missing_ids = select_ids(cursor, MISSING_UNIVERSITIES)
+        if missing_ids:
+            _, deleted = University.objects.filter(pk__in=missing_ids).delete()
+            stats.removed['universities'] += deleted.get(University._meta.label, 0)
+            stats.removed['courses'] += deleted.get(Course._meta.label, 0)
+        # endif
+    # endif
+
+    # rows with the same content hash are left alone, so they don't come back from RETURNING
+    cursor.execute(UPSERT_UNIVERSITIES)
+    inserted = [row[0] for row in cursor.fetchall()]
+    stats.added['universities'] += sum(inserted)
+    stats.changed['universities'] += len(inserted) - sum(inserted)
+
+    cursor.execute(UPSERT_COURSES)
+    rows = cursor.fetchall()
+    written_course_ids = [course_id for course_id, _ in rows]
+    inserted = sum(1 for _, was_inserted in rows if was_inserted)
+    stats.added['courses'] += inserted
+    stats.changed['courses'] += len(rows) - inserted
+
+    if written_course_ids:
+        cursor.execute(UPSERT_REQUIREMENTS, [written_course_ids])
+    # endif
+
+    stats.unchanged['universities'] = staged_universities - stats.added['universities'] - stats.changed['universities']
+    stats.unchanged['courses'] = staged_courses - stats.added['courses'] - stats.changed['courses']
+
+    if moved_university_ids:
+        update_course_regions(Course.objects.filter(university_id__in=moved_university_ids))
+    # endif
+    update_search_documents(Course.objects.filter(
+        Q(pk__in=written_course_ids) | Q(university_id__in=moved_university_ids)
+    ))
+
+    return stats
+
+
+# enddef
+
+
+def bulk_load_catalog(universities: Iterable[Dict], workers: int = None, delete_missing: bool = True,
+                      max_removed_fraction: Optional[float] = None) -> ImportStats:
+    """
+    Imports scraped universities by staging them first and then merging them in one short transaction.
+
+    Reading, building and copying the rows (the slow part) only touches
+    temporary tables, so searches keep using the current catalog and nothing
+    in it is locked meanwhile. The staged rows are checked, then merged in a
+    single transaction, so searches switch from the old catalog to the new
+    one all at once. Gives the same catalog as import_catalog with the same file.
+
+    :param universities: University dictionaries (e.g. from iter_json_array)
+    :param workers: Number of worker processes, defaults to the number of CPUs
+    :param delete_missing: Whether to delete universities that aren't in the file (False for a partial file)
+    :param max_removed_fraction: Most of the current courses the import may remove, defaults to
+                                 COURSEFINDER_IMPORT_MAX_REMOVED_FRACTION (None for no limit)
+    :return: ImportStats counting what was added, changed, removed and unchanged
+    :raises CatalogImportRunning: If another import is running
+    :raises CatalogValidationError: If the staged rows fail the checks (the catalog isn't changed)
+    """
+    if connection.vendor != "postgresql":
+        raise ValueError("The staged import needs Postgres")
+    # endif
+
+    workers = workers or os.cpu_count() or 1
+    if max_removed_fraction is None:
+        max_removed_fraction = getattr(settings, "COURSEFINDER_IMPORT_MAX_REMOVED_FRACTION", None)
+    # endif
+
+    with catalog_import_lock(), connection.cursor() as wrapper:
+        cursor = wrapper.cursor
+        if not hasattr(cursor, "copy"):
+            raise ValueError("The staged import needs psycopg 3")
+        # endif
+
+        try:
+            stage_catalog(cursor, universities, workers)
+            validate_staging(cursor, delete_missing, max_removed_fraction)
+
+            # bump after the merge commits or rolls back, not inside an aborted transaction
+            with catalog_update(), transaction.atomic():
+                # give up rather than queue behind a long transaction (searches would queue behind us)
+                cursor.execute(f"SET LOCAL lock_timeout = '{MERGE_LOCK_TIMEOUT}'")
+                stats = merge_staging(cursor, delete_missing)
+
+                # the writes above don't send signals, so tell the caches ourselves (only if anything changed)
+                if stats.has_changes:
+                    mark_catalog_changed()
+                # endif
+            # endwith
+        finally:
+            cursor.execute(DROP_STAGING_TABLES)
+        # endtry
+    # endwith
+
+    # load the new catalog into the in-memory index straight away
+    if stats.has_changes and get_search_engine() == "memory":
+        rebuild_search_index()
+    # endif
+
+    # and into the flattened search view (once the new rows are committed)
+    if stats.has_changes:
+        refresh_search_view()
+    # endif
+
+    return stats
+# enddef
@@ -0,0 +1,482 @@
+"""
+Bulk import of the scraper's universities.json into the catalog
+
+The file is a JSON array of universities, each with its courses and their
+entry requirements (the same shape save_scraped_data.saved_Data takes):
+
+    [{"name": ..., "location": ..., "link": ..., "link_all_courses": ...,
+      "courses": [{"name": ..., "course_type": ..., "duration": ..., "mode": ...,
+                   "location": ..., "start_date": ..., "link": ...,
+                   "requirements": [{"min_ucas_points": ..., ...}]}]}]
+
+Universities are read one at a time (see iter_json_array) and written in
+batches with bulk_create, so memory depends on the batch size rather than
+the size of the file. Bulk writes skip save() and the signals, so the
+columns they would fill in (normalized filters, region, requirements text,
+search document) are worked out here instead.
+
+Most of the catalog is the same from one scrape to the next, so every
+university and course stores a hash of the data it was imported from.
+Universities whose hash hasn't changed are skipped whole, and within a
+changed university only new or changed courses are written. Anything no
+longer in the file is deleted, and the catalog version is only bumped if
+something actually changed.
+"""
+import hashlib
+import json
+import re
+from collections import Counter
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from .catalog import catalog_import_lock, catalog_update, mark_catalog_changed
+from .full_text_search import update_search_documents
+from .models import Course, EntryRequirement, University
+from .normalize import normalize_course, requirements_display
+from .regions import course_region, find_region, update_course_regions
+from .search_index import get_search_engine, rebuild_search_index
+from .search_view import refresh_search_view
+
+# how much of the file to read at a time
+READ_CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r"\s*")
+
+UNIVERSITY_FIELDS = ['location', 'website', 'all_courses_url', 'region', 'content_hash']
+COURSE_FIELDS = [
+    'course_type', 'duration', 'mode', 'location', 'start_date', 'link',
+    'duration_years', 'study_mode', 'qualification', 'region', 'requirements_display', 'content_hash',
+]
+REQUIREMENT_FIELDS = [
+    'min_ucas_points', 'min_grade_required', 'display_grades', 'btec_grades', 'accepts_ucas', 'has_requirements',
+]
+
+
+class CatalogValidationError(ValueError):
+    """
+    Raised when an import fails the checks made before it changes the catalog.
+    """
+# endclass
+
+
+class ImportStats:
+    """
+    Counts of what an import added, changed, removed and left alone, by kind ("universities" or "courses").
+    """
+
+    def __init__(self):
+        self.added = Counter()
+        self.changed = Counter()
+        self.removed = Counter()
+        self.unchanged = Counter()
+    # enddef
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(sum(self.added.values()) or sum(self.changed.values()) or sum(self.removed.values()))
+    # enddef
+
+    @property
+    def records(self) -> int:
+        """
+        Number of universities and courses read from the file.
+        """
+        return sum(self.added.values()) + sum(self.changed.values()) + sum(self.unchanged.values())
+    # enddef
+
+    def summary(self, kind: str) -> str:
+        return (f"{self.added[kind]} added, {self.changed[kind]} changed, "
+                f"{self.removed[kind]} removed, {self.unchanged[kind]} unchanged")
+    # enddef
+# endclass
+
+
+def content_hash(values: List[Any]) -> str:
+    """
+    Hashes the values a row was imported from.
+
+    :param values: List of JSON-serializable values
+    :return: Hex SHA-1 of the values
+    """
+    payload = json.dumps(values, separators=(",", ":"), default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+# enddef
+
+
+def iter_json_array(stream: TextIO, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[Any]:
+    """
+    Reads the items of a top-level JSON array one at a time.
+
+    Only the item being decoded (plus one chunk) is held in memory, instead
+    of the whole file like json.load.
+
+    :param stream: Text file containing a JSON array
+    :param chunk_size: How many characters to read at a time
+    :return: Iterator of the decoded items
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    at_end = False
+    started = False
+
+    while True:
+        # skip whitespace and the commas between items
+        while position < len(buffer) and (buffer[position].isspace() or (started and buffer[position] == ",")):
+            position += 1
+        # endwhile
+
+        if position >= len(buffer):
+            if at_end:
+                raise ValueError("JSON array isn't closed")
+            # endif
+            chunk = stream.read(chunk_size)
+            at_end = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        # endif
+
+        if not started:
+            if buffer[position] != "[":
+                raise ValueError("Expected a JSON array of universities")
+            # endif
+            started = True
+            position += 1
+            continue
+        # endif
+
+        if buffer[position] == "]":
+            return
+        # endif
+
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+            # only whole once the , or ] after it has been read: a chunk can end inside a number
+            # (after the "1" or "1." of "1.5e3"), which decodes fine as a shorter number
+            after = WHITESPACE.match(buffer, end).end()
+            complete = at_end or (after < len(buffer) and buffer[after] in ",]")
+        except json.JSONDecodeError:
+            # the item probably carries on in the next chunk
+            if at_end:
+                raise
+            # endif
+            complete = False
+        # endtry
+
+        if not complete:
+            chunk = stream.read(chunk_size)
+            at_end = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        # endif
+
+        position = end
+        yield item
+    # endwhile
+
+
+# enddef
+
+
+def check_removed_courses(current: int, removed: int, max_removed_fraction: Optional[float]) -> None:
+    """
+    Stops an import that would remove too much of the catalog (e.g. from a broken scrape).
+
+    :param current: Number of courses in the catalog before the import
+    :param removed: Number of them the import would remove
+    :param max_removed_fraction: Most of the current courses the import may remove, or None for no limit
+    :raises CatalogValidationError: If more than max_removed_fraction of the courses would go
+    """
+    if max_removed_fraction is not None and current and removed / current > max_removed_fraction:
+        raise CatalogValidationError(
+            f"The import would remove {removed} of {current} courses "
+            f"(more than {max_removed_fraction:.0%}), use --keep-missing or --force if that's right"
+        )
+    # endif
+
+
+# enddef
+
+
+def build_requirement(data: Dict) -> EntryRequirement:
+    """
+    Builds an (unsaved) EntryRequirement from scraped requirement data.
+
+    :param data: Requirement dictionary from the file
+    :return: EntryRequirement without a course
+    """
+    return EntryRequirement(**{field: data[field] for field in REQUIREMENT_FIELDS if data.get(field) is not None})
+
+
+# enddef
+
+
+# a university from the file, with its courses and (for each course) its requirement or None
+ScrapedUniversity = Tuple[University, List[Course], List[Optional[EntryRequirement]]]
+
+
+def build_university(data: Dict) -> ScrapedUniversity:
+    """
+    Builds the (unsaved) rows for a university from the file, with their content hashes.
+
+    :param data: University dictionary from the file
+    :return: Tuple of (University, its courses, each course's requirement or None)
+    """
+    location = data.get('location') or ""
+    university = University(
+        name=data['name'],
+        location=location,
+        website=data.get('link') or "",
+        all_courses_url=data.get('link_all_courses') or "",
+        region=find_region(location),
+    )
+
+    courses = []
+    requirements = []
+    # the last copy of a course wins (one statement can't update the same row twice)
+    courses_by_name = {course_data['name']: course_data for course_data in data.get('courses') or []}
+    for course_data in courses_by_name.values():
+        course = Course(
+            name=course_data['name'],
+            course_type=course_data.get('course_type') or "",
+            duration=course_data.get('duration') or "",
+            mode=course_data.get('mode') or "",
+            location=course_data.get('location') or "",
+            start_date=course_data.get('start_date') or "",
+            link=course_data.get('link') or "",
+        )
+        normalize_course(course)
+        course.region = course_region(course.location, university.region)
+
+        # a course only has one EntryRequirement, so only the first is used
+        requirement = build_requirement(course_data['requirements'][0]) if course_data.get('requirements') else None
+        course.requirements_display = requirements_display(requirement)
+
+        course.content_hash = content_hash([
+            course.name, course.course_type, course.duration, course.mode, course.location, course.start_date,
+            course.link, [getattr(requirement, field) for field in REQUIREMENT_FIELDS] if requirement else None,
+        ])
+        courses.append(course)
+        requirements.append(requirement)
+    # endfor
+
+    # covers the courses too, so an unchanged university can be skipped without looking at them
+    university.content_hash = content_hash([
+        university.name, university.location, university.website, university.all_courses_url,
+        sorted(course.content_hash for course in courses),
+    ])
+    return university, courses, requirements
+
+
+# enddef
+
+
+def write_batch(batch: List[ScrapedUniversity], stored_universities: Dict[str, Tuple], batch_size: int,
+                stats: ImportStats) -> None:
+    """
+    Writes a batch of new or changed universities, only touching the courses that are new, changed or gone.
+
+    :param batch: Universities from the file whose content hash changed
+    :param stored_universities: Dictionary mapping name to (id, content_hash, location, website, all_courses_url)
+    :param batch_size: Most rows per INSERT
+    :param stats: ImportStats to count the changes in
+    """
+    universities = [university for university, _, _ in batch]
+
+    # universities whose own details changed, so their other courses need a new region and search document
+    moved_university_names = set()
+    stored_ids = {}
+    for university in universities:
+        stored = stored_universities.get(university.name)
+        if stored is None:
+            stats.added['universities'] += 1
+        else:
+            stats.changed['universities'] += 1
+            stored_ids[university.name] = stored[0]
+            if stored[2:] != (university.location, university.website, university.all_courses_url):
+                moved_university_names.add(university.name)
+            # endif
+        # endif
+    # endfor
+
+    stored_courses = {
+        (university_id, name): (course_id, stored_hash)
+        for university_id, name, course_id, stored_hash in Course.objects.filter(
+            university_id__in=stored_ids.values()
+        ).values_list('university_id', 'name', 'id', 'content_hash')
+    }
+
+    courses = []
+    requirements = []
+    dropped_requirement_ids = []
+    for university, university_courses, university_requirements in batch:
+        for course, requirement in zip(university_courses, university_requirements):
+            stored = stored_courses.pop((stored_ids.get(university.name), course.name), None)
+            if stored is None:
+                stats.added['courses'] += 1
+            elif stored[1] != course.content_hash:
+                stats.changed['courses'] += 1
+                if requirement is None:
+                    dropped_requirement_ids.append(stored[0])
+                # endif
+            else:
+                stats.unchanged['courses'] += 1
+                continue
+            # endif
+            courses.append(course)
+            requirements.append(requirement)
+        # endfor
+    # endfor
+
+    # deleted before the upserts, so nothing deleted can clobber a row written below
+    # whatever is left at these universities isn't in the file any more
+    if stored_courses:
+        Course.objects.filter(pk__in=[course_id for course_id, _ in stored_courses.values()]).delete()
+        stats.removed['courses'] += len(stored_courses)
+    # endif
+    # and these courses have no requirements now
+    EntryRequirement.objects.filter(course_id__in=dropped_requirement_ids).delete()
+
+    # one INSERT ... ON CONFLICT (name) DO UPDATE, which also fills in the ids
+    University.objects.bulk_create(
+        universities, batch_size=batch_size,
+        update_conflicts=True, unique_fields=['name'], update_fields=UNIVERSITY_FIELDS,
+    )
+    moved_university_ids = [university.pk for university in universities if university.name in moved_university_names]
+
+    for university, university_courses, _ in batch:
+        for course in university_courses:
+            course.university_id = university.pk
+        # endfor
+    # endfor
+
+    Course.objects.bulk_create(
+        courses, batch_size=batch_size,
+        update_conflicts=True, unique_fields=['university', 'name'], update_fields=COURSE_FIELDS,
+    )
+
+    with_requirements = []
+    for course, requirement in zip(courses, requirements):
+        if requirement is not None:
+            requirement.course_id = course.pk
+            with_requirements.append(requirement)
+        # endif
+    # endfor
+
+    EntryRequirement.objects.bulk_create(
+        with_requirements, batch_size=batch_size,
+        update_conflicts=True, unique_fields=['course'], update_fields=REQUIREMENT_FIELDS,
+    )
+
+    if moved_university_ids:
+        update_course_regions(Course.objects.filter(university_id__in=moved_university_ids))
+    # endif
+    update_search_documents(Course.objects.filter(
+        Q(pk__in=[course.pk for course in courses]) | Q(university_id__in=moved_university_ids)
+    ))
+
+
+# enddef
+
+
+def import_catalog(universities: Iterable[Dict], batch_size: int = 1000, delete_missing: bool = True,
+                   max_removed_fraction: Optional[float] = None) -> ImportStats:
+    """
+    Brings the catalog in line with the scraped universities in one transaction, only writing what changed.
+
+    :param universities: University dictionaries (e.g. from iter_json_array)
+    :param batch_size: Roughly how many courses to write per batch
+    :param delete_missing: Whether to delete universities that aren't in the file (False for a partial file)
+    :param max_removed_fraction: Most of the current courses the import may remove, defaults to
+                                 COURSEFINDER_IMPORT_MAX_REMOVED_FRACTION (None for no limit)
+    :return: ImportStats counting what was added, changed, removed and unchanged
+    :raises CatalogImportRunning: If another import is running
+    :raises CatalogValidationError: If the import would remove too many courses (the catalog isn't changed)
+    """
+    stats = ImportStats()
+    if max_removed_fraction is None:
+        max_removed_fraction = getattr(settings, "COURSEFINDER_IMPORT_MAX_REMOVED_FRACTION", None)
+    # endif
+
+    # catalog_update is outside the transaction so its bump runs after commit/rollback, not in an aborted transaction
+    with catalog_import_lock(), catalog_update(), transaction.atomic():
+        # for the removed courses check, which (like the staged import) only applies when deleting missing universities
+        check_removals = delete_missing and max_removed_fraction is not None
+        current_courses = Course.objects.count() if check_removals else 0
+
+        # the university table is small, so its hashes are loaded up front
+        stored_universities = {
+            name: (university_id, stored_hash, location, website, all_courses_url)
+            for name, university_id, stored_hash, location, website, all_courses_url in
+            University.objects.values_list('name', 'id', 'content_hash', 'location', 'website', 'all_courses_url')
+        }
+        seen_names = set()
+
+        batch: Dict[str, ScrapedUniversity] = {}
+        pending_courses = 0
+        for data in universities:
+            university, courses, requirements = build_university(data)
+            seen_names.add(university.name)
+
+            stored = stored_universities.get(university.name)
+            if stored is not None and stored[1] == university.content_hash:
+                stats.unchanged['universities'] += 1
+                stats.unchanged['courses'] += len(courses)
+                continue
+            # endif
+
+            # a university listed twice in one batch is written once (the last copy)
+            batch[university.name] = (university, courses, requirements)
+            pending_courses += len(courses)
+            if pending_courses >= batch_size:
+                write_batch(list(batch.values()), stored_universities, batch_size, stats)
+                batch = {}
+                pending_courses = 0
+            # endif
+        # endfor
+
+        if batch:
+            write_batch(list(batch.values()), stored_universities, batch_size, stats)
+        # endif
+
+        if delete_missing:
+            missing_ids = [stored[0] for name, stored in stored_universities.items() if name not in seen_names]
+
+            # courses dropped from changed universities are already deleted, but raising rolls that back too
+            if check_removals:
+                missing_courses = Course.objects.filter(university_id__in=missing_ids).count() if missing_ids else 0
+                check_removed_courses(current_courses, stats.removed['courses'] + missing_courses, max_removed_fraction)
+            # endif
+
+            if missing_ids:
+                _, deleted = University.objects.filter(pk__in=missing_ids).delete()
+                stats.removed['universities'] += deleted.get(University._meta.label, 0)
+                stats.removed['courses'] += deleted.get(Course._meta.label, 0)
+            # endif
+        # endif
+
+        # bulk writes don't send signals, so tell the caches ourselves (only if anything changed)
+        if stats.has_changes:
+            mark_catalog_changed()
+        # endif
+    # endwith
+
+    # load the new catalog into the in-memory index straight away
+    if stats.has_changes and get_search_engine() == "memory":
+        rebuild_search_index()
+    # endif
+
+    # and into the flattened search view (once the new rows are committed)
+    if stats.has_changes:
+        refresh_search_view()
+    # endif
+
+    return stats
+# enddef
@@ -0,0 +1,240 @@
+"""
+Vectorized entry requirement checks against the whole catalog
+
+Matching used to compare only the total UCAS points, so a student without
+the A in Maths a course asks for still saw it. Checking every course's
+subject requirements in Python for each search would be slow, so the
+requirements are kept in NumPy arrays instead:
+
+    points          minimum UCAS points for each course
+    min_grades      minimum grade (as a GRADE_POINTS value) for each course
+    subject_grades  course x subject matrix of the grade needed in each subject (0 = not needed)
+
+A student's grades are turned into one vector over the same subjects, and
+every course is checked against it in a single pass. Like the search index,
+the arrays are rebuilt when the catalog version changes.
+"""
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .catalog import get_catalog_version
+from .models import EntryRequirement, SubjectRequirement
+from .query_parsing import GRADE_POINTS
+from .synonym_matcher import get_synonym_matcher
+
+# min_grade_required is checked against the weakest of the student's best this many grades
+COUNTED_GRADES = 3
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def grade_value(grade: Optional[str]) -> int:
+    """
+    Turns a grade into a number that can be compared (its UCAS points).
+
+    :param grade: Grade like "A*" or "B" (any case)
+    :return: Points for the grade, 0 for blank or unknown grades
+    """
+    if not grade:
+        return 0
+    # endif
+    return GRADE_POINTS.get(grade.strip().upper(), 0)
+
+
+# enddef
+
+
+def normalize_subject(subject: str, synonyms: Dict[str, str]) -> str:
+    """
+    Turns a subject name into the name used for matching, so "Maths" on
+    the student's side and "Mathematics" on the course's side line up.
+
+    :param subject: Subject name
+    :param synonyms: Synonym -> main subject lookup (SynonymMatcher.reverse_lookup)
+    :return: Lowercase main subject name
+    """
+    subject = " ".join(subject.lower().split())
+    return synonyms.get(subject, subject)
+
+
+# enddef
+
+
+class EligibilityEngine:
+    """
+    Entry requirements for every course that has them, as NumPy arrays.
+
+    Rows follow course_ids (sorted). Courses without an EntryRequirement
+    aren't in the arrays, as they never stop anyone applying.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.course_ids = np.zeros(0, dtype=np.int64)
+        self.points = np.zeros(0, dtype=np.int32)
+        self.min_grades = np.zeros(0, dtype=np.uint8)
+        self.subject_grades = np.zeros((0, 0), dtype=np.uint8)
+        self.subjects: Dict[str, int] = {}  # normalized subject -> column
+        self.synonyms: Dict[str, str] = {}
+    # enddef
+
+    @classmethod
+    def build(cls, version: int = None) -> "EligibilityEngine":
+        """
+        Builds the arrays from the requirements in the database.
+
+        :param version: Catalog version read before building, used to spot when it goes stale
+        :return: New EligibilityEngine
+        """
+        engine = cls()
+        engine.version = version
+        engine.synonyms = get_synonym_matcher().reverse_lookup
+
+        rows = list(EntryRequirement.objects.order_by('course_id').values_list(
+            'course_id', 'min_ucas_points', 'min_grade_required', 'has_requirements'
+        ))
+
+        engine.course_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        engine.points = np.fromiter((row[1] for row in rows), dtype=np.int32, count=len(rows))
+        # courses marked as having no requirements don't ask for any grades either
+        engine.min_grades = np.fromiter(
+            (grade_value(row[2]) if row[3] else 0 for row in rows), dtype=np.uint8, count=len(rows)
+        )
+
+        subject_rows = SubjectRequirement.objects.filter(
+            entry_requirement__has_requirements=True
+        ).values_list('entry_requirement__course_id', 'subject', 'grade')
+
+        positions = []
+        columns = []
+        grades = []
+        for course_id, subject, grade in subject_rows.iterator(chunk_size=2000):
+            grade = grade_value(grade)
+            if not grade:
+                continue
+            # endif
+            column = engine.subjects.setdefault(normalize_subject(subject, engine.synonyms), len(engine.subjects))
+            positions.append(course_id)
+            columns.append(column)
+            grades.append(grade)
+        # endfor
+
+        engine.subject_grades = np.zeros((len(rows), len(engine.subjects)), dtype=np.uint8)
+        if positions:
+            course_rows = np.searchsorted(engine.course_ids, np.array(positions, dtype=np.int64))
+            # two spellings of the same subject can land in one cell, so keep the higher grade
+            np.maximum.at(engine.subject_grades, (course_rows, np.array(columns)), np.array(grades, dtype=np.uint8))
+        # endif
+
+        return engine
+    # enddef
+
+    def student_grades(self, grades: Dict[str, str]) -> np.ndarray:
+        """
+        Lines a student's grades up with the subject columns.
+
+        :param grades: Dictionary mapping subject names to grades (from GradeParser)
+        :return: Array with the student's grade in each subject column (0 if they didn't name it)
+        """
+        student = np.zeros(len(self.subjects), dtype=np.uint8)
+        for subject, grade in grades.items():
+            column = self.subjects.get(normalize_subject(subject, self.synonyms))
+            if column is not None:
+                student[column] = max(student[column], grade_value(grade))
+            # endif
+        # endfor
+        return student
+    # enddef
+
+    def grade_checks(self, grades: Dict[str, str]) -> np.ndarray:
+        """
+        Checks the minimum grade and subject requirements of every course.
+
+        Subject requirements are only checked for subjects the student named.
+        Grades often come without a subject ("I got AAB") or with one we can't
+        match, and that shouldn't rule out every course asking for a subject.
+
+        :param grades: Dictionary mapping subject names to grades (from GradeParser)
+        :return: Boolean array, True where the student meets them
+        """
+        values = sorted((grade_value(grade) for grade in grades.values()), reverse=True)
+        counted = values[:COUNTED_GRADES]
+        weakest = counted[-1] if counted else 0
+
+        meets = self.min_grades <= weakest
+
+        student = self.student_grades(grades)
+        named = np.flatnonzero(student)
+        if len(named):
+            meets &= (self.subject_grades[:, named] <= student[named]).all(axis=1)
+        # endif
+        return meets
+    # enddef
+
+    def eligible(self, grades: Dict[str, str], ucas_points: int) -> np.ndarray:
+        """
+        Checks every course's points, minimum grade and subject requirements.
+
+        :param grades: Dictionary mapping subject names to grades (from GradeParser)
+        :param ucas_points: Total UCAS points from the grades
+        :return: Boolean array over course_ids, True where the student can apply
+        """
+        return (self.points <= ucas_points) & self.grade_checks(grades)
+    # enddef
+
+    def eligible_course_ids(self, grades: Dict[str, str], ucas_points: int) -> List[int]:
+        """
+        Finds every course with requirements the student meets.
+
+        Courses without an EntryRequirement are always open and aren't included.
+
+        :param grades: Dictionary mapping subject names to grades (from GradeParser)
+        :param ucas_points: Total UCAS points from the grades
+        :return: List of course ids
+        """
+        return self.course_ids[self.eligible(grades, ucas_points)].tolist()
+    # enddef
+
+    def failed_grade_course_ids(self, grades: Dict[str, str], ucas_points: int) -> List[int]:
+        """
+        Finds courses the student has the points for but not the grades.
+
+        Searches already filter on points (with an index), so these are the
+        only courses they still need to drop.
+
+        :param grades: Dictionary mapping subject names to grades (from GradeParser)
+        :param ucas_points: Total UCAS points from the grades
+        :return: List of course ids
+        """
+        failed = (self.points <= ucas_points) & ~self.grade_checks(grades)
+        return self.course_ids[failed].tolist()
+    # enddef
+# endclass
+
+
+def get_eligibility_engine() -> EligibilityEngine:
+    """
+    Gets the shared engine, building it the first time it's needed and
+    rebuilding it when the catalog version changes.
+
+    :return: EligibilityEngine for the current catalog
+    """
+    global _engine
+
+    version = get_catalog_version()
+    engine = _engine
+    if engine is None or engine.version != version:
+        with _engine_lock:
+            # another thread might have built it while we waited
+            if _engine is None or _engine.version != version:
+                _engine = EligibilityEngine.build(version)
+            # endif
+            engine = _engine
+        # endwith
+    # endif
+
+    return engine
+# enddef
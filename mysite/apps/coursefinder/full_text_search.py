@@ -0,0 +1,123 @@
+"""
+Postgres full-text search over courses and universities
+"""
+import re
+from typing import List, Optional
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import F, OuterRef, QuerySet, Subquery
+
+from .models import Course, University
+
+# text search config used for both the stored documents and the queries
+SEARCH_CONFIG = "english"
+
+
+def is_postgres() -> bool:
+    """
+    Checks if the default database supports full-text search.
+
+    :return: True when the database is Postgres
+    """
+    return connection.vendor == "postgresql"
+
+
+# enddef
+
+
+def build_search_vector() -> SearchVector:
+    """
+    Builds the expression used to fill Course.search_document.
+
+    Course name and university name are weighted highest so they rank above
+    matches on the course type or the university location.
+
+    :return: SearchVector expression that can be used in an update
+    """
+    uni = University.objects.filter(pk=OuterRef("university_id"))
+
+    return (
+        SearchVector("name", weight="A", config=SEARCH_CONFIG)
+        + SearchVector(Subquery(uni.values("name")[:1]), weight="A", config=SEARCH_CONFIG)
+        + SearchVector("course_type", weight="B", config=SEARCH_CONFIG)
+        + SearchVector(Subquery(uni.values("location")[:1]), weight="C", config=SEARCH_CONFIG)
+    )
+
+
+# enddef
+
+
+def update_search_documents(courses: Optional[QuerySet] = None) -> int:
+    """
+    Recomputes the search document for the given courses (or all of them).
+
+    :param courses: Optional Course queryset to limit which rows are updated
+    :return: Number of rows updated (0 if the database isn't Postgres)
+    """
+    if not is_postgres():
+        return 0
+    # endif
+
+    if courses is None:
+        courses = Course.objects.all()
+    # endif
+
+    return courses.update(search_document=build_search_vector())
+
+
+# enddef
+
+
+def build_search_query(terms: List[str]) -> Optional[SearchQuery]:
+    """
+    Turns search terms into a prefix-matching tsquery.
+
+    Every word gets a ":*" so partly typed words like "manch" still match,
+    and the terms are OR'd together like the old icontains chain.
+
+    :param terms: List of search terms (already expanded with synonyms)
+    :return: SearchQuery or None if the terms have no searchable words
+    """
+    search_query = None
+
+    for term in terms:
+        # only keep word characters so user input can't break the tsquery syntax
+        words = re.findall(r"\w+", term.lower())
+        if not words:
+            continue
+        # endif
+
+        raw = " & ".join(f"{word}:*" for word in words)
+        term_query = SearchQuery(raw, search_type="raw", config=SEARCH_CONFIG)
+
+        if search_query is None:
+            search_query = term_query
+        else:
+            search_query |= term_query
+        # endif
+    # endfor
+
+    return search_query
+
+
+# enddef
+
+
+def full_text_filter(courses: QuerySet, terms: List[str]) -> QuerySet:
+    """
+    Filters courses by full-text match and annotates each with a "rank".
+
+    :param courses: Course queryset to filter
+    :param terms: List of search terms (already expanded with synonyms)
+    :return: Filtered queryset annotated with rank (empty if nothing is searchable)
+    """
+    search_query = build_search_query(terms)
+    if search_query is None:
+        return courses.none()
+    # endif
+
+    return courses.filter(search_document=search_query).annotate(
+        rank=SearchRank(F("search_document"), search_query)
+    )
+# enddef
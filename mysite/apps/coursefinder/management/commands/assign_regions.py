@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mysite.apps.coursefinder.catalog import catalog_update, mark_catalog_changed
+from mysite.apps.coursefinder.regions import update_course_regions, update_university_regions
+from mysite.apps.coursefinder.search_view import refresh_search_view
+
+
+class Command(BaseCommand):
+    help = "Works out the stored region of every university and course again (run after changing LOCATION_REGIONS)"
+
+    def handle(self, *args, **options):
+        # bump after the transaction commits or rolls back, not inside an aborted one
+        with catalog_update(), transaction.atomic():
+            # universities first, since courses without their own region copy the university's
+            universities_changed = update_university_regions()
+            courses_changed = update_course_regions()
+
+            # bulk updates don't send signals, so tell the caches ourselves
+            if universities_changed or courses_changed:
+                mark_catalog_changed()
+            # endif
+        # endwith
+
+        # the search view has its own copy of the regions
+        if universities_changed or courses_changed:
+            refresh_search_view()
+        # endif
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Updated regions of {universities_changed} universities and {courses_changed} courses")
+        )
+    # enddef
+# endclass
@@ -0,0 +1,96 @@
+import statistics
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from mysite.apps.coursefinder.models import Course
+from mysite.apps.coursefinder.results import RESULT_FIELDS, format_row
+
+
+class DictMatchResult:
+    """
+    UniMatchResult as it was before __slots__ (one __dict__ per row), kept here to compare against.
+    """
+
+    def __init__(self, university, course, course_type, duration, requirements, course_link, is_saved=False):
+        self.university = university
+        self.course = course
+        self.course_type = course_type
+        self.duration = duration
+        self.requirements = requirements
+        self.course_link = course_link
+        self.is_saved = is_saved
+    # enddef
+# endclass
+
+
+def load_models(queryset):
+    """
+    The old row path: full Course and University instances copied into a dict-backed result.
+    """
+    return [
+        DictMatchResult(course.university.name, course.name, course.course_type, course.duration,
+                        course.requirements_display, course.link or "#")
+        for course in queryset.select_related('university')
+    ]
+
+
+# enddef
+
+
+def load_projected(queryset):
+    """
+    The current row path: values_list over RESULT_FIELDS into slotted UniMatchResults.
+    """
+    return [format_row(row) for row in queryset.values_list(*RESULT_FIELDS)]
+
+
+# enddef
+
+
+class Command(BaseCommand):
+    help = "Compares time and allocations per 1,000 result rows for model instances vs the projected row path"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1000, help="How many result rows to load each time")
+        parser.add_argument("--repeat", type=int, default=10, help="How many times to time each path")
+    # enddef
+
+    def handle(self, *args, **options):
+        rows = options["rows"]
+        queryset = Course.objects.order_by("university__name", "name")[:rows]
+        loaded = queryset.count()
+        if not loaded:
+            self.stdout.write("No courses to load")
+            return
+        # endif
+
+        # per 1,000 rows so runs with different --rows can be compared
+        scale = 1000 / loaded
+        self.stdout.write(f"Loading {loaded} rows, figures per 1,000 rows:")
+
+        for label, load in [("models + __dict__", load_models), ("values_list + __slots__", load_projected)]:
+            load(queryset)  # warm up (connection, query compilation)
+
+            times = []
+            for _ in range(options["repeat"]):
+                start = time.perf_counter()
+                load(queryset)
+                times.append((time.perf_counter() - start) * 1000 * scale)
+            # endfor
+
+            # retained = memory still held by the result list, peak = most allocated while loading
+            tracemalloc.start()
+            results = load(queryset)
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del results
+
+            self.stdout.write(
+                f"  {label:24} mean {statistics.mean(times):7.2f} ms | "
+                f"retained {retained * scale / 1024:8.1f} KiB | peak {peak * scale / 1024:8.1f} KiB"
+            )
+        # endfor
+    # enddef
+# endclass
@@ -0,0 +1,167 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from mysite.apps.coursefinder.query_parsing import clear_parse_cache, get_parse_cache_stats, parse_query
+from mysite.apps.coursefinder.search_index import rebuild_search_index
+from mysite.apps.coursefinder.search_service import find_matching_courses
+from mysite.apps.coursefinder.synonym_matcher import clear_synonym_matcher
+from mysite.apps.coursefinder.university_search import expand_query_with_synonyms, run_university_search
+from mysite.apps.nlp.synonyms import SYNONYMS
+
+DEFAULT_QUERIES = ["computer science", "london", "medicine", "manchester", "law", "engineering"]
+
+PAGE_SIZE = 50
+
+SYNONYM_QUERIES = ["maths", "comp sci", "manchester", "I like comp sci and maths", "kings college london"]
+
+PARSE_QUERIES = ["I got AAB and want to study computer science", "A*AA maths physics", "BBC  in   law"]
+
+
+def linear_expand(query):
+    """
+    The old synonym expansion (a scan over every synonym), kept here to compare against.
+    """
+    query_lower = query.strip().lower()
+    for subject, synonym_list in SYNONYMS.get('courses', {}).items():
+        for synonym in synonym_list:
+            if synonym.lower() == query_lower:
+                return [subject.lower()]
+            # endif
+        # endfor
+    # endfor
+    return [query_lower]
+
+
+# enddef
+
+
+class Command(BaseCommand):
+    help = "Times course searches with the database and in-memory search engines"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--query", action="append", dest="queries",
+                            help="Query to time (can be given more than once)")
+        parser.add_argument("--repeat", type=int, default=20, help="How many times to run each query")
+        parser.add_argument("--synonyms-only", action="store_true",
+                            help="Only run the synonym and parsing micro-benchmarks")
+    # enddef
+
+    def handle(self, *args, **options):
+        queries = options["queries"] or DEFAULT_QUERIES
+        repeat = options["repeat"]
+
+        self.benchmark_synonyms()
+        self.benchmark_parsing(repeat)
+        if options["synonyms_only"]:
+            return
+        # endif
+
+        start = time.perf_counter()
+        index = rebuild_search_index()
+        build_ms = (time.perf_counter() - start) * 1000
+        self.stdout.write(
+            f"Built in-memory index: {len(index.course_ids)} courses, "
+            f"{len(index.vocabulary)} terms in {build_ms:.1f} ms"
+        )
+
+        for engine in ["database", "memory"]:
+            self.stdout.write(f"\nEngine: {engine}")
+            with override_settings(COURSEFINDER_SEARCH_ENGINE=engine):
+                for query in queries:
+                    # run_university_search skips the result cache, which would answer every run but the first
+                    search_times = self.time_search(
+                        lambda: run_university_search(query, {}), repeat
+                    )
+                    match_times = self.time_search(
+                        lambda: find_matching_courses(120, [query], {}), repeat
+                    )
+                    self.stdout.write(
+                        f"  {query!r:24} search tab {self.summary(search_times)} | "
+                        f"matches tab {self.summary(match_times)}"
+                    )
+                # endfor
+            # endwith
+        # endfor
+    # enddef
+
+    def benchmark_synonyms(self, loops=20000):
+        """
+        Compares the per-query cost of the old synonym scan with the compiled matcher.
+        """
+        clear_synonym_matcher()
+        start = time.perf_counter()
+        expand_query_with_synonyms("warm up")
+        compile_us = (time.perf_counter() - start) * 1_000_000
+
+        synonym_count = sum(len(synonyms) for synonyms in SYNONYMS.get('courses', {}).values())
+        self.stdout.write(f"Synonym matcher: {synonym_count} synonyms compiled in {compile_us:.0f} us")
+
+        for query in SYNONYM_QUERIES:
+            start = time.perf_counter()
+            for _ in range(loops):
+                linear_expand(query)
+            # endfor
+            linear_us = (time.perf_counter() - start) * 1_000_000 / loops
+
+            start = time.perf_counter()
+            for _ in range(loops):
+                expand_query_with_synonyms(query)
+            # endfor
+            compiled_us = (time.perf_counter() - start) * 1_000_000 / loops
+
+            self.stdout.write(f"  {query!r:30} linear scan {linear_us:6.2f} us | compiled {compiled_us:6.2f} us")
+        # endfor
+        self.stdout.write("")
+    # enddef
+
+    def benchmark_parsing(self, repeat):
+        """
+        Compares a first (uncached) NLP parse with repeats of the same query.
+        """
+        clear_parse_cache()
+        self.stdout.write("Query parsing:")
+        for query in PARSE_QUERIES:
+            start = time.perf_counter()
+            parse_query(query)
+            first_ms = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                parse_query(query)
+            # endfor
+            cached_us = (time.perf_counter() - start) * 1_000_000 / repeat
+
+            self.stdout.write(f"  {query!r:50} first parse {first_ms:7.2f} ms | cached {cached_us:6.2f} us")
+        # endfor
+
+        stats = get_parse_cache_stats()
+        self.stdout.write(
+            f"  parse cache: {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['size']}/{stats['max_size']} entries\n"
+        )
+    # enddef
+
+    @staticmethod
+    def time_search(run_search, repeat):
+        """
+        Runs a search and renders its first page, returning the time of each run in ms.
+        """
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results = run_search()
+            len(results)
+            list(results[:PAGE_SIZE])
+            times.append((time.perf_counter() - start) * 1000)
+        # endfor
+        return times
+    # enddef
+
+    @staticmethod
+    def summary(times):
+        return f"mean {statistics.mean(times):7.2f} ms, max {max(times):7.2f} ms"
+    # enddef
+# endclass
@@ -0,0 +1,73 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# run in a fresh interpreter each time, so nothing is already imported
+CHILD_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import django
+django.setup()
+import mysite.urls
+startup_ms = (time.perf_counter() - start) * 1000
+
+from mysite.apps.coursefinder.search_service import search_courses
+start = time.perf_counter()
+results = search_courses(QUERY, {})
+len(results["matching_courses"])
+list(results["matching_courses"][:50])
+first_ms = (time.perf_counter() - start) * 1000
+
+start = time.perf_counter()
+results = search_courses(QUERY + " again", {})
+len(results["matching_courses"])
+list(results["matching_courses"][:50])
+second_ms = (time.perf_counter() - start) * 1000
+
+print(json.dumps({"startup": startup_ms, "first": first_ms, "second": second_ms}))
+"""
+
+
+class Command(BaseCommand):
+    help = "Times worker startup and the first search, with and without COURSEFINDER_WARM_UP"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--query", default="I got AAB and want to study computer science",
+                            help="Query used for the first search")
+        parser.add_argument("--runs", type=int, default=3, help="How many fresh processes to start for each mode")
+    # enddef
+
+    def handle(self, *args, **options):
+        script = f"QUERY = {options['query']!r}\n{CHILD_SCRIPT}"
+
+        for warm_up in [False, True]:
+            runs = [self.run_child(script, warm_up) for _ in range(options["runs"])]
+
+            self.stdout.write(f"Warm-up {'on' if warm_up else 'off'}:")
+            for name, label in [("startup", "startup"), ("first", "first search"), ("second", "second search")]:
+                times = [run[name] for run in runs]
+                self.stdout.write(f"  {label:14} mean {statistics.mean(times):8.1f} ms, max {max(times):8.1f} ms")
+            # endfor
+        # endfor
+    # enddef
+
+    @staticmethod
+    def run_child(script, warm_up):
+        """
+        Starts a new Python process with the same settings and returns its timings.
+        """
+        env = dict(os.environ)
+        env["DJANGO_SETTINGS_MODULE"] = settings.SETTINGS_MODULE
+        env["COURSEFINDER_WARM_UP"] = "1" if warm_up else "0"
+
+        output = subprocess.run(
+            [sys.executable, "-c", script], env=env, capture_output=True, text=True, check=True
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+    # enddef
+# endclass
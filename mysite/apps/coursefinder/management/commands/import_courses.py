@@ -0,0 +1,79 @@
+import resource
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from mysite.apps.coursefinder.catalog import CatalogImportRunning
+from mysite.apps.coursefinder.catalog_copy import bulk_load_catalog
+from mysite.apps.coursefinder.catalog_import import import_catalog, iter_json_array
+
+
+class Command(BaseCommand):
+    help = "Imports universities, courses and entry requirements from the scraper's universities.json"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Path to the universities.json written by the scraper")
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Roughly how many courses to write at a time (only used by the ORM import, "
+                                 "the staged import copies every row in one go)")
+        parser.add_argument("--keep-missing", action="store_true",
+                            help="Don't delete universities that aren't in the file (for a partial scrape)")
+        parser.add_argument("--orm", action="store_true",
+                            help="Write straight into the catalog through the ORM instead of staging the rows first "
+                                 "(always used on databases other than Postgres)")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="Worker processes building rows for the staged import (defaults to the number of CPUs)")
+        parser.add_argument("--force", action="store_true",
+                            help="Import even if it would remove more than COURSEFINDER_IMPORT_MAX_REMOVED_FRACTION "
+                                 "of the courses")
+    # enddef
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        # endif
+        if options["workers"] is not None and options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+        # endif
+        max_removed_fraction = 1.0 if options["force"] else None
+
+        start = time.perf_counter()
+        try:
+            with open(options["path"], encoding="utf-8") as stream:
+                # staged on postgres, so searches aren't affected until the short merge at the end
+                if connection.vendor == "postgresql" and not options["orm"]:
+                    stats = bulk_load_catalog(iter_json_array(stream), workers=options["workers"],
+                                              delete_missing=not options["keep_missing"],
+                                              max_removed_fraction=max_removed_fraction)
+                else:
+                    stats = import_catalog(iter_json_array(stream), batch_size=options["batch_size"],
+                                           delete_missing=not options["keep_missing"],
+                                           max_removed_fraction=max_removed_fraction)
+                # endif
+            # endwith
+        except (OSError, ValueError, KeyError, CatalogImportRunning) as e:
+            raise CommandError(f"Could not import {options['path']}: {e!r}")
+        finally:
+            elapsed = time.perf_counter() - start
+        # endtry
+
+        # peak resident memory of this process (not the workers), free to read unlike tracemalloc
+        # which slows every allocation down; ru_maxrss is in KiB on Linux but bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            peak *= 1024
+        # endif
+
+        self.stdout.write(f"Universities: {stats.summary('universities')}")
+        self.stdout.write(f"Courses: {stats.summary('courses')}")
+        if not stats.has_changes:
+            self.stdout.write("Nothing changed, catalog version left alone")
+        # endif
+        self.stdout.write(self.style.SUCCESS(
+            f"Read {stats.records} records in {elapsed:.1f}s "
+            f"({stats.records / elapsed if elapsed else 0:,.0f} rows/sec, peak RSS {peak / 1024 / 1024:.1f} MiB)"
+        ))
+    # enddef
+# endclass
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mysite.apps.coursefinder.search_view import refresh_search_view
+
+
+class Command(BaseCommand):
+    help = "Refreshes the flattened course search view (run after editing courses outside an import)"
+
+    def handle(self, *args, **options):
+        if not refresh_search_view():
+            raise CommandError("The course search view only exists on Postgres")
+        # endif
+
+        self.stdout.write(self.style.SUCCESS("Refreshed the course search view"))
+    # enddef
+# endclass
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:20
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+
+
+def fill_search_documents(apps, schema_editor):
+    # only postgres has tsvector, other databases use the icontains fallback
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    # endif
+
+    schema_editor.execute(
+        """
+        UPDATE coursefinder_course AS c
+        SET search_document =
+            setweight(to_tsvector('english', coalesce(c.name, '')), 'A')
+            || setweight(to_tsvector('english', coalesce(u.name, '')), 'A')
+            || setweight(to_tsvector('english', coalesce(c.course_type, '')), 'B')
+            || setweight(to_tsvector('english', coalesce(u.location, '')), 'C')
+        FROM coursefinder_university AS u
+        WHERE u.id = c.university_id
+        """
+    )
+
+
+# enddef
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("coursefinder", "0004_alter_course_mode"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="course",
+            name="search_document",
+            field=django.contrib.postgres.search.SearchVectorField(
+                editable=False, null=True
+            ),
+        ),
+        migrations.AlterField(
+            model_name="course",
+            name="mode",
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name="course",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_document"], name="course_search_document_gin"
+            ),
+        ),
+        migrations.RunPython(fill_search_documents, migrations.RunPython.noop),
+    ]
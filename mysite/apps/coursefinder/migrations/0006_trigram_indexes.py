@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:22
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("coursefinder", "0005_course_search_document"),
+    ]
+
+    operations = [
+        # gin_trgm_ops needs the pg_trgm extension
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name="course",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["name"], name="course_name_trgm", opclasses=["gin_trgm_ops"]
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="university",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["name"], name="university_name_trgm", opclasses=["gin_trgm_ops"]
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="university",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["location"],
+                name="university_location_trgm",
+                opclasses=["gin_trgm_ops"],
+            ),
+        ),
+    ]
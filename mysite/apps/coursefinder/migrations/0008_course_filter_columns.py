@@ -0,0 +1,149 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:31
+
+import re
+
+from django.db import migrations, models
+
+# copies of the normalize.py parsers as they were when this migration was written,
+# so changing them later doesn't change what the migration does
+
+# (flag, words that mean it), checked against the lowercased mode text
+STUDY_MODE_KEYWORDS = [
+    (1, ["full time", "full-time", "fulltime"]),
+    (2, ["part time", "part-time", "parttime"]),
+    (4, ["sandwich", "placement", "industry"]),
+    (8, ["distance", "online"]),
+]
+
+QUALIFICATION_MAX_LENGTH = 20
+
+
+def parse_duration_years(duration):
+    """
+    Gets the number of years from a duration like "3 years" (the last number of a range).
+    """
+    match = re.search(r"(\d+)\s*years?\b", (duration or "").lower())
+    if not match:
+        return None
+    # endif
+    return int(match.group(1))
+
+
+# enddef
+
+
+def parse_study_mode(mode):
+    """
+    Works out the study mode flags mentioned in some mode text.
+    """
+    text = (mode or "").lower()
+    flags = 0
+    for flag, keywords in STUDY_MODE_KEYWORDS:
+        if any(keyword in text for keyword in keywords):
+            flags |= flag
+        # endif
+    # endfor
+    return flags
+
+
+# enddef
+
+
+def parse_qualification(course_type):
+    """
+    Turns a course type into a short qualification code ("BSc (Hons)" -> "bsc-hons").
+    """
+    text = (course_type or "").lower().replace(".", "")
+    if "foundation" in text or re.match(r"\s*fd[a-z]*\b", text):
+        return "foundation"
+    # endif
+
+    match = re.match(r"\s*([a-z]+)", text)
+    if not match:
+        return ""
+    # endif
+
+    code = match.group(1)
+    if re.search(r"\bhon(s|ours)?\b", text):
+        code += "-hons"
+    # endif
+    return code[:QUALIFICATION_MAX_LENGTH]
+
+
+# enddef
+
+
+def fill_filter_columns(apps, schema_editor):
+    Course = apps.get_model("coursefinder", "Course")
+
+    batch = []
+    for course in Course.objects.only("id", "duration", "mode", "course_type").iterator(
+        chunk_size=2000
+    ):
+        course.duration_years = parse_duration_years(course.duration)
+        course.study_mode = parse_study_mode(course.mode)
+        course.qualification = parse_qualification(course.course_type)
+        batch.append(course)
+        if len(batch) >= 1000:
+            Course.objects.bulk_update(
+                batch, ["duration_years", "study_mode", "qualification"]
+            )
+            batch = []
+        # endif
+    # endfor
+
+    if batch:
+        Course.objects.bulk_update(
+            batch, ["duration_years", "study_mode", "qualification"]
+        )
+    # endif
+
+
+# enddef
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("coursefinder", "0007_catalogversion"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="course",
+            name="duration_years",
+            field=models.PositiveSmallIntegerField(
+                blank=True, editable=False, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="course",
+            name="qualification",
+            field=models.CharField(blank=True, editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name="course",
+            name="study_mode",
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name="course",
+            index=models.Index(
+                fields=["qualification", "duration_years", "study_mode"],
+                name="course_qual_filter_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="course",
+            index=models.Index(
+                fields=["duration_years", "study_mode"],
+                name="course_duration_filter_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="course",
+            index=models.Index(
+                fields=["study_mode", "qualification"], name="course_mode_filter_idx"
+            ),
+        ),
+        migrations.RunPython(fill_filter_columns, migrations.RunPython.noop),
+    ]
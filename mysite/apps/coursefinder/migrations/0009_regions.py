@@ -0,0 +1,135 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:34
+
+from django.db import migrations, models
+
+# copies of regions.py as it was when this migration was written,
+# so changing LOCATION_REGIONS later doesn't change what the migration does
+# (run the assign_regions command for that)
+LOCATION_REGIONS = {
+    "London & South East": [
+        "London",
+        "Brighton",
+        "Oxford",
+        "Reading",
+        "Southampton",
+        "Surrey",
+        "Kent",
+        "Sussex",
+    ],
+    "South West": ["Bristol", "Bath", "Exeter", "Plymouth", "Bournemouth", "Falmouth"],
+    "West Midlands": ["Birmingham", "Coventry", "Warwick", "Wolverhampton", "Aston"],
+    "East Midlands": ["Nottingham", "Leicester", "Loughborough", "Derby", "Lincoln"],
+    "North West": ["Manchester", "Liverpool", "Lancaster", "Chester", "Salford"],
+    "North East & Yorkshire": [
+        "Leeds",
+        "Sheffield",
+        "York",
+        "Newcastle",
+        "Durham",
+        "Hull",
+        "Bradford",
+    ],
+    "Scotland": [
+        "Edinburgh",
+        "Glasgow",
+        "Aberdeen",
+        "St Andrews",
+        "Dundee",
+        "Stirling",
+    ],
+    "Wales": ["Cardiff", "Swansea", "Bangor", "Aberystwyth"],
+    "Northern Ireland": ["Belfast", "Ulster"],
+}
+
+# lowercase city -> region, in the same order as LOCATION_REGIONS
+CITY_REGIONS = {
+    city.lower(): region
+    for region, cities in LOCATION_REGIONS.items()
+    for city in cities
+}
+
+
+def find_region(location):
+    """
+    Finds the region a location is in by looking for any of the region's cities in it.
+    """
+    text = (location or "").lower()
+    if not text:
+        return ""
+    # endif
+
+    for city, region in CITY_REGIONS.items():
+        if city in text:
+            return region
+        # endif
+    # endfor
+    return ""
+
+
+# enddef
+
+
+def course_region(location, university_region):
+    """
+    A course's region: its own location if that's in a region, otherwise its university's.
+    """
+    return find_region(location) or university_region or ""
+
+
+# enddef
+
+
+def fill_regions(apps, schema_editor):
+    University = apps.get_model("coursefinder", "University")
+    Course = apps.get_model("coursefinder", "Course")
+
+    university_regions = {}
+    universities = []
+    for university in University.objects.only("id", "location"):
+        university.region = find_region(university.location)
+        university_regions[university.id] = university.region
+        universities.append(university)
+    # endfor
+    University.objects.bulk_update(universities, ["region"], batch_size=1000)
+
+    batch = []
+    rows = Course.objects.values_list("id", "location", "university_id")
+    for course_id, location, university_id in rows.iterator(chunk_size=2000):
+        region = course_region(location, university_regions.get(university_id))
+        batch.append(Course(id=course_id, region=region))
+        if len(batch) >= 1000:
+            Course.objects.bulk_update(batch, ["region"])
+            batch = []
+        # endif
+    # endfor
+
+    if batch:
+        Course.objects.bulk_update(batch, ["region"])
+    # endif
+
+
+# enddef
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("coursefinder", "0008_course_filter_columns"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="course",
+            name="region",
+            field=models.CharField(
+                blank=True, db_index=True, editable=False, max_length=50
+            ),
+        ),
+        migrations.AddField(
+            model_name="university",
+            name="region",
+            field=models.CharField(
+                blank=True, db_index=True, editable=False, max_length=50
+            ),
+        ),
+        migrations.RunPython(fill_regions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 5.2.18 on 2026-10-17 04:35
+
+from django.db import migrations, models
+
+# copy of normalize.requirements_display as it was when this migration was written,
+# so changing it later doesn't change what the migration does
+NO_REQUIREMENTS_TEXT = "No specific requirements"
+REQUIREMENTS_DISPLAY_MAX_LENGTH = 100
+
+
+def requirements_display(requirement):
+    """
+    Builds the requirements text shown for a course, e.g. "AAB / DDM".
+    """
+    if requirement is None or not requirement.has_requirements:
+        return NO_REQUIREMENTS_TEXT
+    # endif
+
+    if requirement.display_grades and requirement.display_grades.strip():
+        requirements_str = requirement.display_grades
+    elif requirement.min_ucas_points > 0:
+        requirements_str = f"{requirement.min_ucas_points} UCAS points"
+    else:
+        requirements_str = NO_REQUIREMENTS_TEXT
+    # endif
+
+    if requirement.btec_grades:
+        requirements_str += f" / {requirement.btec_grades}"
+    # endif
+
+    return requirements_str[:REQUIREMENTS_DISPLAY_MAX_LENGTH]
+
+
+# enddef
+
+
+def fill_requirements_display(apps, schema_editor):
+    Course = apps.get_model("coursefinder", "Course")
+    EntryRequirement = apps.get_model("coursefinder", "EntryRequirement")
+
+    # courses without a requirement row keep the default
+    batch = []
+    for requirement in EntryRequirement.objects.iterator(chunk_size=2000):
+        batch.append(
+            Course(
+                id=requirement.course_id,
+                requirements_display=requirements_display(requirement),
+            )
+        )
+        if len(batch) >= 1000:
+            Course.objects.bulk_update(batch, ["requirements_display"])
+            batch = []
+        # endif
+    # endfor
+
+    if batch:
+        Course.objects.bulk_update(batch, ["requirements_display"])
+    # endif
+
+
+# enddef
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("coursefinder", "0009_regions"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="course",
+            name="requirements_display",
+            field=models.CharField(
+                db_index=True,
+                default="No specific requirements",
+                editable=False,
+                max_length=100,
+            ),
+        ),
+        migrations.RunPython(fill_requirements_display, migrations.RunPython.noop),
+    ]
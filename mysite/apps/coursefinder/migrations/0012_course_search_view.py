@@ -0,0 +1,136 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:10
+
+import django.contrib.postgres.search
+import django.db.models.deletion
+from django.db import migrations, models
+
+CREATE_VIEW = """
+CREATE MATERIALIZED VIEW coursefinder_coursesearchrow AS
+SELECT
+    c.id,
+    c.university_id,
+    c.name,
+    u.name AS university_name,
+    u.location AS university_location,
+    c.course_type,
+    c.duration,
+    c.link,
+    c.requirements_display,
+    c.qualification,
+    c.duration_years,
+    c.study_mode,
+    c.region,
+    c.search_document,
+    r.min_ucas_points,
+    r.has_requirements,
+    r.display_grades,
+    (row_number() OVER (ORDER BY u.name, c.name, c.id))::integer AS sort_key
+FROM coursefinder_course AS c
+JOIN coursefinder_university AS u ON u.id = c.university_id
+LEFT JOIN coursefinder_entryrequirement AS r ON r.course_id = c.id
+"""
+
+# the unique id index is what lets the view be refreshed CONCURRENTLY,
+# the others lead with a filter and end with the sort key so pages come out of the index in order
+CREATE_INDEXES = [
+    "CREATE UNIQUE INDEX course_search_row_id ON coursefinder_coursesearchrow (id)",
+    "CREATE UNIQUE INDEX course_search_row_sort ON coursefinder_coursesearchrow (sort_key) "
+    "INCLUDE (min_ucas_points, has_requirements, region, qualification, duration_years, study_mode)",
+    "CREATE INDEX course_search_row_points ON coursefinder_coursesearchrow (min_ucas_points, sort_key)",
+    "CREATE INDEX course_search_row_region ON coursefinder_coursesearchrow (region, sort_key) "
+    "INCLUDE (min_ucas_points)",
+    "CREATE INDEX course_search_row_qual ON coursefinder_coursesearchrow (qualification, sort_key) "
+    "INCLUDE (min_ucas_points)",
+    "CREATE INDEX course_search_row_university ON coursefinder_coursesearchrow (university_id, sort_key)",
+    "CREATE INDEX course_search_row_document ON coursefinder_coursesearchrow USING gin (search_document)",
+]
+
+
+def create_search_view(apps, schema_editor):
+    # only postgres has materialized views, other databases keep searching the tables
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    # endif
+
+    schema_editor.execute(CREATE_VIEW)
+    for sql in CREATE_INDEXES:
+        schema_editor.execute(sql)
+    # endfor
+
+    # the view was just filled from the current catalog
+    CatalogVersion = apps.get_model("coursefinder", "CatalogVersion")
+    version = (
+        CatalogVersion.objects.filter(pk=1).values_list("version", flat=True).first()
+    )
+    CatalogVersion.objects.update_or_create(
+        pk=1, defaults={"version": version or 1, "search_view_version": version or 1}
+    )
+
+
+# enddef
+
+
+def drop_search_view(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    # endif
+
+    schema_editor.execute(
+        "DROP MATERIALIZED VIEW IF EXISTS coursefinder_coursesearchrow"
+    )
+
+
+# enddef
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("coursefinder", "0011_content_hash"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CourseSearchRow",
+            fields=[
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                (
+                    "university",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to="coursefinder.university",
+                    ),
+                ),
+                ("name", models.CharField(max_length=255)),
+                ("university_name", models.CharField(max_length=200)),
+                ("university_location", models.CharField(max_length=200)),
+                ("course_type", models.CharField(max_length=50)),
+                ("duration", models.CharField(max_length=50)),
+                ("link", models.URLField(max_length=500)),
+                ("requirements_display", models.CharField(max_length=100)),
+                ("qualification", models.CharField(max_length=20)),
+                ("duration_years", models.PositiveSmallIntegerField(null=True)),
+                ("study_mode", models.PositiveSmallIntegerField()),
+                ("region", models.CharField(max_length=50)),
+                (
+                    "search_document",
+                    django.contrib.postgres.search.SearchVectorField(null=True),
+                ),
+                ("min_ucas_points", models.IntegerField(null=True)),
+                ("has_requirements", models.BooleanField(null=True)),
+                ("display_grades", models.CharField(max_length=50, null=True)),
+                ("sort_key", models.IntegerField()),
+            ],
+            options={
+                "db_table": "coursefinder_coursesearchrow",
+                "managed": False,
+            },
+        ),
+        migrations.AddField(
+            model_name="catalogversion",
+            name="search_view_version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(create_search_view, drop_search_view),
+    ]
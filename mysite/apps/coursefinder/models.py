@@ -1,5 +1,10 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 
+from .normalize import NO_REQUIREMENTS_TEXT, REQUIREMENTS_DISPLAY_MAX_LENGTH, normalize_course
+from .regions import REGION_MAX_LENGTH, course_region, find_region
+
 
 # Create your models here.
 
@@ -8,6 +13,27 @@ class University(models.Model):
     location = models.CharField(max_length=200, blank=True)
     website = models.URLField(max_length=500, blank=True)  # Link to uni
     all_courses_url = models.URLField(max_length=500, blank=True)  # "View all courses" page
+    region = models.CharField(max_length=REGION_MAX_LENGTH, blank=True, db_index=True, editable=False)  # from location
+    content_hash = models.CharField(max_length=40, blank=True, editable=False)  # of the last import, see catalog_import
+
+    class Meta:
+        # trigram indexes so fuzzy name/location matching doesn't scan the table
+        indexes = [
+            GinIndex(fields=['name'], name='university_name_trgm', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['location'], name='university_location_trgm', opclasses=['gin_trgm_ops']),
+        ]
+
+    # endclass
+
+    def save(self, *args, **kwargs):
+        # courses that take their region from the university are updated by signals.py
+        self.region = find_region(self.location)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'region'}
+        # endif
+        super().save(*args, **kwargs)
+    # enddef
 
     def __str__(self):
         return self.name
@@ -26,12 +52,50 @@ class Course(models.Model):
     start_date = models.CharField(max_length=50, blank=True)
     link = models.URLField(max_length=500, blank=True)
 
+    # normalized copies of duration, mode and course_type for the filters (filled in by save())
+    duration_years = models.PositiveSmallIntegerField(null=True, blank=True, editable=False)
+    study_mode = models.PositiveSmallIntegerField(default=0, editable=False)  # STUDY_MODE_* flags in normalize.py
+    qualification = models.CharField(max_length=20, blank=True, editable=False)  # e.g. "bsc-hons"
+
+    # region of the course's own location, or its university's if it doesn't have one
+    region = models.CharField(max_length=REGION_MAX_LENGTH, blank=True, db_index=True, editable=False)
+
+    # requirements text shown in the results, kept up to date from EntryRequirement by signals.py
+    requirements_display = models.CharField(
+        max_length=REQUIREMENTS_DISPLAY_MAX_LENGTH, default=NO_REQUIREMENTS_TEXT, db_index=True, editable=False
+    )
+
+    # tsvector over course name, type, uni name and location (kept up to date by full_text_search)
+    search_document = SearchVectorField(null=True, editable=False)
+
+    # hash of the imported course and requirement data, so unchanged courses can be skipped (see catalog_import)
+    content_hash = models.CharField(max_length=40, blank=True, editable=False)
+
     class Meta:
         # Ensure course name is unique within each university
         unique_together = ['university', 'name']
+        indexes = [
+            GinIndex(fields=['search_document'], name='course_search_document_gin'),
+            GinIndex(fields=['name'], name='course_name_trgm', opclasses=['gin_trgm_ops']),
+            # one per filter that can come first, with the others after it
+            models.Index(fields=['qualification', 'duration_years', 'study_mode'], name='course_qual_filter_idx'),
+            models.Index(fields=['duration_years', 'study_mode'], name='course_duration_filter_idx'),
+            models.Index(fields=['study_mode', 'qualification'], name='course_mode_filter_idx'),
+        ]
 
     # endclass
 
+    def save(self, *args, **kwargs):
+        # keep the filter columns in step with the text they come from
+        normalize_course(self)
+        self.region = course_region(self.location, self.university.region)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'duration_years', 'study_mode', 'qualification', 'region'}
+        # endif
+        super().save(*args, **kwargs)
+    # enddef
+
     def __str__(self):
         return f"{self.name} - {self.university.name}"
     # enddef
@@ -81,3 +145,66 @@ class SubjectRequirement(models.Model):
         return f"{self.subject}: {self.grade}"
     # enddef
 # endclass
+
+
+class CatalogVersion(models.Model):
+    """
+    Single row holding a number that goes up whenever the course catalog changes.
+
+    Search caches put it in their keys so nothing cached before an import or edit is used afterwards.
+    """
+    version = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # catalog version the course search view was last refreshed at (see search_view.py)
+    search_view_version = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Catalog version {self.version}"
+    # enddef
+# endclass
+
+
+class CourseSearchRow(models.Model):
+    """
+    One row per course from the coursefinder_coursesearchrow materialized view (Postgres only).
+
+    Holds everything the searches filter on and the results table shows, so
+    they can read one table instead of joining Course, University and
+    EntryRequirement. It's refreshed after imports, see search_view.py.
+    """
+    id = models.BigIntegerField(primary_key=True)  # the Course id
+    university = models.ForeignKey(University, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    name = models.CharField(max_length=255)
+    university_name = models.CharField(max_length=200)
+    university_location = models.CharField(max_length=200)
+    course_type = models.CharField(max_length=50)
+    duration = models.CharField(max_length=50)
+    link = models.URLField(max_length=500)
+    requirements_display = models.CharField(max_length=REQUIREMENTS_DISPLAY_MAX_LENGTH)
+
+    # filter columns copied from Course
+    qualification = models.CharField(max_length=20)
+    duration_years = models.PositiveSmallIntegerField(null=True)
+    study_mode = models.PositiveSmallIntegerField()
+    region = models.CharField(max_length=REGION_MAX_LENGTH)
+    search_document = SearchVectorField(null=True)
+
+    # from EntryRequirement, all null when the course doesn't have one
+    min_ucas_points = models.IntegerField(null=True)
+    has_requirements = models.BooleanField(null=True)
+    display_grades = models.CharField(max_length=50, null=True)
+
+    # position in the default display order (university name then course name)
+    sort_key = models.IntegerField()
+
+    class Meta:
+        managed = False
+        db_table = 'coursefinder_coursesearchrow'
+
+    # endclass
+
+    def __str__(self):
+        return f"{self.name} - {self.university_name}"
+    # enddef
+# endclass
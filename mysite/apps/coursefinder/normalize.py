@@ -0,0 +1,206 @@
+"""
+Turns the free-text course fields into values that can be filtered with an index
+
+The scraped duration, mode and course type are free text ("3 years full
+time", "Full-time with placement year", "BSc (Hons)"), so they are
+normalized into duration_years, a study_mode bitmask and a qualification
+code when a course is saved or imported. The filter helpers here turn the
+options picked on the page into the same values. The requirements text shown
+in the results is worked out here too, so it can be stored with the course.
+"""
+import re
+from typing import List, Optional, Tuple
+
+# study mode flags (a course can have more than one, e.g. full-time with a sandwich year)
+STUDY_MODE_FULL_TIME = 1
+STUDY_MODE_PART_TIME = 2
+STUDY_MODE_SANDWICH = 4
+STUDY_MODE_DISTANCE = 8
+
+# words that mean each mode, checked against the lowercased mode text
+STUDY_MODE_KEYWORDS = [
+    (STUDY_MODE_FULL_TIME, ["full time", "full-time", "fulltime"]),
+    (STUDY_MODE_PART_TIME, ["part time", "part-time", "parttime"]),
+    (STUDY_MODE_SANDWICH, ["sandwich", "placement", "industry"]),
+    (STUDY_MODE_DISTANCE, ["distance", "online"]),
+]
+
+# every mask that can be stored (all four flags combined)
+ALL_STUDY_MODES = 15
+
+QUALIFICATION_MAX_LENGTH = 20
+
+NO_REQUIREMENTS_TEXT = "No specific requirements"
+REQUIREMENTS_DISPLAY_MAX_LENGTH = 100
+
+
+def parse_duration_years(duration: str) -> Optional[int]:
+    """
+    Gets the number of years from a duration like "3 years" or "3-4 years".
+
+    For a range the last number is used, which is what the old "N year"
+    text match did.
+
+    :param duration: Duration text from the course
+    :return: Number of years, or None if there isn't one (e.g. "18 months")
+    """
+    match = re.search(r"(\d+)\s*years?\b", (duration or "").lower())
+    if not match:
+        return None
+    # endif
+    return int(match.group(1))
+
+
+# enddef
+
+
+def parse_study_mode(mode: str) -> int:
+    """
+    Works out the study mode flags mentioned in some mode text.
+
+    :param mode: Mode text like "Full time" or "Part-time, distance learning"
+    :return: Bitmask of STUDY_MODE_* flags (0 if none are recognised)
+    """
+    text = (mode or "").lower()
+    flags = 0
+    for flag, keywords in STUDY_MODE_KEYWORDS:
+        if any(keyword in text for keyword in keywords):
+            flags |= flag
+        # endif
+    # endfor
+    return flags
+
+
+# enddef
+
+
+def parse_qualification(course_type: str) -> str:
+    """
+    Turns a course type into a short qualification code.
+
+    "BSc (Hons)" becomes "bsc-hons", "MA" becomes "ma" and any foundation
+    degree (FdA, FdSc, "Foundation Degree") becomes "foundation".
+
+    :param course_type: Course type text like "BSc (Hons)"
+    :return: Qualification code, or "" if there isn't one
+    """
+    text = (course_type or "").lower().replace(".", "")
+    if "foundation" in text or re.match(r"\s*fd[a-z]*\b", text):
+        return "foundation"
+    # endif
+
+    match = re.match(r"\s*([a-z]+)", text)
+    if not match:
+        return ""
+    # endif
+
+    code = match.group(1)
+    if re.search(r"\bhon(s|ours)?\b", text):
+        code += "-hons"
+    # endif
+    return code[:QUALIFICATION_MAX_LENGTH]
+
+
+# enddef
+
+
+def normalize_course(course) -> None:
+    """
+    Fills in a course's duration_years, study_mode and qualification from its text fields.
+
+    :param course: Course object (changed in place, not saved)
+    """
+    course.duration_years = parse_duration_years(course.duration)
+    course.study_mode = parse_study_mode(course.mode)
+    course.qualification = parse_qualification(course.course_type)
+
+
+# enddef
+
+
+def requirements_display(requirement) -> str:
+    """
+    Builds the requirements text shown for a course.
+
+    :param requirement: The course's EntryRequirement, or None if it doesn't have one
+    :return: Requirements string, e.g. "AAB / DDM" or "No specific requirements"
+    """
+    # no requirements for this course
+    if requirement is None or not requirement.has_requirements:
+        return NO_REQUIREMENTS_TEXT
+    # endif
+
+    # course has requirements so show them
+    if requirement.display_grades and requirement.display_grades.strip():
+        requirements_str = requirement.display_grades
+    elif requirement.min_ucas_points > 0:
+        requirements_str = f"{requirement.min_ucas_points} UCAS points"
+    else:
+        requirements_str = NO_REQUIREMENTS_TEXT
+    # endif
+
+    # add btec grades if they exist
+    if requirement.btec_grades:
+        requirements_str += f" / {requirement.btec_grades}"
+    # endif
+
+    return requirements_str[:REQUIREMENTS_DISPLAY_MAX_LENGTH]
+
+
+# enddef
+
+
+def duration_filter_range(selected_duration: str) -> Optional[Tuple[int, Optional[int]]]:
+    """
+    Turns a duration filter option into a range of years.
+
+    :param selected_duration: Option like "3 Years" or "5+ Years"
+    :return: (min years, max years or None for no upper limit), or None if it can't be read
+    """
+    match = re.match(r"\s*(\d+)(\+)?", selected_duration or "")
+    if not match:
+        return None
+    # endif
+
+    years = int(match.group(1))
+    if match.group(2):
+        return years, None
+    # endif
+    return years, years
+
+
+# enddef
+
+
+def study_modes_with(flag: int) -> List[int]:
+    """
+    Lists every study_mode value that includes the flag, so the filter can be an IN lookup.
+
+    :param flag: One or more STUDY_MODE_* flags
+    :return: List of bitmasks containing all of the flags
+    """
+    return [mask for mask in range(ALL_STUDY_MODES + 1) if flag and mask & flag == flag]
+
+
+# enddef
+
+
+def qualification_filter_codes(selected_type: str) -> List[str]:
+    """
+    Turns a course type filter option into the qualification codes it should match.
+
+    An option without honours ("MA") matches the honours version too, so
+    picking MA still finds the Scottish "MA (Hons)" degrees.
+
+    :param selected_type: Option like "BSc (Hons)" or "MA"
+    :return: List of qualification codes
+    """
+    code = parse_qualification(selected_type)
+    if not code:
+        return []
+    # endif
+    if code.endswith("-hons") or code == "foundation":
+        return [code]
+    # endif
+    return [code, f"{code}-hons"[:QUALIFICATION_MAX_LENGTH]]
+# enddef
@@ -0,0 +1,189 @@
+"""
+Memoized NLP parsing of search queries
+
+GradeParser and parse_interests are slow compared to everything else in a
+search, and the same query gets parsed again for every "Load more" page.
+Parses are kept in a bounded LRU keyed on the normalized query text and
+handed out as read-only values so nobody can change a cached entry.
+
+The NLP modules are only imported when the first search needs them (or at
+startup with COURSEFINDER_WARM_UP), so workers that only serve other pages
+never load them.
+"""
+import threading
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, NamedTuple, Tuple
+
+from django.conf import settings
+
+# UCAS points for each grade
+GRADE_POINTS = {
+    'A*': 56,
+    'A': 48,
+    'B': 40,
+    'C': 32,
+    'D': 24,
+    'E': 16,
+    'U': 0,
+    'D*': 56,
+    'M': 32,
+    'P': 16
+}
+
+_parser = None
+# guards creating the parser and using it (we don't know that GradeParser.parse is thread-safe)
+_parser_lock = threading.RLock()
+
+
+class ParsedQuery(NamedTuple):
+    """
+    What the NLP parsers understood from a query (read-only).
+    """
+    grades: MappingProxyType  # subject -> grade
+    interests: Tuple[str, ...]
+    ucas_points: int
+# endclass
+
+
+def normalize_query_text(query: str) -> str:
+    """
+    Strips the query and collapses repeated whitespace.
+
+    Case is kept because the grade parser looks at it.
+
+    :param query: Natural language input from user
+    :return: Normalized query
+    """
+    return " ".join(query.split())
+
+
+# enddef
+
+
+def get_grade_parser():
+    """
+    Gets the GradeParser shared by the whole process, creating it on first use.
+
+    :return: GradeParser instance
+    """
+    global _parser
+
+    parser = _parser
+    if parser is None:
+        with _parser_lock:
+            parser = _parser
+            if parser is None:
+                from mysite.apps.nlp.grade_parser import GradeParser
+
+                parser = GradeParser()
+                _parser = parser
+            # endif
+        # endwith
+    # endif
+
+    return parser
+
+
+# enddef
+
+
+def calculate_ucas_points(grades: Dict[str, str]) -> int:
+    """
+    Calculates total UCAS points from grades dictionary.
+
+    :param grades: Dictionary mapping subject names to grade strings (e.g., {"mathematics": "A", "physics": "B"})
+    :return: Total UCAS points as integer
+    """
+    total = 0
+    for subject, grade in grades.items():
+        grade = grade.upper()
+        if grade in GRADE_POINTS:
+            total += GRADE_POINTS[grade]
+        # endif
+    # endfor
+
+    return total
+
+
+# enddef
+
+
+@lru_cache(maxsize=getattr(settings, "COURSEFINDER_PARSE_CACHE_SIZE", 1024))
+def parse_normalized_query(text: str) -> ParsedQuery:
+    """
+    Runs both NLP parsers on already normalized text (results are memoized).
+
+    :param text: Normalized query text
+    :return: ParsedQuery with grades, interests and UCAS points
+    """
+    from mysite.apps.nlp.course_interests import parse_interests
+
+    # get both grades and interests from the input
+    parser = get_grade_parser()
+    with _parser_lock:
+        parsed = parser.parse(text)
+    # endwith
+
+    # double check for course interests using the other parser too
+    interests_result = parse_interests(text)
+
+    # put all the interests together from both parsers
+    all_interests = list(parsed.get("interests", []))
+    if interests_result and "interests" in interests_result:
+        for interest in interests_result["interests"]:
+            if interest not in all_interests:
+                all_interests.append(interest)
+            # endif
+        # endfor
+    # endif
+
+    grades = dict(parsed.get("grades", {}))
+
+    return ParsedQuery(
+        grades=MappingProxyType(grades),
+        interests=tuple(all_interests),
+        ucas_points=calculate_ucas_points(grades) if grades else 0
+    )
+
+
+# enddef
+
+
+def parse_query(query: str) -> ParsedQuery:
+    """
+    Parses grades and interests out of a query, reusing earlier parses of the same text.
+
+    :param query: Natural language input from user describing grades and interests
+    :return: Read-only ParsedQuery
+    """
+    return parse_normalized_query(normalize_query_text(query))
+
+
+# enddef
+
+
+def get_parse_cache_stats() -> Dict[str, int]:
+    """
+    Gets hit/miss counters for the parse cache.
+
+    :return: Dictionary with hits, misses, size and max_size
+    """
+    info = parse_normalized_query.cache_info()
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "max_size": info.maxsize,
+    }
+
+
+# enddef
+
+
+def clear_parse_cache() -> None:
+    """
+    Empties the parse cache and resets its counters.
+    """
+    parse_normalized_query.cache_clear()
+# enddef
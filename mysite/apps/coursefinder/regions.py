@@ -0,0 +1,138 @@
+"""
+UK regions used by the location filter
+
+Every university and course stores the region its location falls in, so the
+filter is a single indexed equality instead of matching every city in the
+region against the location text. After changing LOCATION_REGIONS run
+"python manage.py assign_regions" to work the stored regions out again.
+"""
+from typing import Optional
+
+LOCATION_REGIONS = {
+    "London & South East": ["London", "Brighton", "Oxford", "Reading", "Southampton", "Surrey", "Kent", "Sussex"],
+    "South West": ["Bristol", "Bath", "Exeter", "Plymouth", "Bournemouth", "Falmouth"],
+    "West Midlands": ["Birmingham", "Coventry", "Warwick", "Wolverhampton", "Aston"],
+    "East Midlands": ["Nottingham", "Leicester", "Loughborough", "Derby", "Lincoln"],
+    "North West": ["Manchester", "Liverpool", "Lancaster", "Chester", "Salford"],
+    "North East & Yorkshire": ["Leeds", "Sheffield", "York", "Newcastle", "Durham", "Hull", "Bradford"],
+    "Scotland": ["Edinburgh", "Glasgow", "Aberdeen", "St Andrews", "Dundee", "Stirling"],
+    "Wales": ["Cardiff", "Swansea", "Bangor", "Aberystwyth"],
+    "Northern Ireland": ["Belfast", "Ulster"],
+}
+
+REGION_MAX_LENGTH = 50
+
+# lowercase city -> region, in the same order as LOCATION_REGIONS
+CITY_REGIONS = {
+    city.lower(): region
+    for region, cities in LOCATION_REGIONS.items()
+    for city in cities
+}
+
+
+def find_region(location: str) -> str:
+    """
+    Finds the region a location is in by looking for any of the region's cities in it.
+
+    :param location: Location text like "London" or "Canterbury, Kent"
+    :return: Region name, or "" if no city matches
+    """
+    text = (location or "").lower()
+    if not text:
+        return ""
+    # endif
+
+    for city, region in CITY_REGIONS.items():
+        if city in text:
+            return region
+        # endif
+    # endfor
+    return ""
+
+
+# enddef
+
+
+def course_region(location: str, university_region: Optional[str]) -> str:
+    """
+    Works out a course's region: its own location if that's in a region, otherwise its university's.
+
+    :param location: The course's location text
+    :param university_region: Region stored on the course's university
+    :return: Region name, or "" if neither has one
+    """
+    return find_region(location) or university_region or ""
+
+
+# enddef
+
+
+def is_known_city(text: str) -> bool:
+    """
+    Checks if some text is exactly one of the cities in LOCATION_REGIONS.
+
+    :param text: Text to check (e.g. a search query)
+    :return: True if it's a city name
+    """
+    return text.strip().lower() in CITY_REGIONS
+
+
+# enddef
+
+
+def update_university_regions(universities=None) -> int:
+    """
+    Works out the region of each university again and saves the ones that changed.
+
+    :param universities: Optional University queryset, defaults to every university
+    :return: Number of universities whose region changed
+    """
+    from .models import University
+
+    if universities is None:
+        universities = University.objects.all()
+    # endif
+
+    changed = []
+    for university in universities.only('id', 'location', 'region').iterator(chunk_size=2000):
+        region = find_region(university.location)
+        if region != university.region:
+            university.region = region
+            changed.append(university)
+        # endif
+    # endfor
+
+    # bulk_update skips save(), so this doesn't set off the signals for every row
+    University.objects.bulk_update(changed, ['region'], batch_size=1000)
+    return len(changed)
+
+
+# enddef
+
+
+def update_course_regions(courses=None) -> int:
+    """
+    Works out the region of each course again (from its location or its
+    university's region) and saves the ones that changed.
+
+    :param courses: Optional Course queryset, defaults to every course
+    :return: Number of courses whose region changed
+    """
+    from .models import Course
+
+    if courses is None:
+        courses = Course.objects.all()
+    # endif
+
+    changed = []
+    rows = courses.values_list('id', 'location', 'region', 'university__region')
+    for course_id, location, region, university_region in rows.iterator(chunk_size=2000):
+        new_region = course_region(location, university_region)
+        if new_region != region:
+            changed.append(Course(id=course_id, region=new_region))
+        # endif
+    # endfor
+
+    Course.objects.bulk_update(changed, ['region'], batch_size=1000)
+    return len(changed)
+# enddef
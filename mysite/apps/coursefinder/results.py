@@ -0,0 +1,211 @@
+"""
+Turns course rows into UniMatchResult objects for the results table
+
+Pages are loaded with values_list over just the columns the table shows
+(RESULT_FIELDS), so no Course or University instances get built per row.
+"""
+from typing import Iterator, List, Optional, Sequence
+
+from django.conf import settings
+from django.db.models import QuerySet
+
+from .models import Course
+from .types import UniMatchResult
+
+# columns needed for one results row, in the order format_row expects
+RESULT_FIELDS = ("id", "university__name", "name", "course_type", "duration", "requirements_display", "link")
+
+
+def format_row(row: tuple) -> UniMatchResult:
+    """
+    Converts a RESULT_FIELDS row into the result object used by the templates.
+
+    :param row: Tuple of values from values_list(*RESULT_FIELDS)
+    :return: UniMatchResult for the course
+    """
+    course_id, university_name, name, course_type, duration, requirements, link = row
+    return UniMatchResult(university_name, name, course_type, duration, requirements, link or "#",
+                          course_id=course_id)
+
+
+# enddef
+
+
+def format_course(course: Course) -> UniMatchResult:
+    """
+    Converts a course into the result object used by the templates.
+
+    :param course: Course object with university selected
+    :return: UniMatchResult for the course
+    """
+    return UniMatchResult(
+        university=course.university.name,
+        course=course.name,
+        course_type=course.course_type,
+        duration=course.duration,
+        requirements=course.requirements_display,
+        course_link=course.link or "#",
+        course_id=course.id
+    )
+
+
+# enddef
+
+
+class SearchResults:
+    """
+    Base class for lazily loaded search results.
+
+    Results only get formatted when they're sliced out (one page at a time),
+    so a search can match thousands of courses cheaply. Works with Django's
+    Paginator because it supports count() and slicing.
+    """
+
+    # True when count() stopped counting at COURSEFINDER_RESULT_COUNT_CAP
+    is_capped = False
+
+    def count(self) -> int:
+        raise NotImplementedError
+    # enddef
+
+    def get_rows(self, start: int, stop: Optional[int]) -> List[UniMatchResult]:
+        raise NotImplementedError
+    # enddef
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[List[UniMatchResult]]:
+        """
+        Goes through every result a chunk at a time, e.g. to stream an export.
+
+        :param chunk_size: Most results in each chunk
+        :return: Iterator of lists of UniMatchResult objects, in display order
+        """
+        start = 0
+        while True:
+            rows = self.get_rows(start, start + chunk_size)
+            if rows:
+                yield rows
+            # endif
+            if len(rows) < chunk_size:
+                return
+            # endif
+            start += chunk_size
+        # endwhile
+    # enddef
+
+    def __len__(self) -> int:
+        return self.count()
+    # enddef
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step not in (None, 1):
+                raise ValueError("Search results can't be sliced with a step")
+            # endif
+            return self.get_rows(index.start or 0, index.stop)
+        # endif
+        return self.get_rows(index, index + 1)[0]
+    # enddef
+
+    def __iter__(self):
+        return iter(self.get_rows(0, None))
+    # enddef
+# endclass
+
+
+class QueryResults(SearchResults):
+    """
+    Search results backed by an ordered Course (or CourseSearchRow) queryset.
+
+    The total comes from a COUNT(*) that stops at the count cap, and each page
+    is a LIMIT/OFFSET query, so memory depends on the page size rather than
+    on how many courses matched.
+    """
+
+    def __init__(self, queryset: QuerySet, fields: Sequence[str] = RESULT_FIELDS):
+        self.queryset = queryset
+        # columns for format_row, under the queryset model's names
+        self.fields = fields
+        self._count = None
+    # enddef
+
+    def count(self) -> int:
+        if self._count is None:
+            cap = getattr(settings, "COURSEFINDER_RESULT_COUNT_CAP", None)
+            if cap:
+                # count one past the cap so we know if there are more
+                count = self.queryset[:cap + 1].count()
+                if count > cap:
+                    count = cap
+                    self.is_capped = True
+                # endif
+            else:
+                count = self.queryset.count()
+            # endif
+            self._count = count
+        # endif
+        return self._count
+    # enddef
+
+    def get_rows(self, start: int, stop: Optional[int]) -> List[UniMatchResult]:
+        rows = self.queryset[start:stop].values_list(*self.fields)
+        return [format_row(row) for row in rows]
+    # enddef
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[List[UniMatchResult]]:
+        # one query read through a server-side cursor on Postgres, rather than a LIMIT/OFFSET query per chunk
+        rows = self.queryset.values_list(*self.fields).iterator(chunk_size=chunk_size)
+        chunk = []
+        for row in rows:
+            chunk.append(format_row(row))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+            # endif
+        # endfor
+        if chunk:
+            yield chunk
+        # endif
+    # enddef
+# endclass
+
+
+class CourseIdResults(SearchResults):
+    """
+    Ordered search results held as course ids (from the in-memory index).
+    """
+
+    def __init__(self, course_ids: Sequence[int]):
+        self.course_ids = course_ids
+    # enddef
+
+    def count(self) -> int:
+        return len(self.course_ids)
+    # enddef
+
+    def get_rows(self, start: int, stop: Optional[int]) -> List[UniMatchResult]:
+        return self.hydrate(self.course_ids[start:stop])
+    # enddef
+
+    @staticmethod
+    def hydrate(course_ids: Sequence[int]) -> List[UniMatchResult]:
+        """
+        Loads the given courses in one query and formats them in the same order.
+
+        :param course_ids: Course ids to load
+        :return: List of UniMatchResult objects
+        """
+        rows = Course.objects.filter(pk__in=list(course_ids)).values_list(*RESULT_FIELDS)
+        rows_by_id = {row[0]: row for row in rows}
+
+        results = []
+        for course_id in course_ids:
+            row = rows_by_id.get(course_id)
+            # skip courses deleted since the index was built
+            if row is not None:
+                results.append(format_row(row))
+            # endif
+        # endfor
+
+        return results
+    # enddef
+# endclass
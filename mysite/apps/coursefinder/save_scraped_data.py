@@ -1,34 +1,48 @@
+from .catalog import catalog_update
 from .models import University, Course, EntryRequirement
+from .search_index import get_search_engine, rebuild_search_index
+from .search_view import refresh_search_view
 
 
 def saved_Data(scraped_unis):
-    for uni_data in scraped_unis:
-        uni = University.objects.create(
-            name=uni_data.name,
-            location=uni_data.location,
-            website=uni_data.link,
-            all_courses_url=uni_data.link_all_courses
-        )
-
-        for course_data in uni_data.courses:
-            course = Course.objects.create(
-                university=uni,
-                name=course_data.name,
-                course_type=course_data.course_type,
-                duration=course_data.duration,
-                mode=course_data.mode,
-                location=course_data.location,
-                start_date=course_data.start_date,
-                link=course_data.link
+    # bump the catalog version once at the end rather than for every row
+    with catalog_update():
+        for uni_data in scraped_unis:
+            uni = University.objects.create(
+                name=uni_data.name,
+                location=uni_data.location,
+                website=uni_data.link,
+                all_courses_url=uni_data.link_all_courses
             )
 
-            for req_data in course_data.requirements:
-                EntryRequirement.objects.create(
-                    course=course,
-                    min_ucas_points=req_data.min_ucas_points,
-
+            for course_data in uni_data.courses:
+                course = Course.objects.create(
+                    university=uni,
+                    name=course_data.name,
+                    course_type=course_data.course_type,
+                    duration=course_data.duration,
+                    mode=course_data.mode,
+                    location=course_data.location,
+                    start_date=course_data.start_date,
+                    link=course_data.link
                 )
+
+                for req_data in course_data.requirements:
+                    EntryRequirement.objects.create(
+                        course=course,
+                        min_ucas_points=req_data.min_ucas_points,
+
+                    )
+                # endfor
             # endfor
         # endfor
-    # endfor
+    # endwith
+
+    # load the new catalog into the in-memory index straight away
+    if get_search_engine() == "memory":
+        rebuild_search_index()
+    # endif
+
+    # and into the flattened search view
+    refresh_search_view()
 # enddef
@@ -0,0 +1,199 @@
+"""
+Result cache for course and university searches
+
+Keys are built from the normalized query (or for course matches, the
+parsed grades and interests), the filters, the search engine and the
+catalog version, so an import or edit makes every older entry unreachable. Entries live in the
+"search" cache (a size-limited LRU with a timeout, see CACHES in settings),
+empty results are cached for a shorter time, and only one caller at a time
+computes a missing entry.
+"""
+import hashlib
+import json
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .catalog import get_catalog_version
+from .results import SearchResults
+from .search_index import get_search_engine
+from .types import UniMatchResult
+
+# filters that don't change the results and shouldn't be part of the key
+# (region_mapping was the whole region table, which callers used to pass along)
+IGNORED_FILTERS = {'region_mapping'}
+
+# used so a cached None can be told apart from a miss
+MISSING = object()
+
+
+def get_search_cache():
+    """
+    Gets the cache backend used for search results.
+
+    :return: Django cache object
+    """
+    return caches[getattr(settings, "COURSEFINDER_SEARCH_CACHE", "search")]
+
+
+# enddef
+
+
+def normalize_query(query: str) -> str:
+    """
+    Lowercases the query and collapses repeated whitespace.
+
+    :param query: Search query from the user
+    :return: Normalized query
+    """
+    return " ".join(query.lower().split())
+
+
+# enddef
+
+
+def build_cache_key(kind: str, query: str, filters: Dict, *extra) -> str:
+    """
+    Builds the cache key for a search.
+
+    :param kind: Which search this is ("courses" or "universities")
+    :param query: Search query from the user
+    :param filters: Dictionary containing filter options
+    :param extra: Any other arguments that change the results
+    :return: Cache key including the search engine and catalog version
+    """
+    canonical_filters = {}
+    for name, value in (filters or {}).items():
+        # empty and ignored filters don't change the results
+        if name in IGNORED_FILTERS or not value:
+            continue
+        # endif
+        canonical_filters[name] = value
+    # endfor
+
+    # only_grades wins when both boxes are ticked, so they give the same results
+    if canonical_filters.get('only_grades'):
+        canonical_filters.pop('no_requirements', None)
+    # endif
+
+    # the engines rank differently, so switching engine mustn't give the other one's results
+    extra = list(extra) + [get_search_engine()]
+
+    payload = json.dumps([normalize_query(query), canonical_filters, extra], sort_keys=True, default=str)
+    digest = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    return f"search:{kind}:v{get_catalog_version()}:{digest}"
+
+
+# enddef
+
+
+def get_or_compute(key: str, compute: Callable[[], Any], is_empty: Callable[[Any], bool] = None) -> Any:
+    """
+    Gets a value from the search cache, computing and storing it on a miss.
+
+    Only one caller computes a missing value: the others wait for it to
+    appear (up to COURSEFINDER_SEARCH_CACHE_LOCK_TIMEOUT seconds) instead of
+    all running the same search at once.
+
+    :param key: Cache key
+    :param compute: Function that works out the value
+    :param is_empty: Optional function that says if a value is an empty result (cached for less time)
+    :return: Cached or freshly computed value
+    """
+    cache = get_search_cache()
+
+    value = cache.get(key, MISSING)
+    if value is not MISSING:
+        return value
+    # endif
+
+    lock_key = f"{key}:lock"
+    lock_timeout = getattr(settings, "COURSEFINDER_SEARCH_CACHE_LOCK_TIMEOUT", 10)
+
+    # add() only succeeds for one caller, so that caller does the work
+    got_lock = cache.add(lock_key, True, timeout=lock_timeout)
+    if not got_lock:
+        deadline = time.monotonic() + lock_timeout
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            value = cache.get(key, MISSING)
+            if value is not MISSING:
+                return value
+            # endif
+        # endwhile
+        # whoever had the lock took too long, so just work it out ourselves
+    # endif
+
+    try:
+        value = compute()
+
+        if is_empty is not None and is_empty(value):
+            timeout = getattr(settings, "COURSEFINDER_SEARCH_CACHE_EMPTY_TIMEOUT", 60)
+        else:
+            timeout = getattr(settings, "COURSEFINDER_SEARCH_CACHE_TIMEOUT", 300)
+        # endif
+        cache.set(key, value, timeout=timeout)
+    finally:
+        if got_lock:
+            cache.delete(lock_key)
+        # endif
+    # endtry
+
+    return value
+
+
+# enddef
+
+
+class CachedResults(SearchResults):
+    """
+    Search results where the count and each page are cached separately.
+
+    The real search is only run (through the factory) if something isn't
+    cached, so a repeated search doesn't touch the course tables at all.
+    """
+
+    def __init__(self, key: str, factory: Callable[[], SearchResults]):
+        self.key = key
+        self.factory = factory
+        self._results = None
+        self._count = None
+    # enddef
+
+    def get_results(self) -> SearchResults:
+        if self._results is None:
+            self._results = self.factory()
+        # endif
+        return self._results
+    # enddef
+
+    def count(self) -> int:
+        if self._count is None:
+            def compute():
+                results = self.get_results()
+                return results.count(), results.is_capped
+            # enddef
+
+            self._count, self.is_capped = get_or_compute(
+                f"{self.key}:count", compute, is_empty=lambda value: value[0] == 0
+            )
+        # endif
+        return self._count
+    # enddef
+
+    def get_rows(self, start: int, stop: Optional[int]) -> List[UniMatchResult]:
+        return get_or_compute(
+            f"{self.key}:rows:{start}:{stop}",
+            lambda: self.get_results()[start:stop],
+            is_empty=lambda rows: not rows
+        )
+    # enddef
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[List[UniMatchResult]]:
+        # exports read straight from the search, they'd only push pages people are looking at out of the cache
+        return self.get_results().iter_chunks(chunk_size)
+    # enddef
+# endclass
@@ -0,0 +1,453 @@
+"""
+In-memory inverted index with BM25 ranking for course search
+
+The catalog only changes when we import new data, so instead of asking the
+database for every search we can keep a tokenized copy of it in memory and
+answer term lookups from there. Only the courses on the page being shown get
+loaded from the database (see results.CourseIdResults).
+"""
+import math
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from typing import AbstractSet, Callable, Dict, List, Optional
+
+from django.conf import settings
+
+from .catalog import get_catalog_version
+from .models import Course
+from .normalize import duration_filter_range, parse_study_mode, qualification_filter_codes
+from .regions import LOCATION_REGIONS
+
+# BM25 tuning values (the usual defaults)
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# requirement state stored for each course
+REQ_NONE = -1  # no EntryRequirement row
+REQ_NOT_NEEDED = 0  # has_requirements is False
+REQ_NO_GRADES = 1  # has requirements but no display grades
+REQ_GRADES = 2  # has requirements and display grades
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_search_engine() -> str:
+    """
+    Gets which search engine is switched on in settings.
+
+    :return: "memory" for the in-memory index or "database" for the ORM
+    """
+    return getattr(settings, "COURSEFINDER_SEARCH_ENGINE", "database")
+
+
+# enddef
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits text into lowercase words.
+
+    Apostrophes are dropped first so "King's" and "kings" end up the same.
+
+    :param text: Text to split
+    :return: List of words
+    """
+    if not text:
+        return []
+    # endif
+
+    text = text.lower().replace("'", "").replace("’", "")
+    return re.findall(r"\w+", text)
+
+
+# enddef
+
+
+class CourseSearchIndex:
+    """
+    Inverted index over course name, course type, university name and location.
+
+    Courses are stored as document numbers in the default display order
+    (university name then course name), and each term maps to compact arrays
+    of the document numbers it appears in and how often.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.course_ids = array("q")
+        self.university_ids = array("q")
+        self.doc_lengths = array("I")
+
+        # normalized columns used by the filters
+        self.qualifications = []
+        self.duration_years = array("h")  # -1 when unknown
+        self.study_modes = array("B")
+        self.regions = []
+
+        # requirement info used by the points and requirement filters
+        self.min_points = array("i")
+        self.requirement_states = array("b")
+
+        # term -> (document numbers, term frequencies)
+        self.postings: Dict[str, tuple] = {}
+        self.vocabulary: List[str] = []
+        self.length_norms = array("d")
+    # enddef
+
+    @classmethod
+    def build(cls, version: int = None) -> "CourseSearchIndex":
+        """
+        Builds the index from the catalog in the database.
+
+        :param version: Catalog version read before building, used to spot when it goes stale
+        :return: New CourseSearchIndex
+        """
+        index = cls()
+        index.version = version
+
+        rows = Course.objects.order_by("university__name", "name").values_list(
+            "id",
+            "university_id",
+            "name",
+            "course_type",
+            "university__name",
+            "university__location",
+            "duration_years",
+            "study_mode",
+            "qualification",
+            "region",
+            "entryrequirement__min_ucas_points",
+            "entryrequirement__has_requirements",
+            "entryrequirement__display_grades",
+        )
+
+        for row in rows.iterator(chunk_size=2000):
+            index.add_course(*row)
+        # endfor
+
+        index.finish()
+        return index
+    # enddef
+
+    def add_course(self, course_id, university_id, name, course_type, university_name, university_location,
+                   duration_years, study_mode, qualification, region, min_points, has_requirements,
+                   display_grades):
+        """
+        Adds one course to the index. Courses must be added in display order.
+        """
+        doc = len(self.course_ids)
+
+        words = (tokenize(name) + tokenize(course_type)
+                 + tokenize(university_name) + tokenize(university_location))
+        for term, frequency in Counter(words).items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = (array("I"), array("H"))
+                self.postings[term] = postings
+            # endif
+            postings[0].append(doc)
+            postings[1].append(min(frequency, 65535))
+        # endfor
+
+        self.course_ids.append(course_id)
+        self.university_ids.append(university_id)
+        self.doc_lengths.append(len(words))
+
+        self.qualifications.append(qualification or "")
+        self.duration_years.append(duration_years if duration_years is not None else -1)
+        self.study_modes.append(study_mode or 0)
+        self.regions.append(region or "")
+
+        if has_requirements is None:
+            self.min_points.append(-1)
+            self.requirement_states.append(REQ_NONE)
+        else:
+            self.min_points.append(min_points or 0)
+            if not has_requirements:
+                self.requirement_states.append(REQ_NOT_NEEDED)
+            elif display_grades and display_grades.strip():
+                self.requirement_states.append(REQ_GRADES)
+            else:
+                self.requirement_states.append(REQ_NO_GRADES)
+            # endif
+        # endif
+    # enddef
+
+    def finish(self):
+        """
+        Works out the values BM25 needs once all courses are added.
+        """
+        self.vocabulary = sorted(self.postings)
+
+        # the document length part of BM25 only depends on the document, so do it once here
+        if self.doc_lengths:
+            average_length = sum(self.doc_lengths) / len(self.doc_lengths)
+            self.length_norms = array("d", (
+                BM25_K1 * (1 - BM25_B + BM25_B * length / average_length) for length in self.doc_lengths
+            ))
+        # endif
+    # enddef
+
+    def expand_word(self, word: str) -> List[str]:
+        """
+        Finds every indexed term starting with the word, so partly typed words still match.
+
+        :param word: Lowercase word from the query
+        :return: List of matching terms
+        """
+        terms = []
+        position = bisect_left(self.vocabulary, word)
+        while position < len(self.vocabulary) and self.vocabulary[position].startswith(word):
+            terms.append(self.vocabulary[position])
+            position += 1
+        # endwhile
+        return terms
+    # enddef
+
+    def score_terms(self, terms: List[str]) -> Dict[int, float]:
+        """
+        Finds the documents matching any of the terms and gives each a BM25 score.
+
+        Every word of a term has to appear in a document (like the full-text
+        search), and the terms themselves are OR'd together.
+
+        :param terms: List of search terms (already expanded with synonyms)
+        :return: Dictionary mapping document number to score
+        """
+        total_docs = len(self.course_ids)
+        scores: Dict[int, float] = {}
+
+        for term in terms:
+            words = tokenize(term)
+            if not words:
+                continue
+            # endif
+
+            term_scores: Optional[Dict[int, float]] = None
+            for word in words:
+                word_scores: Dict[int, float] = {}
+                for indexed_term in self.expand_word(word):
+                    docs, frequencies = self.postings[indexed_term]
+                    idf = math.log(1 + (total_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for doc, frequency in zip(docs, frequencies):
+                        score = idf * frequency * (BM25_K1 + 1) / (frequency + self.length_norms[doc])
+                        word_scores[doc] = word_scores.get(doc, 0.0) + score
+                    # endfor
+                # endfor
+
+                # keep only the documents that have every word so far
+                if term_scores is None:
+                    term_scores = word_scores
+                else:
+                    term_scores = {
+                        doc: score + word_scores[doc]
+                        for doc, score in term_scores.items()
+                        if doc in word_scores
+                    }
+                # endif
+
+                if not term_scores:
+                    break
+                # endif
+            # endfor
+
+            for doc, score in (term_scores or {}).items():
+                scores[doc] = scores.get(doc, 0.0) + score
+            # endfor
+        # endfor
+
+        return scores
+    # enddef
+
+    def build_filter(self, filters: Dict) -> Optional[Callable[[int], bool]]:
+        """
+        Turns the filter options into a check for a single document.
+
+        Mirrors the filters used by the database search.
+
+        :param filters: Dictionary containing filter options
+        :return: Function that takes a document number, or None if no filters are set
+        """
+        checks = []
+
+        if filters.get('course_type'):
+            codes = set(qualification_filter_codes(filters['course_type']))
+            if codes:
+                checks.append(lambda doc: self.qualifications[doc] in codes)
+            # endif
+        # endif
+
+        if filters.get('duration'):
+            years = duration_filter_range(filters['duration'])
+            if years:
+                min_years, max_years = years
+                if max_years is None:
+                    checks.append(lambda doc: self.duration_years[doc] >= min_years)
+                else:
+                    checks.append(lambda doc: self.duration_years[doc] == min_years)
+                # endif
+            # endif
+        # endif
+
+        if filters.get('mode'):
+            mode_flag = parse_study_mode(filters['mode'])
+            if mode_flag:
+                checks.append(lambda doc: self.study_modes[doc] & mode_flag == mode_flag)
+            # endif
+        # endif
+
+        if filters.get('location') in LOCATION_REGIONS:
+            selected_region = filters['location']
+            checks.append(lambda doc: self.regions[doc] == selected_region)
+        # endif
+
+        if filters.get('ucas_range'):
+            try:
+                max_points = int(filters['ucas_range'])
+            except ValueError:
+                max_points = 0
+            # endtry
+            if max_points > 0:
+                checks.append(lambda doc: self.requirement_states[doc] != REQ_NONE
+                                          and self.min_points[doc] <= max_points)
+            # endif
+        # endif
+
+        if filters.get('only_grades'):
+            checks.append(lambda doc: self.requirement_states[doc] == REQ_GRADES)
+        elif filters.get('no_requirements'):
+            checks.append(lambda doc: self.requirement_states[doc] == REQ_NOT_NEEDED)
+        # endif
+
+        if not checks:
+            return None
+        # endif
+
+        return lambda doc: all(check(doc) for check in checks)
+    # enddef
+
+    def search(self, terms: Optional[List[str]], filters: Dict, max_points: Optional[int] = None,
+               university_ids: Optional[List[int]] = None, per_university: Optional[int] = None,
+               limit: Optional[int] = None, excluded_course_ids: Optional[AbstractSet[int]] = None) -> List[int]:
+        """
+        Runs a search against the index.
+
+        :param terms: Search terms, or None to match every course (in display order)
+        :param filters: Dictionary containing filter options
+        :param max_points: Optional UCAS points, keeps courses needing no more than this (or with no requirements)
+        :param university_ids: Optional list of university ids to restrict to
+        :param per_university: Optional most courses to keep at each university (the best ones)
+        :param limit: Optional maximum number of results
+        :param excluded_course_ids: Optional set of course ids to leave out (e.g. missing grade requirements)
+        :return: List of course ids, best match first
+        """
+        if terms is None:
+            docs = range(len(self.course_ids))
+        else:
+            scores = self.score_terms(terms)
+            # ties stay in display order because document numbers follow it
+            docs = sorted(scores, key=lambda doc: (-scores[doc], doc))
+        # endif
+
+        matches_filters = self.build_filter(filters)
+        allowed_universities = set(university_ids) if university_ids is not None else None
+        university_counts = Counter()
+
+        course_ids = []
+        for doc in docs:
+            if max_points is not None:
+                if self.requirement_states[doc] != REQ_NONE and self.min_points[doc] > max_points:
+                    continue
+                # endif
+            # endif
+
+            university_id = self.university_ids[doc]
+            if allowed_universities is not None and university_id not in allowed_universities:
+                continue
+            # endif
+
+            if matches_filters is not None and not matches_filters(doc):
+                continue
+            # endif
+
+            if excluded_course_ids and self.course_ids[doc] in excluded_course_ids:
+                continue
+            # endif
+
+            if per_university is not None:
+                if university_counts[university_id] >= per_university:
+                    continue
+                # endif
+                university_counts[university_id] += 1
+            # endif
+
+            course_ids.append(self.course_ids[doc])
+            if limit is not None and len(course_ids) >= limit:
+                break
+            # endif
+        # endfor
+
+        return course_ids
+    # enddef
+# endclass
+
+
+def get_search_index() -> CourseSearchIndex:
+    """
+    Gets the shared index, building it the first time it's needed and
+    rebuilding it when the catalog version changes (e.g. after an import).
+
+    :return: CourseSearchIndex for the current catalog
+    """
+    global _index
+
+    version = get_catalog_version()
+    index = _index
+    if index is None or index.version != version:
+        with _index_lock:
+            # another thread might have built it while we waited
+            if _index is None or _index.version != version:
+                _index = CourseSearchIndex.build(version)
+            # endif
+            index = _index
+        # endwith
+    # endif
+
+    return index
+
+
+# enddef
+
+
+def rebuild_search_index() -> CourseSearchIndex:
+    """
+    Builds a fresh index and swaps it in (searches keep using the old one meanwhile).
+
+    :return: The new CourseSearchIndex
+    """
+    global _index
+
+    index = CourseSearchIndex.build(get_catalog_version())
+    with _index_lock:
+        _index = index
+    # endwith
+    return index
+
+
+# enddef
+
+
+def invalidate_search_index() -> None:
+    """
+    Throws away the index so the next search rebuilds it.
+    """
+    global _index
+
+    with _index_lock:
+        _index = None
+    # endwith
+# enddef
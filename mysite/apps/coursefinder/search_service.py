@@ -1,14 +1,20 @@
 """
 Search service that uses NLP parser to find matching courses
 """
-from typing import List, Dict, Any
-
-from django.db.models import Q
-
-from mysite.apps.nlp.course_interests import parse_interests
-from mysite.apps.nlp.grade_parser import GradeParser
-from .models import Course
-from .types import UniMatchResult
+from typing import List, Dict, Any, Optional
+
+from django.contrib.postgres.fields import ArrayField
+from django.db.models import BigIntegerField, F, Lookup, Q, Value
+
+from .full_text_search import full_text_filter, is_postgres
+from .models import Course, CourseSearchRow
+from .normalize import duration_filter_range, parse_study_mode, qualification_filter_codes, study_modes_with
+from .query_parsing import parse_query
+from .regions import LOCATION_REGIONS
+from .results import CourseIdResults, QueryResults, SearchResults
+from .search_cache import CachedResults, build_cache_key
+from .search_index import get_search_engine, get_search_index
+from .search_view import SEARCH_ROW_FIELDS, filter_search_rows, search_view_is_current
 from .university_search import expand_query_with_synonyms
 
 
@@ -21,45 +27,35 @@ def search_courses(query: str, filters: Dict) -> Dict[str, Any]:
     :return: Dictionary containing query, parsed_grades, interests, ucas_points, and matching_courses list
     """
 
-    # initialize parser
-    parser = GradeParser()
-
-    # get both grades and interests from the input
-    parsed = parser.parse(query)
+    # parsing is memoized, so a repeated query (or "Load more") skips the NLP parsers
+    parsed = parse_query(query)
 
-    # double check for course interests using the other parser too
-    interests_result = parse_interests(query)
-
-    # put all the interests together from both parsers
-    all_interests = parsed.get("interests", [])
-    if interests_result and "interests" in interests_result:
-        for interest in interests_result["interests"]:
-            if interest not in all_interests:
-                all_interests.append(interest)
-
-    # make the response dictionary with what we found
+    # the parsed values are shared with the cache, so hand out our own copies
     result = {
         "query": query,
-        "parsed_grades": parsed.get("grades", {}),
-        "interests": all_interests,
+        "parsed_grades": dict(parsed.grades),
+        "interests": list(parsed.interests),
         "dropped": [],  # Could extract this from parsed data if needed
         "matching_courses": []
     }
 
-    # calculate UCAS points from grades
-    ucas_points = 0
+    ucas_points = parsed.ucas_points
     if result["parsed_grades"]:
-        ucas_points = calculate_ucas_points(result["parsed_grades"])
         result["ucas_points"] = ucas_points
     # endif
 
     # find matching courses
     # Pass filters dictionary to the next function
-    courses = find_matching_courses(
+    # repeated searches come from the cache, so the search only runs for what isn't cached
+    # keyed on what the parsers understood rather than the text: the grade parser is case-sensitive,
+    # so "AAB" and "aab" can parse differently but would share a key once the query is lowercased
+    cache_key = build_cache_key("courses", "", filters, dict(parsed.grades), list(parsed.interests), ucas_points)
+    courses = CachedResults(cache_key, lambda: find_matching_courses(
         ucas_points=ucas_points,
-        interests=result["interests"],
-        filters=filters
-    )
+        interests=list(parsed.interests),
+        filters=filters,
+        grades=dict(parsed.grades)
+    ))
 
     result["matching_courses"] = courses
 
@@ -69,90 +65,203 @@ def search_courses(query: str, filters: Dict) -> Dict[str, Any]:
 # enddef
 
 
-def calculate_ucas_points(grades: Dict[str, str]) -> int:
+class AnyOf(Lookup):
+    """
+    "column = ANY(array)", so a list of ids is sent as one array parameter
+    rather than one parameter per id like __in.
     """
-    Calculates total UCAS points from grades dictionary.
+    lookup_name = "any_of"
+    prepare_rhs = False
 
-    :param grades: Dictionary mapping subject names to grade strings (e.g., {"mathematics": "A", "physics": "B"})
-    :return: Total UCAS points as integer
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} = ANY({rhs})", (*lhs_params, *rhs_params)
+    # enddef
+# endclass
+
+
+def exclude_courses(queryset, course_ids: List[int]):
     """
-    # UCAS points for each grade
-    grade_points = {
-        'A*': 56,
-        'A': 48,
-        'B': 40,
-        'C': 32,
-        'D': 24,
-        'E': 16,
-        'U': 0,
-        'D*': 56,
-        'M': 32,
-        'P': 16
-    }
+    Leaves the given courses out of a Course (or CourseSearchRow) queryset.
 
-    total = 0
-    for subject, grade in grades.items():
-        grade = grade.upper()
-        if grade in grade_points:
-            total += grade_points[grade]
-        # endif
+    There can be tens of thousands of ids, so on Postgres they go in as a
+    single array parameter instead of hitting the driver's parameter limit.
+
+    :param queryset: Queryset to filter
+    :param course_ids: Ids of the courses to leave out
+    :return: Filtered queryset
+    """
+    if not course_ids:
+        return queryset
+    # endif
+
+    if is_postgres():
+        return queryset.exclude(AnyOf(F('pk'), Value(course_ids, output_field=ArrayField(BigIntegerField()))))
+    # endif
+    return queryset.exclude(pk__in=course_ids)
+
+
+# enddef
+
+
+def expand_interests(interests: List[str]) -> List[str]:
+    """
+    Expands every interest with its synonyms, without duplicates.
+
+    :param interests: List of course/subject names the user is interested in
+    :return: List of search terms
+    """
+    # use the synonym function to expand search terms
+    # this means if someone searches "math" it also finds "mathematics"
+    search_terms = []
+    for interest in interests:
+        for term in expand_query_with_synonyms(interest):
+            if term not in search_terms:
+                search_terms.append(term)
+            # endif
+        # endfor
     # endfor
 
-    return total
+    return search_terms
 
 
 # enddef
 
 
-def find_matching_courses(ucas_points: int, interests: List[str], filters: Dict) -> List:
+def filter_by_interests(courses, interests: List[str]):
+    """
+    Narrows a course queryset down to courses matching any of the interests.
+
+    Uses the full-text search document on Postgres and falls back to
+    icontains on the course name for other databases.
+
+    :param courses: Course queryset to filter
+    :param interests: List of course/subject names the user is interested in
+    :return: Filtered queryset (annotated with "rank" on Postgres)
+    """
+    search_terms = expand_interests(interests)
+
+    if is_postgres():
+        return full_text_filter(courses, search_terms)
+    # endif
+
+    interest_query = Q()
+    for term in search_terms:
+        interest_query |= Q(name__icontains=term)
+    # endfor
+    return courses.filter(interest_query)
+
+
+# enddef
+
+
+def find_matching_rows(ucas_points: int, interests: List[str], filters: Dict,
+                       failed_grades: List[int]) -> SearchResults:
+    """
+    Same search as find_matching_courses, against the flattened course search view.
+
+    :param ucas_points: Total UCAS points calculated from grades
+    :param interests: List of course/subject names the user is interested in
+    :param filters: Dictionary containing filter options (course_type, duration, mode, location, etc.)
+    :param failed_grades: Ids of courses to leave out as the student doesn't have the grades
+    :return: Lazily loaded SearchResults of UniMatchResult objects
+    """
+    # nothing to search for
+    if ucas_points <= 0 and not interests:
+        return CourseIdResults([])
+    # endif
+
+    rows = CourseSearchRow.objects.all()
+    if interests:
+        rows = full_text_filter(rows, expand_interests(interests))
+    # endif
+
+    if ucas_points > 0:
+        # courses without an EntryRequirement have null points and are open to everyone
+        rows = rows.filter(Q(min_ucas_points__lte=ucas_points) | Q(min_ucas_points__isnull=True))
+        rows = exclude_courses(rows, failed_grades)
+    # endif
+
+    rows = filter_search_rows(rows, filters)
+
+    if interests:
+        # full-text matches come back ranked, so show the best ones first
+        rows = rows.order_by("-rank", "sort_key")
+    else:
+        rows = rows.order_by("sort_key")
+    # endif
+
+    return QueryResults(rows, SEARCH_ROW_FIELDS)
+
+
+# enddef
+
+
+def find_matching_courses(ucas_points: int, interests: List[str], filters: Dict,
+                          grades: Optional[Dict[str, str]] = None) -> SearchResults:
     """
     Finds courses that match the given criteria by comparing grades and interests with database entries.
 
     :param ucas_points: Total UCAS points calculated from grades
     :param interests: List of course/subject names the user is interested in
     :param filters: Dictionary containing filter options (course_type, duration, mode, location, etc.)
-    :return: List of UniMatchResult objects containing matching courses
+    :param grades: Optional dictionary mapping subjects to grades, to check minimum grade and subject requirements
+    :return: Lazily loaded SearchResults of UniMatchResult objects (only the page sliced out gets formatted)
     """
-    results = []
+    # courses they have the points for but not the grades (e.g. no A in Maths), checked in one pass over the catalog
+    failed_grades = []
+    if grades and ucas_points > 0:
+        # imported here so NumPy only loads once a search with grades needs it
+        from .eligibility import get_eligibility_engine
+
+        failed_grades = get_eligibility_engine().failed_grade_course_ids(grades, ucas_points)
+    # endif
+
+    if get_search_engine() == "memory":
+        # nothing to search for
+        if ucas_points <= 0 and not interests:
+            return CourseIdResults([])
+        # endif
+
+        # answer from the in-memory index and only load the page that gets shown
+        course_ids = get_search_index().search(
+            expand_interests(interests) if interests else None,
+            filters,
+            max_points=ucas_points if ucas_points > 0 else None,
+            excluded_course_ids=set(failed_grades)
+        )
+        return CourseIdResults(course_ids)
+    # endif
+
+    # on Postgres the flattened search view answers without any joins (see search_view.py)
+    if search_view_is_current():
+        return find_matching_rows(ucas_points, interests, filters, failed_grades)
+    # endif
 
     # need to find courses the student can actually get into with their grades
     if ucas_points > 0:
         # grab all the courses from database
-        all_courses = Course.objects.select_related('university', 'entryrequirement')
+        all_courses = Course.objects.select_related('university')
 
 
         # if they mentioned interests, look for those courses first
         if interests:
-            interest_query = Q()
-            for interest in interests:
-                # use the synonym function to expand search terms
-                # this means if someone searches "math" it also finds "mathematics"
-                expanded_terms = expand_query_with_synonyms(interest)
-                for term in expanded_terms:
-                    interest_query |= Q(name__icontains=term)
-                # endfor
-            # endfor
-            all_courses = all_courses.filter(interest_query)
+            all_courses = filter_by_interests(all_courses, interests)
         # endif
 
         # get courses where they have enough points or no requirements
         qualifying_courses = all_courses.filter(
             Q(entryrequirement__min_ucas_points__lte=ucas_points) | Q(entryrequirement__isnull=True)
         )
+        qualifying_courses = exclude_courses(qualifying_courses, failed_grades)
 
     elif interests:
         # they didn't give grades but mentioned interests
-        interest_query = Q()
-        for interest in interests:
-            # use the synonym function to expand search terms
-            # this means if someone searches "math" it also finds "mathematics"
-            expanded_terms = expand_query_with_synonyms(interest)
-            for term in expanded_terms:
-                interest_query |= Q(name__icontains=term)
-            # endfor
-        # endfor
-        qualifying_courses = Course.objects.select_related('university', 'entryrequirement').filter(
-            interest_query)
+        qualifying_courses = filter_by_interests(
+            Course.objects.select_related('university'),
+            interests
+        )
     else:
         # nothing to search for
         qualifying_courses = Course.objects.none()
@@ -172,44 +281,37 @@ def find_matching_courses(ucas_points: int, interests: List[str], filters: Dict)
         # endtry
     # endif
 
-    # filter by course type if they selected one
+    # filter by course type, duration and mode using the normalized (indexed) columns
     if filters.get('course_type'):
-        selected_type = filters['course_type']
-        # matches "BA (Hons)" in both short and long forms
-        qualifying_courses = qualifying_courses.filter(course_type__icontains=selected_type)
+        codes = qualification_filter_codes(filters['course_type'])
+        if codes:
+            qualifying_courses = qualifying_courses.filter(qualification__in=codes)
+        # endif
     # endif
 
     if filters.get('duration'):
-        selected_duration = filters['duration']
-        if "5+" in selected_duration:
-            # match courses with 5, 6, or 7 years
-            qualifying_courses = qualifying_courses.filter(
-                Q(duration__icontains="5 year") | Q(duration__icontains="6 year") | Q(duration__icontains="7 year")
-            )
-        else:
-            # extract the number and match with the word "year" to avoid matching months
-            years = selected_duration.split(' ')[0]
-            qualifying_courses = qualifying_courses.filter(duration__icontains=years + " year")
+        years = duration_filter_range(filters['duration'])
+        if years:
+            min_years, max_years = years
+            if max_years is None:
+                # "5+" means 5 or more years
+                qualifying_courses = qualifying_courses.filter(duration_years__gte=min_years)
+            else:
+                qualifying_courses = qualifying_courses.filter(duration_years=min_years)
+            # endif
         # endif
     # endif
 
     if filters.get('mode'):
-        qualifying_courses = qualifying_courses.filter(mode__icontains=filters['mode'])
+        mode_flag = parse_study_mode(filters['mode'])
+        if mode_flag:
+            qualifying_courses = qualifying_courses.filter(study_mode__in=study_modes_with(mode_flag))
+        # endif
     # endif
 
-    if filters.get('location'):
-        selected_region = filters['location']
-        region_map = filters.get('region_mapping', {})
-
-        cities_in_region = region_map.get(selected_region, [])
-
-        if cities_in_region:
-            location_query = Q()
-            for city in cities_in_region:
-                location_query |= Q(location__icontains=city) | Q(university__location__icontains=city)
-            # endfor
-            qualifying_courses = qualifying_courses.filter(location_query)
-        # endif
+    # each course stores its region (see regions.py), so this is one indexed equality
+    if filters.get('location') in LOCATION_REGIONS:
+        qualifying_courses = qualifying_courses.filter(region=filters['location'])
     # endif
 
     # if user wants to see only courses with grade requirements
@@ -235,46 +337,13 @@ def find_matching_courses(ucas_points: int, interests: List[str], filters: Dict)
         ).distinct()
     # endif
 
-    qualifying_courses = qualifying_courses.order_by("university__name", "name")
-    courses_to_show = list(qualifying_courses)
-
-    # format the courses as UniMatchResult objects for the template
-    for course in courses_to_show:
-        try:
-            req = course.entryrequirement
-            # decide what to show for requirements
-            if req.has_requirements:
-                # course has requirements so show them
-                if req.display_grades and req.display_grades.strip():
-                    requirements_str = req.display_grades
-                elif req.min_ucas_points > 0:
-                    requirements_str = f"{req.min_ucas_points} UCAS points"
-                else:
-                    requirements_str = "No specific requirements"
-                # endif
-
-                # add btec grades if they exist
-                if req.btec_grades:
-                    requirements_str += f" / {req.btec_grades}"
-                # endif
-            else:
-                # no requirements for this course
-                requirements_str = "No specific requirements"
-            # endif
-        except:
-            requirements_str = "No specific requirements"
-        # endtry
-
-        match = UniMatchResult(
-            university=course.university.name,
-            course=course.name,
-            course_type=course.course_type,
-            duration=course.duration,
-            requirements=requirements_str,
-            course_link=course.link or "#"
-        )
-        results.append(match)
-    # endfor
+    if interests and is_postgres():
+        # full-text matches come back ranked, so show the best ones first
+        qualifying_courses = qualifying_courses.order_by("-rank", "university__name", "name")
+    else:
+        qualifying_courses = qualifying_courses.order_by("university__name", "name")
+    # endif
 
-    return results
+    # the view counts and slices out one page, so nothing is loaded here
+    return QueryResults(qualifying_courses)
 # enddef
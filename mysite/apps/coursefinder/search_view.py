@@ -0,0 +1,155 @@
+"""
+Flattened course search view (Postgres only)
+
+Every database search used to join Course, University and EntryRequirement,
+filter through the outer join to EntryRequirement and sort on columns from
+two tables. The coursefinder_coursesearchrow materialized view (migration
+0012) has one row per course with everything the searches filter on and
+show, plus sort_key (the position in the default display order), so a
+search is a scan of one table with indexes that already give pages in order.
+
+The view is refreshed CONCURRENTLY (searches keep reading the old rows
+meanwhile) at the end of every import, and the catalog version it was
+refreshed at is recorded. If the catalog changes some other way (e.g. an
+edit in the admin) searches go back to the tables until the next refresh
+(or the refresh_search_view command).
+"""
+from typing import Dict
+
+from django.db import connection
+
+from .catalog import CATALOG_VERSION_ID, get_catalog_version
+from .full_text_search import is_postgres
+from .models import CatalogVersion
+from .normalize import duration_filter_range, parse_study_mode, qualification_filter_codes, study_modes_with
+from .regions import LOCATION_REGIONS
+
+SEARCH_VIEW = "coursefinder_coursesearchrow"
+
+# CourseSearchRow columns needed for one results row, in the order results.format_row expects
+SEARCH_ROW_FIELDS = ("id", "university_name", "name", "course_type", "duration", "requirements_display", "link")
+
+
+def search_view_is_current() -> bool:
+    """
+    Checks if searches can use the view, i.e. it was refreshed after the last catalog change.
+
+    :return: True on Postgres when the view is up to date
+    """
+    if not is_postgres():
+        return False
+    # endif
+
+    versions = CatalogVersion.objects.filter(pk=CATALOG_VERSION_ID).values_list(
+        'version', 'search_view_version'
+    ).first()
+    if versions is None:
+        # nothing has changed since the view was created
+        return True
+    # endif
+    version, view_version = versions
+    return version == view_version
+
+
+# enddef
+
+
+def refresh_search_view() -> bool:
+    """
+    Refreshes the view from the tables without blocking searches and records
+    which catalog version it now holds.
+
+    Should run after the import has committed, so the refresh sees the new rows.
+
+    :return: True if the view was refreshed, False if the database isn't Postgres
+    """
+    if not is_postgres():
+        return False
+    # endif
+
+    # read before refreshing, so a change made during the refresh leaves the view marked as stale
+    version = get_catalog_version()
+    with connection.cursor() as cursor:
+        cursor.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {SEARCH_VIEW}")
+    # endwith
+
+    updated = CatalogVersion.objects.filter(pk=CATALOG_VERSION_ID).update(search_view_version=version)
+    if not updated:
+        CatalogVersion.objects.get_or_create(
+            pk=CATALOG_VERSION_ID, defaults={'version': version, 'search_view_version': version}
+        )
+    # endif
+    return True
+
+
+# enddef
+
+
+def filter_search_rows(rows, filters: Dict):
+    """
+    Applies the search filters to a CourseSearchRow queryset.
+
+    Same filters as the table searches, but every one is a plain column of the view.
+
+    :param rows: CourseSearchRow queryset
+    :param filters: Dictionary containing filter options (course_type, duration, mode, location, etc.)
+    :return: Filtered queryset
+    """
+    if filters.get('ucas_range'):
+        try:
+            min_points = int(filters['ucas_range'])
+            # only show courses that require no more than this many points
+            if min_points > 0:
+                rows = rows.filter(min_ucas_points__lte=min_points)
+            # endif
+        except ValueError:
+            pass
+        # endtry
+    # endif
+
+    if filters.get('course_type'):
+        codes = qualification_filter_codes(filters['course_type'])
+        if codes:
+            rows = rows.filter(qualification__in=codes)
+        # endif
+    # endif
+
+    if filters.get('duration'):
+        years = duration_filter_range(filters['duration'])
+        if years:
+            min_years, max_years = years
+            if max_years is None:
+                # "5+" means 5 or more years
+                rows = rows.filter(duration_years__gte=min_years)
+            else:
+                rows = rows.filter(duration_years=min_years)
+            # endif
+        # endif
+    # endif
+
+    if filters.get('mode'):
+        mode_flag = parse_study_mode(filters['mode'])
+        if mode_flag:
+            rows = rows.filter(study_mode__in=study_modes_with(mode_flag))
+        # endif
+    # endif
+
+    if filters.get('location') in LOCATION_REGIONS:
+        rows = rows.filter(region=filters['location'])
+    # endif
+
+    if filters.get('only_grades') and filters.get('no_requirements'):
+        filters['no_requirements'] = False
+    # endif
+
+    if filters.get('only_grades'):
+        # courses that have requirements with grades to show
+        rows = rows.filter(has_requirements=True, display_grades__isnull=False).exclude(display_grades='')
+    # endif
+
+    if filters.get('no_requirements'):
+        rows = rows.filter(has_requirements=False)
+    # endif
+
+    return rows
+# enddef
@@ -0,0 +1,144 @@
+"""
+Signal handlers that keep derived course data in sync with edits
+"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .catalog import is_importing, mark_catalog_changed
+from .full_text_search import update_search_documents
+from .models import Course, EntryRequirement, SubjectRequirement, University
+from .normalize import NO_REQUIREMENTS_TEXT, requirements_display
+from .regions import update_course_regions
+
+
+@receiver(post_save, sender=Course)
+def refresh_course_search_document(sender, instance, **kwargs):
+    """
+    Rebuilds the search document after a course is created or edited.
+
+    :param sender: Course model class
+    :param instance: Course that was saved
+    """
+    update_search_documents(Course.objects.filter(pk=instance.pk))
+
+
+# enddef
+
+
+@receiver(post_save, sender=University)
+def refresh_university_search_documents(sender, instance, **kwargs):
+    """
+    Rebuilds the search documents of every course at a university after it's edited.
+
+    :param sender: University model class
+    :param instance: University that was saved
+    """
+    update_search_documents(Course.objects.filter(university=instance))
+
+
+# enddef
+
+
+@receiver(post_save, sender=EntryRequirement)
+def refresh_requirements_display(sender, instance, **kwargs):
+    """
+    Stores the requirements text on the course after its requirements are created or edited.
+
+    :param sender: EntryRequirement model class
+    :param instance: EntryRequirement that was saved
+    """
+    Course.objects.filter(pk=instance.course_id).update(requirements_display=requirements_display(instance))
+
+
+# enddef
+
+
+@receiver(post_delete, sender=EntryRequirement)
+def clear_requirements_display(sender, instance, **kwargs):
+    """
+    Resets the requirements text once a course's requirements are deleted.
+
+    :param sender: EntryRequirement model class
+    :param instance: EntryRequirement that was deleted
+    """
+    # imports write the requirements text themselves
+    if is_importing():
+        return
+    # endif
+
+    Course.objects.filter(pk=instance.course_id).update(requirements_display=NO_REQUIREMENTS_TEXT)
+
+
+# enddef
+
+
+@receiver(post_save, sender=University)
+def refresh_university_course_regions(sender, instance, **kwargs):
+    """
+    Updates the region of courses that take it from their university after the university is edited.
+
+    :param sender: University model class
+    :param instance: University that was saved
+    """
+    update_course_regions(Course.objects.filter(university=instance))
+
+
+# enddef
+
+
+@receiver(post_save, sender=Course)
+@receiver(post_save, sender=University)
+@receiver(post_save, sender=EntryRequirement)
+@receiver(post_delete, sender=Course)
+@receiver(post_delete, sender=EntryRequirement)
+def forget_content_hashes(sender, instance, **kwargs):
+    """
+    Clears the import hashes of anything edited outside the import (e.g. in
+    the admin), so the next import writes it again instead of skipping it.
+
+    :param sender: Model class that changed
+    :param instance: Object that was saved or deleted
+    """
+    # imports write the hashes themselves
+    if is_importing():
+        return
+    # endif
+
+    if sender is University:
+        University.objects.filter(pk=instance.pk).update(content_hash="")
+        return
+    # endif
+
+    if sender is Course:
+        course_id = instance.pk
+        university_id = instance.university_id
+    else:
+        course_id = instance.course_id
+        university_id = Course.objects.filter(pk=course_id).values_list('university_id', flat=True).first()
+    # endif
+
+    Course.objects.filter(pk=course_id).update(content_hash="")
+    # the university hash covers its courses too
+    University.objects.filter(pk=university_id).update(content_hash="")
+
+
+# enddef
+
+
+@receiver(post_save, sender=Course)
+@receiver(post_save, sender=University)
+@receiver(post_save, sender=EntryRequirement)
+@receiver(post_save, sender=SubjectRequirement)
+@receiver(post_delete, sender=Course)
+@receiver(post_delete, sender=University)
+@receiver(post_delete, sender=EntryRequirement)
+@receiver(post_delete, sender=SubjectRequirement)
+def catalog_changed(sender, **kwargs):
+    """
+    Bumps the catalog version when course data changes, so cached searches,
+    the in-memory index and the eligibility arrays are rebuilt.
+
+    :param sender: Model class that changed
+    """
+    mark_catalog_changed()
+# enddef
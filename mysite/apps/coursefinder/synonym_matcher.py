@@ -0,0 +1,203 @@
+"""
+Compiled synonym lookup used to expand search queries
+
+The synonym table is turned into a reverse lookup (synonym -> subject) for
+whole-query matches and an Aho-Corasick automaton over words, so one pass
+over a query like "I like comp sci and maths" finds every synonym in it.
+The synonym tables are only imported when the matcher is first needed.
+"""
+import re
+import threading
+from collections import deque
+from typing import Dict, List, Tuple
+
+_matcher = None
+_matcher_lock = threading.Lock()
+
+
+def split_words(text: str) -> List[str]:
+    """
+    Splits lowercase text into words for the automaton.
+
+    :param text: Lowercase text
+    :return: List of words
+    """
+    return re.findall(r"\w+", text)
+
+
+# enddef
+
+
+class SynonymMatcher:
+    """
+    Word-level Aho-Corasick automaton over every course synonym.
+    """
+
+    def __init__(self, courses: Dict[str, List[str]]):
+        # remember what it was built from so we can tell when the data changes
+        self.source = courses
+        self.source_size = len(courses)
+
+        # exact synonym -> main subject (first subject wins, same as the old scan)
+        self.reverse_lookup: Dict[str, str] = {}
+
+        # automaton: goto transitions, failure links and (pattern length, subject) outputs
+        self.transitions: List[Dict[str, int]] = [{}]
+        self.failures: List[int] = [0]
+        self.outputs: List[List[Tuple[int, str]]] = [[]]
+
+        for subject, synonym_list in courses.items():
+            for synonym in synonym_list:
+                synonym_lower = synonym.strip().lower()
+                if synonym_lower in self.reverse_lookup:
+                    continue
+                # endif
+                self.reverse_lookup[synonym_lower] = subject.lower()
+                self.add_pattern(split_words(synonym_lower), subject.lower())
+            # endfor
+        # endfor
+
+        self.build_failure_links()
+    # enddef
+
+    def add_pattern(self, words: List[str], subject: str):
+        """
+        Adds one synonym (as a list of words) to the trie.
+        """
+        if not words:
+            return
+        # endif
+
+        node = 0
+        for word in words:
+            next_node = self.transitions[node].get(word)
+            if next_node is None:
+                next_node = len(self.transitions)
+                self.transitions.append({})
+                self.failures.append(0)
+                self.outputs.append([])
+                self.transitions[node][word] = next_node
+            # endif
+            node = next_node
+        # endfor
+
+        # two synonyms can split into the same words ("comp-sci" and "comp sci")
+        if not self.outputs[node]:
+            self.outputs[node].append((len(words), subject))
+        # endif
+    # enddef
+
+    def build_failure_links(self):
+        """
+        Fills in the failure links breadth first, merging outputs along them.
+        """
+        queue = deque(self.transitions[0].values())
+        while queue:
+            node = queue.popleft()
+            for word, child in self.transitions[node].items():
+                queue.append(child)
+
+                # follow failure links until something can take this word
+                fallback = self.failures[node]
+                while fallback and word not in self.transitions[fallback]:
+                    fallback = self.failures[fallback]
+                # endwhile
+                self.failures[child] = self.transitions[fallback].get(word, 0)
+
+                # anything that ends at the failure node also ends here
+                self.outputs[child] = self.outputs[child] + self.outputs[self.failures[child]]
+            # endfor
+        # endwhile
+    # enddef
+
+    def find_subjects(self, text: str) -> List[str]:
+        """
+        Finds the subjects of every synonym contained in the text in one pass.
+
+        When synonyms overlap the longest one wins, so "computer science"
+        is used rather than just "science".
+
+        :param text: Lowercase text to scan
+        :return: List of main subject names in the order they appear
+        """
+        matches = []
+        node = 0
+        for position, word in enumerate(split_words(text)):
+            while node and word not in self.transitions[node]:
+                node = self.failures[node]
+            # endwhile
+            node = self.transitions[node].get(word, 0)
+
+            for length, subject in self.outputs[node]:
+                matches.append((position - length + 1, -length, subject))
+            # endfor
+        # endfor
+
+        # earliest start first, then longest, skipping anything overlapping what we kept
+        subjects = []
+        covered_until = 0
+        for start, negative_length, subject in sorted(matches):
+            if start < covered_until:
+                continue
+            # endif
+            covered_until = start - negative_length
+            if subject not in subjects:
+                subjects.append(subject)
+            # endif
+        # endfor
+
+        return subjects
+    # enddef
+# endclass
+
+
+def get_course_synonyms() -> Dict[str, List[str]]:
+    """
+    Gets the course synonym table, importing the NLP synonyms module on first use.
+
+    :return: Dictionary mapping main subject names to their synonyms
+    """
+    from ..nlp.synonyms import SYNONYMS
+
+    return SYNONYMS.get('courses', {})
+
+
+# enddef
+
+
+def get_synonym_matcher() -> SynonymMatcher:
+    """
+    Gets the compiled synonym matcher, rebuilding it only if the synonym data changed.
+
+    :return: SynonymMatcher for the current course synonyms
+    """
+    global _matcher
+
+    courses = get_course_synonyms()
+    matcher = _matcher
+    if matcher is None or matcher.source is not courses or matcher.source_size != len(courses):
+        with _matcher_lock:
+            matcher = _matcher
+            if matcher is None or matcher.source is not courses or matcher.source_size != len(courses):
+                matcher = SynonymMatcher(courses)
+                _matcher = matcher
+            # endif
+        # endwith
+    # endif
+
+    return matcher
+
+
+# enddef
+
+
+def clear_synonym_matcher() -> None:
+    """
+    Forgets the compiled matcher, e.g. after the synonym lists are edited in place.
+    """
+    global _matcher
+
+    with _matcher_lock:
+        _matcher = None
+    # endwith
+# enddef
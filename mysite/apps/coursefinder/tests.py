@@ -1,3 +1,1560 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.contrib.postgres.search import SearchQuery
+from django.core.management import CommandError, call_command
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models.functions import Length
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from . import eligibility, query_parsing, university_lookup
+from .catalog import CATALOG_VERSION_ID, bump_catalog_version, get_catalog_version
+from .catalog_copy import STAGED_COURSE_COLUMNS, STAGED_REQUIREMENT_COLUMNS, STAGED_UNIVERSITY_COLUMNS
+from .catalog_copy import build_rows, bulk_load_catalog, chunked, map_in_order
+from .catalog_import import CatalogValidationError, import_catalog, iter_json_array
+from .eligibility import EligibilityEngine, get_eligibility_engine
+from .full_text_search import SEARCH_CONFIG, build_search_query, build_search_vector, full_text_filter
+from .models import CatalogVersion, Course, EntryRequirement, SubjectRequirement, University
+from .normalize import NO_REQUIREMENTS_TEXT, STUDY_MODE_FULL_TIME, STUDY_MODE_PART_TIME, STUDY_MODE_SANDWICH
+from .normalize import duration_filter_range, parse_duration_years, parse_qualification, parse_study_mode
+from .normalize import qualification_filter_codes, requirements_display, study_modes_with
+from .query_parsing import ParsedQuery, calculate_ucas_points, clear_parse_cache, get_parse_cache_stats
+from .query_parsing import get_grade_parser, parse_query
+from .regions import find_region
+from .results import RESULT_FIELDS, CourseIdResults, QueryResults, format_course, format_row
+from .search_cache import build_cache_key, get_search_cache
+from .search_index import CourseSearchIndex, invalidate_search_index
+from .search_service import search_courses
+from .search_view import search_view_is_current
+from .synonym_matcher import SynonymMatcher
+from .trigram_search import similarity_threshold
+from .types import UniMatchResult
+from .university_lookup import get_university_lookup
+from .university_search import classify_query, expand_query_with_synonyms, run_university_search
+from .university_search import top_courses_per_university
+from .warmup import warm_up_search
+
+# small synonym table so the tests don't need the NLP app
+TEST_SYNONYMS = {
+    "Mathematics": ["maths", "math", "mathematics"],
+    "Physics": ["physics"],
+    "Computer Science": ["computer science", "comp sci", "cs"],
+    "Science": ["science"],
+    # "maths" is a Mathematics synonym too, and the first subject wins
+    "Further Mathematics": ["further maths", "maths"],
+}
+
+
+def forget_catalog_caches() -> None:
+    """
+    Drops the in-memory copies of the catalog (university lookup, eligibility
+    engine, search index) left by earlier tests.
+
+    Each test rolls the catalog version back, so a copy built in another test
+    can have the same version as this one and would otherwise be reused.
+    """
+    university_lookup._lookup = None
+    eligibility._engine = None
+    invalidate_search_index()
+
+
+# enddef
+
+
+def make_course(university: University, name: str, min_points: int = None, min_grade: str = "",
+                subjects: dict = None) -> Course:
+    """
+    Creates a course, with an EntryRequirement if min_points is given.
+
+    :param university: University the course is at
+    :param name: Course name
+    :param min_points: Optional minimum UCAS points
+    :param min_grade: Optional minimum grade
+    :param subjects: Optional dictionary of subject -> grade needed
+    :return: The new Course
+    """
+    course = Course.objects.create(university=university, name=name)
+    if min_points is not None:
+        requirement = EntryRequirement.objects.create(
+            course=course, min_ucas_points=min_points, min_grade_required=min_grade
+        )
+        for subject, grade in (subjects or {}).items():
+            SubjectRequirement.objects.create(entry_requirement=requirement, subject=subject, grade=grade)
+        # endfor
+    # endif
+    return course
+
+
+# enddef
+
+
+class EligibilityEngineTests(TestCase):
+    """
+    Points, minimum grade and subject checks in eligibility.py.
+    """
+
+    def setUp(self):
+        forget_catalog_caches()
+        university = University.objects.create(name="Test University", location="London")
+        self.open_course = make_course(university, "Open", 0)
+        self.points = make_course(university, "Points", 136)
+        self.min_grade = make_course(university, "Min Grade", 96, min_grade="A")
+        self.maths = make_course(university, "Maths", 96, subjects={"Mathematics": "A"})
+        self.physics = make_course(university, "Physics", 96, subjects={"Physics": "B"})
+        self.no_requirement = make_course(university, "No Requirement")
+
+        matcher = SynonymMatcher(TEST_SYNONYMS)
+        with mock.patch("mysite.apps.coursefinder.eligibility.get_synonym_matcher", return_value=matcher):
+            self.engine = EligibilityEngine.build()
+        # endwith
+    # enddef
+
+    def eligible(self, grades: dict, points: int) -> set:
+        return set(self.engine.eligible_course_ids(grades, points))
+    # enddef
+
+    def test_points(self):
+        eligible = self.eligible({"maths": "B", "physics": "B", "english": "B"}, 120)
+        self.assertIn(self.open_course.id, eligible)
+        self.assertNotIn(self.points.id, eligible)
+        self.assertIn(self.points.id, self.eligible({"maths": "A", "physics": "A", "english": "B"}, 136))
+    # enddef
+
+    def test_courses_without_requirements_are_left_out(self):
+        # they're always open, so the searches don't need them in the arrays
+        self.assertNotIn(self.no_requirement.id, self.eligible({"maths": "A"}, 300))
+    # enddef
+
+    def test_min_grade_uses_weakest_of_best_three(self):
+        self.assertNotIn(self.min_grade.id, self.eligible({"maths": "A", "physics": "A", "english": "B"}, 136))
+        self.assertIn(self.min_grade.id, self.eligible({"maths": "A", "physics": "A", "english": "A"}, 144))
+        # a fourth, weaker grade doesn't count
+        self.assertIn(self.min_grade.id, self.eligible({"a": "A", "b": "A", "c": "A", "d": "E"}, 160))
+    # enddef
+
+    def test_subject_grade_with_synonyms(self):
+        grades = {"Maths": "B", "physics": "B", "english": "B"}
+        self.assertNotIn(self.maths.id, self.eligible(grades, 120))
+        self.assertIn(self.physics.id, self.eligible(grades, 120))
+
+        grades["Maths"] = "A"
+        self.assertIn(self.maths.id, self.eligible(grades, 128))
+    # enddef
+
+    def test_subjects_not_named_are_not_checked(self):
+        # grades without subjects can't fail a subject requirement
+        eligible = self.eligible({"grade 1": "A", "grade 2": "A", "grade 3": "B"}, 136)
+        self.assertIn(self.maths.id, eligible)
+        self.assertIn(self.physics.id, eligible)
+
+        # naming maths only checks the maths requirement
+        eligible = self.eligible({"maths": "C", "english": "A", "history": "A"}, 128)
+        self.assertNotIn(self.maths.id, eligible)
+        self.assertIn(self.physics.id, eligible)
+    # enddef
+
+    def test_failed_grade_course_ids_only_has_courses_within_points(self):
+        failed = self.engine.failed_grade_course_ids({"maths": "C", "physics": "B", "english": "C"}, 104)
+        self.assertEqual(set(failed), {self.min_grade.id, self.maths.id})
+    # enddef
+
+    def test_subject_requirement_edits_rebuild_the_engine(self):
+        grades = {"maths": "B", "physics": "B", "english": "B"}
+        matcher = SynonymMatcher(TEST_SYNONYMS)
+        with mock.patch("mysite.apps.coursefinder.eligibility.get_synonym_matcher", return_value=matcher):
+            self.assertNotIn(self.maths.id, get_eligibility_engine().eligible_course_ids(grades, 120))
+
+            version = get_catalog_version()
+            SubjectRequirement.objects.filter(entry_requirement__course=self.maths).update(grade="B")
+            SubjectRequirement.objects.get(entry_requirement__course=self.maths).save()
+            self.assertGreater(get_catalog_version(), version)
+            self.assertIn(self.maths.id, get_eligibility_engine().eligible_course_ids(grades, 120))
+
+            SubjectRequirement.objects.get(entry_requirement__course=self.physics).delete()
+            self.assertIn(self.physics.id, get_eligibility_engine().eligible_course_ids({"physics": "E"}, 120))
+        # endwith
+    # enddef
+# endclass
+
+
+class ResultRowTests(TestCase):
+    """
+    Result rows built straight from values_list tuples.
+    """
+
+    def setUp(self):
+        university = University.objects.create(name="Alpha University", location="London")
+        self.physics = make_course(university, "Physics", 128, "B")
+        Course.objects.filter(pk=self.physics.pk).update(course_type="BSc (Hons)", duration="3 years")
+        EntryRequirement.objects.filter(course=self.physics).update(display_grades="ABB")
+        self.chemistry = Course.objects.create(university=university, name="Chemistry", link="https://example.com")
+    # enddef
+
+    def test_rows_match_the_courses(self):
+        row = Course.objects.filter(pk=self.physics.pk).values_list(*RESULT_FIELDS).get()
+        result = format_row(row)
+        expected = format_course(Course.objects.select_related('university').get(pk=self.physics.pk))
+        self.assertEqual(
+            [getattr(result, name) for name in UniMatchResult.__slots__],
+            [getattr(expected, name) for name in UniMatchResult.__slots__]
+        )
+        self.assertEqual(
+            (result.university, result.course, result.course_id), ("Alpha University", "Physics", self.physics.id)
+        )
+        # no link to show
+        self.assertEqual(result.course_link, "#")
+        # slots, so no per-row __dict__
+        self.assertFalse(hasattr(result, "__dict__"))
+    # enddef
+
+    def test_a_page_is_one_query(self):
+        course_ids = [self.chemistry.id, self.physics.id]
+        for results in [QueryResults(Course.objects.order_by('name')), CourseIdResults(course_ids)]:
+            with self.assertNumQueries(1):
+                page = results[0:2]
+            # endwith
+            self.assertEqual([result.course for result in page], ["Chemistry", "Physics"])
+            self.assertEqual(page[0].course_link, "https://example.com")
+        # endfor
+    # enddef
+# endclass
+
+
+class ParseQueryTests(SimpleTestCase):
+    """
+    Memoized NLP parsing (with the parsers mocked, so only the caching is tested).
+    """
+
+    def setUp(self):
+        clear_parse_cache()
+        self.addCleanup(clear_parse_cache)
+
+        self.grade_parser = mock.Mock()
+        self.grade_parser.parse.return_value = {"grades": {"maths": "A", "physics": "B"}, "interests": ["physics"]}
+        patcher = mock.patch("mysite.apps.coursefinder.query_parsing.get_grade_parser", return_value=self.grade_parser)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch(
+            "mysite.apps.nlp.course_interests.parse_interests", return_value={"interests": ["physics", "medicine"]}
+        )
+        self.parse_interests = patcher.start()
+        self.addCleanup(patcher.stop)
+    # enddef
+
+    def test_both_parsers_are_combined(self):
+        parsed = parse_query("AB in maths and physics, want medicine")
+        self.assertEqual(dict(parsed.grades), {"maths": "A", "physics": "B"})
+        self.assertEqual(parsed.interests, ("physics", "medicine"))
+        self.assertEqual(parsed.ucas_points, 88)
+    # enddef
+
+    def test_repeated_queries_are_parsed_once(self):
+        first = parse_query("AB  in maths ")
+        self.assertIs(parse_query(" AB in maths"), first)
+        self.grade_parser.parse.assert_called_once_with("AB in maths")
+        self.parse_interests.assert_called_once_with("AB in maths")
+        self.assertEqual(get_parse_cache_stats()["hits"], 1)
+        self.assertEqual(get_parse_cache_stats()["misses"], 1)
+    # enddef
+
+    def test_case_is_kept(self):
+        # the grade parser looks at the case
+        parse_query("AAB")
+        parse_query("aab")
+        self.assertEqual(self.grade_parser.parse.call_count, 2)
+    # enddef
+
+    def test_cached_parses_are_read_only(self):
+        parsed = parse_query("AB in maths")
+        with self.assertRaises(TypeError):
+            parsed.grades["maths"] = "E"
+        # endwith
+        self.assertEqual(parse_query("AB in maths").grades["maths"], "A")
+    # enddef
+
+    def test_ucas_points(self):
+        self.assertEqual(calculate_ucas_points({"maths": "a*", "physics": "B", "art": "?"}), 96)
+        self.assertEqual(calculate_ucas_points({}), 0)
+    # enddef
+# endclass
+
+
+class GradeParserWarmUpTests(SimpleTestCase):
+    """
+    One GradeParser per process, created on first use or when a worker starts.
+    """
+
+    def test_parser_is_created_once(self):
+        patcher = mock.patch("mysite.apps.nlp.grade_parser.GradeParser")
+        with mock.patch.object(query_parsing, "_parser", None), patcher as grade_parser:
+            # first searches in several threads at once
+            parsers = []
+            threads = [threading.Thread(target=lambda: parsers.append(get_grade_parser())) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            # endfor
+            for thread in threads:
+                thread.join()
+            # endfor
+
+            grade_parser.assert_called_once_with()
+            self.assertEqual(parsers, [grade_parser.return_value] * 8)
+            self.assertIs(get_grade_parser(), grade_parser.return_value)
+        # endwith
+    # enddef
+
+    def test_warm_up_loads_everything(self):
+        with mock.patch("mysite.apps.coursefinder.warmup.get_grade_parser") as grade_parser:
+            with mock.patch("mysite.apps.coursefinder.warmup.get_synonym_matcher") as synonym_matcher:
+                with mock.patch("mysite.apps.coursefinder.warmup.parse_query") as parse:
+                    timings = warm_up_search()
+                # endwith
+            # endwith
+        # endwith
+        grade_parser.assert_called_once_with()
+        synonym_matcher.assert_called_once_with()
+        parse.assert_called_once_with("warm up")
+        self.assertEqual(set(timings), {"grade_parser", "synonyms", "first_parse"})
+    # enddef
+
+    def test_warm_up_is_opt_in(self):
+        config = apps.get_app_config("coursefinder")
+        with mock.patch("mysite.apps.coursefinder.warmup.warm_up_search") as warm_up:
+            with override_settings(COURSEFINDER_WARM_UP=False):
+                config.ready()
+            # endwith
+            warm_up.assert_not_called()
+
+            with override_settings(COURSEFINDER_WARM_UP=True):
+                config.ready()
+            # endwith
+            warm_up.assert_called_once_with()
+        # endwith
+    # enddef
+# endclass
+
+
+class SearchResultsTests(TestCase):
+    """
+    Lazily loaded results: counted in the database and loaded a page at a time.
+    """
+
+    def setUp(self):
+        university = University.objects.create(name="Test University", location="London")
+        self.courses = [make_course(university, f"Course {number}") for number in range(5)]
+        self.ids = [course.id for course in self.courses]
+    # enddef
+
+    def names(self, results) -> list:
+        return [result.course for result in results]
+    # enddef
+
+    def test_query_results_count_and_pages(self):
+        results = QueryResults(Course.objects.order_by('-name'))
+        with self.assertNumQueries(1):
+            self.assertEqual(len(results), 5)
+            self.assertEqual(len(results), 5)
+        # endwith
+        self.assertFalse(results.is_capped)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.names(results[1:3]), ["Course 3", "Course 2"])
+        # endwith
+        self.assertEqual(results[0].course, "Course 4")
+        self.assertEqual(self.names(results), ["Course 4", "Course 3", "Course 2", "Course 1", "Course 0"])
+        with self.assertRaises(ValueError):
+            results[::2]
+        # endwith
+    # enddef
+
+    def test_count_stops_at_the_cap(self):
+        with override_settings(COURSEFINDER_RESULT_COUNT_CAP=3):
+            results = QueryResults(Course.objects.order_by('name'))
+            self.assertEqual(results.count(), 3)
+            self.assertTrue(results.is_capped)
+        # endwith
+        with override_settings(COURSEFINDER_RESULT_COUNT_CAP=5):
+            results = QueryResults(Course.objects.order_by('name'))
+            self.assertEqual(results.count(), 5)
+            self.assertFalse(results.is_capped)
+        # endwith
+    # enddef
+
+    def test_course_id_results_keep_their_order(self):
+        # a course deleted since the ids were picked is skipped
+        self.courses[2].delete()
+        results = CourseIdResults([self.ids[3], self.ids[2], self.ids[0], self.ids[4]])
+        self.assertEqual(len(results), 4)
+        self.assertEqual(self.names(results[:3]), ["Course 3", "Course 0"])
+        self.assertEqual(self.names(results), ["Course 3", "Course 0", "Course 4"])
+    # enddef
+
+    def test_paginator(self):
+        for results in [QueryResults(Course.objects.order_by('name')), CourseIdResults(self.ids)]:
+            page = Paginator(results, 2).page(2)
+            self.assertEqual(page.paginator.num_pages, 3)
+            self.assertEqual(self.names(page.object_list), ["Course 2", "Course 3"])
+        # endfor
+    # enddef
+# endclass
+
+
+class SearchCoursesCacheTests(TestCase):
+    """
+    Cache keys of search_courses.
+    """
+
+    def setUp(self):
+        forget_catalog_caches()
+        get_search_cache().clear()
+        university = University.objects.create(name="Test University", location="London")
+        make_course(university, "Easy", 96)
+        make_course(university, "Hard", 144)
+    # enddef
+
+    def search(self, query: str, grades: dict) -> list:
+        parsed = ParsedQuery(MappingProxyType(grades), (), calculate_ucas_points(grades))
+        with mock.patch("mysite.apps.coursefinder.search_service.parse_query", return_value=parsed):
+            result = search_courses(query, {})
+        # endwith
+        return [match.course for match in result["matching_courses"]]
+    # enddef
+
+    def test_queries_differing_only_in_case_with_different_grades(self):
+        # the grade parser is case-sensitive, so these can parse differently
+        self.assertEqual(self.search("AAA", {"a": "A", "b": "A", "c": "A"}), ["Easy", "Hard"])
+        self.assertEqual(self.search("aaa", {"a": "C", "b": "C", "c": "C"}), ["Easy"])
+    # enddef
+
+    def test_search_engines_have_their_own_keys(self):
+        with override_settings(COURSEFINDER_SEARCH_ENGINE="database"):
+            database_key = build_cache_key("universities", "law", {})
+        # endwith
+        with override_settings(COURSEFINDER_SEARCH_ENGINE="memory"):
+            memory_key = build_cache_key("universities", "law", {})
+        # endwith
+        self.assertNotEqual(database_key, memory_key)
+    # enddef
+# endclass
+
+
+class BuildSearchQueryTests(SimpleTestCase):
+    """
+    Turning search terms into prefix-matching tsqueries.
+    """
+
+    def assertQuery(self, terms: list, raw: str):
+        self.assertEqual(build_search_query(terms), SearchQuery(raw, search_type="raw", config=SEARCH_CONFIG))
+    # enddef
+
+    def test_every_word_is_a_prefix(self):
+        self.assertQuery(["Comp Sci"], "comp:* & sci:*")
+    # enddef
+
+    def test_only_word_characters_are_kept(self):
+        self.assertQuery(["law') | !(x"], "law:* & x:*")
+        self.assertIsNone(build_search_query(["&!", "  "]))
+        self.assertIsNone(build_search_query([]))
+    # enddef
+# endclass
+
+
+@skipUnless(connection.vendor == "postgresql", "Full-text search needs Postgres")
+class FullTextSearchTests(TestCase):
+    """
+    Full-text matching against the stored course search documents.
+    """
+
+    def setUp(self):
+        import_catalog(scraped_catalog())
+    # enddef
+
+    def search(self, *terms) -> list:
+        return sorted(full_text_filter(Course.objects.all(), list(terms)).values_list('name', flat=True))
+    # enddef
+
+    def test_course_and_university_words_match(self):
+        self.assertEqual(self.search("physics"), ["Physics"])
+        self.assertEqual(self.search("chem"), ["Chemistry"])
+        self.assertEqual(self.search("beta university"), ["Chemistry", "Physics"])
+        self.assertEqual(self.search("leeds"), ["Chemistry", "Physics"])
+        # terms are OR'd
+        self.assertEqual(self.search("law", "art"), ["Art", "Law"])
+        self.assertEqual(self.search("?!"), [])
+    # enddef
+
+    def test_name_ranks_above_location(self):
+        University.objects.filter(name="Gamma University").update(location="Art Quarter, Bristol")
+        Course.objects.filter(name="Law").update(search_document=build_search_vector())
+        ranked = full_text_filter(Course.objects.all(), ["art"]).order_by("-rank").values_list('name', flat=True)
+        self.assertEqual(list(ranked), ["Art", "Law"])
+    # enddef
+
+    def test_edits_update_the_documents(self):
+        university = University.objects.get(name="Alpha University")
+        university.name = "Omega University"
+        university.save()
+        self.assertEqual(self.search("omega"), ["Computer Science", "History"])
+
+        course = Course.objects.get(name="Art")
+        course.name = "Fine Art"
+        course.save()
+        self.assertEqual(self.search("fine"), ["Fine Art"])
+    # enddef
+# endclass
+
+
+def word_similarity_threshold():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT current_setting('pg_trgm.word_similarity_threshold', true)")
+        return cursor.fetchone()[0]
+    # endwith
+
+
+# enddef
+
+
+@skipUnless(connection.vendor == "postgresql", "Trigram search needs Postgres")
+class SimilarityThresholdTests(TransactionTestCase):
+    """
+    The threshold set for a fuzzy search only lasts for that search's transaction.
+    """
+
+    def test_threshold_is_gone_after_the_block(self):
+        with similarity_threshold(0.85):
+            self.assertEqual(word_similarity_threshold(), "0.85")
+        # endwith
+        self.assertNotEqual(word_similarity_threshold(), "0.85")
+
+        # and when the block fails
+        with self.assertRaises(ZeroDivisionError):
+            with similarity_threshold(0.85):
+                1 / 0
+            # endwith
+        # endwith
+        self.assertNotEqual(word_similarity_threshold(), "0.85")
+    # enddef
+
+    def test_default_threshold_from_settings(self):
+        with override_settings(COURSEFINDER_TRIGRAM_THRESHOLD=0.45), similarity_threshold():
+            self.assertEqual(word_similarity_threshold(), "0.45")
+        # endwith
+    # enddef
+# endclass
+
+
+@skipUnless(connection.vendor == "postgresql", "Trigram search needs Postgres")
+@override_settings(COURSEFINDER_SEARCH_ENGINE="database")
+class FuzzySearchTests(TestCase):
+    """
+    Similar spellings are searched when nothing matches the words exactly.
+    """
+
+    def setUp(self):
+        forget_catalog_caches()
+        with connection.cursor() as cursor:
+            # the word similarity operator pg_trgm adds
+            cursor.execute("SELECT to_regoperator('%>(text,text)')")
+            if cursor.fetchone()[0] is None:
+                self.skipTest("pg_trgm isn't installed")
+            # endif
+        # endwith
+        import_catalog(scraped_catalog())
+    # enddef
+
+    def search(self, query: str, fuzzy: bool = None) -> list:
+        return [match.course for match in run_university_search(query, {}, fuzzy=fuzzy)]
+    # enddef
+
+    def test_typos_fall_back_to_similarity(self):
+        self.assertEqual(self.search("chemestry"), ["Chemistry"])
+        self.assertEqual(self.search("chemestry", fuzzy=False), [])
+    # enddef
+
+    def test_exact_matches_skip_similarity(self):
+        with mock.patch("mysite.apps.coursefinder.university_search.trigram_filter") as trigram_filter:
+            self.assertEqual(self.search("chemistry"), ["Chemistry"])
+        # endwith
+        trigram_filter.assert_not_called()
+    # enddef
+# endclass
+
+
+@override_settings(COURSEFINDER_SEARCH_ENGINE="database")
+class ExportCoursesViewTests(TestCase):
+    """
+    Streaming every match as NDJSON, and the capped total shown on the matches tab.
+    """
+
+    def setUp(self):
+        forget_catalog_caches()
+        get_search_cache().clear()
+        self.client.force_login(get_user_model().objects.create_user(username="counsellor", password="password"))
+        university = University.objects.create(name="Test University", location="London")
+        self.courses = [make_course(university, name, points) for name, points in
+                        [("Art", 96), ("Biology", 112), ("Chemistry", 120), ("Drama", 144)]]
+        grades = {"a": "B", "b": "B", "c": "B"}
+        parsed = ParsedQuery(MappingProxyType(grades), (), calculate_ucas_points(grades))
+        patcher = mock.patch("mysite.apps.coursefinder.search_service.parse_query", return_value=parsed)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    # enddef
+
+    def test_every_match_is_a_line(self):
+        # several chunks, and the last one isn't full
+        with override_settings(COURSEFINDER_EXPORT_CHUNK_SIZE=2):
+            response = self.client.get(reverse("coursefinder:export_courses"), {"query": "BBB"})
+            body = b"".join(response.streaming_content).decode()
+        # endwith
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertTrue(body.endswith("\n"))
+        lines = [json.loads(line) for line in body.splitlines()]
+        # BBB is 120 points, so not Drama
+        self.assertEqual([line["course"] for line in lines], ["Art", "Biology", "Chemistry"])
+        self.assertEqual(lines[0]["course_id"], self.courses[0].id)
+        self.assertEqual(lines[0]["university"], "Test University")
+    # enddef
+
+    def test_needs_a_query_and_a_login(self):
+        url = reverse("coursefinder:export_courses")
+        self.assertEqual(self.client.get(url, {"query": " "}).status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.client.get(url, {"query": "BBB"}).status_code, 302)
+    # enddef
+
+    def test_capped_total(self):
+        url = reverse("coursefinder:coursefinder")
+        data = {"tab": "matches", "query": "BBB"}
+        with override_settings(COURSEFINDER_RESULT_COUNT_CAP=2):
+            response = self.client.post(url, data, headers={"x-requested-with": "XMLHttpRequest"})
+        # endwith
+        self.assertTrue(response.json()["parsed_input"].startswith("Showing 2 of 2+ courses"))
+
+        get_search_cache().clear()
+        with override_settings(COURSEFINDER_RESULT_COUNT_CAP=3):
+            response = self.client.post(url, data, headers={"x-requested-with": "XMLHttpRequest"})
+        # endwith
+        self.assertTrue(response.json()["parsed_input"].startswith("Showing 3 of 3 courses"))
+    # enddef
+# endclass
+
+
+class NormalizeTests(SimpleTestCase):
+    """
+    Parsing the free-text course fields and filter options into indexed values.
+    """
+
+    def test_duration(self):
+        self.assertEqual(parse_duration_years("3 years"), 3)
+        self.assertEqual(parse_duration_years("1 Year full time"), 1)
+        # the last number of a range, like the old text match
+        self.assertEqual(parse_duration_years("3-4 years"), 4)
+        self.assertIsNone(parse_duration_years("18 months"))
+        self.assertIsNone(parse_duration_years(None))
+
+        self.assertEqual(duration_filter_range("3 Years"), (3, 3))
+        self.assertEqual(duration_filter_range("5+ Years"), (5, None))
+        self.assertIsNone(duration_filter_range("Any"))
+    # enddef
+
+    def test_study_mode(self):
+        self.assertEqual(parse_study_mode("Full-time"), STUDY_MODE_FULL_TIME)
+        self.assertEqual(
+            parse_study_mode("Full time with placement year"), STUDY_MODE_FULL_TIME | STUDY_MODE_SANDWICH
+        )
+        self.assertEqual(parse_study_mode("Part time"), STUDY_MODE_PART_TIME)
+        self.assertEqual(parse_study_mode("Block release"), 0)
+
+        modes = study_modes_with(STUDY_MODE_SANDWICH)
+        self.assertEqual(len(modes), 8)
+        self.assertTrue(all(mode & STUDY_MODE_SANDWICH for mode in modes))
+        self.assertEqual(study_modes_with(0), [])
+    # enddef
+
+    def test_qualification(self):
+        self.assertEqual(parse_qualification("BSc (Hons)"), "bsc-hons")
+        self.assertEqual(parse_qualification("B.Eng Honours"), "beng-hons")
+        self.assertEqual(parse_qualification("MA"), "ma")
+        self.assertEqual(parse_qualification("FdSc"), "foundation")
+        self.assertEqual(parse_qualification("Foundation Degree"), "foundation")
+        self.assertEqual(parse_qualification(""), "")
+
+        # an option without honours finds the honours degrees too
+        self.assertEqual(qualification_filter_codes("MA"), ["ma", "ma-hons"])
+        self.assertEqual(qualification_filter_codes("BSc (Hons)"), ["bsc-hons"])
+        self.assertEqual(qualification_filter_codes("Foundation"), ["foundation"])
+    # enddef
+# endclass
+
+
+class RequirementsDisplayTests(TestCase):
+    """
+    The requirements text stored on each course for the results table.
+    """
+
+    def setUp(self):
+        university = University.objects.create(name="Alpha University", location="London")
+        self.course = Course.objects.create(university=university, name="Physics")
+    # enddef
+
+    def stored(self) -> str:
+        return Course.objects.get(pk=self.course.pk).requirements_display
+    # enddef
+
+    def test_text(self):
+        self.assertEqual(requirements_display(None), NO_REQUIREMENTS_TEXT)
+        self.assertEqual(requirements_display(EntryRequirement(display_grades="AAB", btec_grades="DDM")), "AAB / DDM")
+        # points when there are no grades to show
+        self.assertEqual(
+            requirements_display(EntryRequirement(display_grades=" ", min_ucas_points=112)), "112 UCAS points"
+        )
+        self.assertEqual(
+            requirements_display(EntryRequirement(display_grades="AAB", has_requirements=False)), NO_REQUIREMENTS_TEXT
+        )
+        # cut to fit the column
+        long_requirement = EntryRequirement(display_grades="A" * 50, btec_grades="D" * 60)
+        self.assertEqual(len(requirements_display(long_requirement)), 100)
+    # enddef
+
+    def test_kept_up_to_date_with_the_requirements(self):
+        self.assertEqual(self.stored(), NO_REQUIREMENTS_TEXT)
+
+        requirement = EntryRequirement.objects.create(course=self.course, min_ucas_points=128, display_grades="ABB")
+        self.assertEqual(self.stored(), "ABB")
+
+        requirement.btec_grades = "DDM"
+        requirement.save()
+        self.assertEqual(self.stored(), "ABB / DDM")
+        self.assertEqual(QueryResults(Course.objects.all())[0].requirements, "ABB / DDM")
+
+        requirement.delete()
+        self.assertEqual(self.stored(), NO_REQUIREMENTS_TEXT)
+    # enddef
+# endclass
+
+
+@override_settings(COURSEFINDER_SEARCH_ENGINE="database")
+class DatabaseFilterTests(TestCase):
+    """
+    The database search filters on the columns filled in when a course is saved.
+    """
+
+    def setUp(self):
+        forget_catalog_caches()
+        get_search_cache().clear()
+        university = University.objects.create(name="Alpha University", location="London")
+        self.physics = Course.objects.create(
+            university=university, name="Physics", course_type="BSc (Hons)", duration="3 years", mode="Full time"
+        )
+        self.engineering = Course.objects.create(
+            university=university, name="Engineering", course_type="MEng", duration="5 years",
+            mode="Full-time with placement year"
+        )
+        self.history = Course.objects.create(
+            university=university, name="History", course_type="MA (Hons)", duration="4 years", mode="Part-time"
+        )
+    # enddef
+
+    def search(self, **filters) -> list:
+        return [match.course for match in run_university_search("alpha", filters)]
+    # enddef
+
+    def test_saving_fills_the_filter_columns(self):
+        self.assertEqual(
+            (self.engineering.duration_years, self.engineering.study_mode, self.engineering.qualification),
+            (5, STUDY_MODE_FULL_TIME | STUDY_MODE_SANDWICH, "meng")
+        )
+        self.history.duration = "1 year"
+        self.history.save(update_fields=["duration"])
+        self.history.refresh_from_db()
+        self.assertEqual(self.history.duration_years, 1)
+    # enddef
+
+    def test_filters(self):
+        self.assertEqual(self.search(duration="3 Years"), ["Physics"])
+        self.assertEqual(self.search(duration="5+ Years"), ["Engineering"])
+        self.assertEqual(self.search(mode="Full-time"), ["Engineering", "Physics"])
+        self.assertEqual(self.search(mode="Sandwich"), ["Engineering"])
+        self.assertEqual(self.search(course_type="MA"), ["History"])
+        self.assertEqual(self.search(course_type="BSc (Hons)", mode="Part-time"), [])
+    # enddef
+# endclass
+
+
+@override_settings(COURSEFINDER_SEARCH_ENGINE="database")
+class RegionTests(TestCase):
+    """
+    Regions stored on universities and courses for the location filter.
+    """
+
+    def setUp(self):
+        forget_catalog_caches()
+        get_search_cache().clear()
+        self.university = University.objects.create(name="Alpha University", location="Canterbury, Kent")
+        self.campus_course = Course.objects.create(university=self.university, name="Physics")
+        self.cardiff_course = Course.objects.create(university=self.university, name="History", location="Cardiff")
+    # enddef
+
+    def regions(self) -> dict:
+        return dict(Course.objects.values_list('name', 'region'))
+    # enddef
+
+    def test_find_region(self):
+        self.assertEqual(find_region("Canterbury, Kent"), "London & South East")
+        self.assertEqual(find_region("GLASGOW"), "Scotland")
+        self.assertEqual(find_region("Paris"), "")
+        self.assertEqual(find_region(None), "")
+    # enddef
+
+    def test_courses_use_their_own_location_first(self):
+        self.assertEqual(self.university.region, "London & South East")
+        self.assertEqual(self.regions(), {"Physics": "London & South East", "History": "Wales"})
+    # enddef
+
+    def test_university_edits_move_its_courses(self):
+        self.university.location = "Belfast"
+        self.university.save()
+        self.assertEqual(self.regions(), {"Physics": "Northern Ireland", "History": "Wales"})
+    # enddef
+
+    def test_location_filter(self):
+        results = run_university_search("alpha", {'location': "Wales"})
+        self.assertEqual([match.course for match in results], ["History"])
+    # enddef
+
+    def test_assign_regions(self):
+        # like LOCATION_REGIONS changing after the regions were stored
+        University.objects.update(region="")
+        Course.objects.update(region="")
+        version = get_catalog_version()
+
+        out = io.StringIO()
+        call_command("assign_regions", stdout=out)
+        self.assertIn("Updated regions of 1 universities and 2 courses", out.getvalue())
+        self.assertEqual(self.regions(), {"Physics": "London & South East", "History": "Wales"})
+        self.assertGreater(get_catalog_version(), version)
+
+        # nothing left to change, so the version stays the same
+        version = get_catalog_version()
+        call_command("assign_regions", stdout=out)
+        self.assertEqual(get_catalog_version(), version)
+    # enddef
+# endclass
+
+
+class CourseSearchIndexTests(TestCase):
+    """
+    BM25 ranking and filters of the in-memory search index.
+    """
+
+    def setUp(self):
+        london = University.objects.create(name="Alpha University", location="London")
+        leeds = University.objects.create(name="Beta University", location="Leeds")
+
+        self.computing = Course.objects.create(
+            university=london, name="Computer Science", course_type="BSc (Hons)", duration="3 years",
+            mode="Full time"
+        )
+        EntryRequirement.objects.create(course=self.computing, min_ucas_points=120, display_grades="BBB")
+
+        self.joint = Course.objects.create(
+            university=london, name="Mathematics with Computer Science", course_type="BSc (Hons)",
+            duration="4 years", mode="Part time"
+        )
+        EntryRequirement.objects.create(course=self.joint, has_requirements=False)
+
+        # no EntryRequirement at all
+        self.masters = Course.objects.create(
+            university=leeds, name="Computer Science", course_type="MSc", duration="1 year", mode="Full time"
+        )
+
+        self.history = Course.objects.create(
+            university=leeds, name="History", course_type="BA (Hons)", duration="3 years", mode="Full time"
+        )
+        EntryRequirement.objects.create(course=self.history, min_ucas_points=144, display_grades="AAA")
+
+        self.index = CourseSearchIndex.build()
+    # enddef
+
+    def search(self, terms=None, filters: dict = None, **kwargs) -> list:
+        return self.index.search(terms, filters or {}, **kwargs)
+    # enddef
+
+    def test_ranking(self):
+        # shorter documents with the words rank higher, and history doesn't match at all
+        self.assertEqual(
+            self.search(["computer science"]), [self.masters.id, self.computing.id, self.joint.id]
+        )
+    # enddef
+
+    def test_every_word_of_a_term_is_needed(self):
+        self.assertEqual(self.search(["computer history"]), [])
+        # the terms themselves are OR'd
+        self.assertEqual(set(self.search(["history", "mathematics"])), {self.history.id, self.joint.id})
+    # enddef
+
+    def test_partly_typed_words_match(self):
+        self.assertEqual(set(self.search(["comp sci"])), {self.computing.id, self.joint.id, self.masters.id})
+    # enddef
+
+    def test_university_name_and_location_are_searched(self):
+        # same score, so display order
+        self.assertEqual(self.search(["leeds"]), [self.masters.id, self.history.id])
+        self.assertEqual(self.search(["alpha"]), [self.computing.id, self.joint.id])
+    # enddef
+
+    def test_no_terms_gives_display_order(self):
+        self.assertEqual(self.search(), [self.computing.id, self.joint.id, self.masters.id, self.history.id])
+    # enddef
+
+    def test_filters(self):
+        self.assertEqual(self.search(filters={'course_type': "BSc (Hons)"}), [self.computing.id, self.joint.id])
+        # an option without honours matches honours degrees too
+        self.assertEqual(self.search(filters={'course_type': "BA"}), [self.history.id])
+        self.assertEqual(self.search(filters={'duration': "3 Years"}), [self.computing.id, self.history.id])
+        self.assertEqual(self.search(filters={'duration': "4+ Years"}), [self.joint.id])
+        self.assertEqual(self.search(filters={'mode': "Part time"}), [self.joint.id])
+        self.assertEqual(
+            self.search(filters={'location': "North East & Yorkshire"}), [self.masters.id, self.history.id]
+        )
+        # courses without requirements are left out of the points filter
+        self.assertEqual(self.search(filters={'ucas_range': "130"}), [self.computing.id, self.joint.id])
+        self.assertEqual(self.search(filters={'only_grades': True}), [self.computing.id, self.history.id])
+        self.assertEqual(self.search(filters={'no_requirements': True}), [self.joint.id])
+        self.assertEqual(
+            self.search(["computer science"], {'course_type': "BSc (Hons)", 'mode': "Full time"}),
+            [self.computing.id]
+        )
+    # enddef
+
+    def test_points_universities_and_limits(self):
+        # courses without requirements are kept by max_points
+        self.assertEqual(self.search(max_points=120), [self.computing.id, self.joint.id, self.masters.id])
+        self.assertEqual(
+            self.search(university_ids=[self.history.university_id]), [self.masters.id, self.history.id]
+        )
+        self.assertEqual(self.search(per_university=1), [self.computing.id, self.masters.id])
+        self.assertEqual(
+            self.search(["computer science"], excluded_course_ids={self.masters.id}),
+            [self.computing.id, self.joint.id]
+        )
+        self.assertEqual(self.search(limit=2), [self.computing.id, self.joint.id])
+    # enddef
+# endclass
+
+
+class ClassifyQueryTests(TestCase):
+    """
+    University and location queries answered from the in-memory university lookup.
+    """
+
+    def setUp(self):
+        forget_catalog_caches()
+        self.leeds = University.objects.create(name="University of Leeds", location="Leeds")
+        self.beckett = University.objects.create(name="Leeds Beckett University", location="Leeds")
+        self.imperial = University.objects.create(name="Imperial College", location="South Kensington")
+    # enddef
+
+    def test_exact_names(self):
+        self.assertEqual(classify_query("University of Leeds"), ([self.leeds.id], True))
+        self.assertEqual(classify_query("  imperial COLLEGE "), ([self.imperial.id], True))
+    # enddef
+
+    def test_names_containing_the_query(self):
+        self.assertEqual(classify_query("perial"), ([self.imperial.id], True))
+        self.assertEqual(classify_query("beckett uni"), ([self.beckett.id], True))
+        # more than one university has it in its name, and it's a city so one course each
+        self.assertEqual(classify_query("leeds"), (None, False))
+    # enddef
+
+    def test_locations_and_other_queries(self):
+        # part of a location, not a known city
+        self.assertEqual(classify_query("kensing"), (None, False))
+        self.assertEqual(classify_query("history"), (None, True))
+        self.assertEqual(classify_query("   "), (None, True))
+    # enddef
+
+    def test_rebuilt_when_the_catalog_version_changes(self):
+        lookup = get_university_lookup()
+        self.assertIs(get_university_lookup(), lookup)
+        self.assertEqual(classify_query("Wessex"), (None, True))
+
+        # saving a university bumps the catalog version
+        version = get_catalog_version()
+        wessex = University.objects.create(name="University of Wessex", location="Casterbridge")
+        self.assertGreater(get_catalog_version(), version)
+
+        self.assertIsNot(get_university_lookup(), lookup)
+        self.assertEqual(classify_query("Wessex"), ([wessex.id], True))
+    # enddef
+# endclass
+
+
+class TopCoursesPerUniversityTests(TestCase):
+    """
+    Picking the first courses at each university with ROW_NUMBER().
+    """
+
+    def setUp(self):
+        alpha = University.objects.create(name="Alpha University")
+        beta = University.objects.create(name="Beta University")
+        self.art = make_course(alpha, "Art")
+        self.biology = make_course(alpha, "Biology")
+        self.chemistry = make_course(alpha, "Chemistry")
+        self.drama = make_course(beta, "Drama")
+        self.economics = make_course(beta, "Economics")
+    # enddef
+
+    def top(self, ordering: list, per_university: int, limit: int = None, courses=None) -> list:
+        if courses is None:
+            courses = Course.objects.all()
+        # endif
+        return top_courses_per_university(courses, ordering, per_university, limit)
+    # enddef
+
+    def test_one_course_per_university(self):
+        self.assertEqual(self.top(["university__name", "name"], 1), [self.art.id, self.drama.id])
+    # enddef
+
+    def test_ordering_picks_the_row_and_the_order_they_come_back_in(self):
+        self.assertEqual(self.top(["-name"], 1), [self.economics.id, self.chemistry.id])
+        # like the rank of a search, with the university and name breaking ties
+        ranked = Course.objects.annotate(name_length=Length('name'))
+        self.assertEqual(
+            self.top(["-name_length", "university__name", "name"], 1, courses=ranked),
+            [self.chemistry.id, self.economics.id]
+        )
+    # enddef
+
+    def test_more_than_one_per_university_and_limit(self):
+        self.assertEqual(
+            self.top(["university__name", "name"], 2), [self.art.id, self.biology.id, self.drama.id, self.economics.id]
+        )
+        self.assertEqual(
+            self.top(["university__name", "name"], 2, limit=3), [self.art.id, self.biology.id, self.drama.id]
+        )
+    # enddef
+
+    def test_filters_apply_before_picking(self):
+        courses = Course.objects.exclude(name="Art")
+        self.assertEqual(self.top(["university__name", "name"], 1, courses=courses), [self.biology.id, self.drama.id])
+    # enddef
+# endclass
+
+
+def old_expand_query(query: str) -> list:
+    """
+    The synonym expansion from before SynonymMatcher (a scan over every synonym), to compare against.
+    """
+    query_lower = query.strip().lower()
+    for subject, synonym_list in TEST_SYNONYMS.items():
+        for synonym in synonym_list:
+            if synonym.lower() == query_lower:
+                return [subject.lower()]
+            # endif
+        # endfor
+    # endfor
+    return [query_lower]
+
+
+# enddef
+
+
+class SynonymMatcherTests(SimpleTestCase):
+    """
+    Query expansion with SynonymMatcher.
+    """
+
+    def setUp(self):
+        self.matcher = SynonymMatcher(TEST_SYNONYMS)
+        patcher = mock.patch(
+            "mysite.apps.coursefinder.university_search.get_synonym_matcher", return_value=self.matcher
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    # enddef
+
+    def test_whole_queries_match_old_expansion(self):
+        queries = [synonym for synonyms in TEST_SYNONYMS.values() for synonym in synonyms]
+        queries += ["MATHS", "  Comp Sci ", "history", "art and design"]
+        for query in queries:
+            with self.subTest(query=query):
+                self.assertEqual(expand_query_with_synonyms(query), old_expand_query(query))
+            # endwith
+        # endfor
+    # enddef
+
+    def test_synonyms_inside_a_longer_query(self):
+        self.assertEqual(
+            expand_query_with_synonyms("I like comp sci and maths"),
+            ["i like comp sci and maths", "computer science", "mathematics"]
+        )
+    # enddef
+
+    def test_longest_synonym_wins(self):
+        self.assertEqual(self.matcher.find_subjects("computer science degrees"), ["computer science"])
+        self.assertEqual(self.matcher.find_subjects("science or computer science"), ["science", "computer science"])
+        self.assertEqual(self.matcher.find_subjects("further maths"), ["further mathematics"])
+    # enddef
+
+    def test_only_whole_words_match(self):
+        # "cs" inside "physics" isn't a synonym
+        self.assertEqual(self.matcher.find_subjects("astrophysics"), [])
+        self.assertEqual(self.matcher.find_subjects("physics"), ["physics"])
+    # enddef
+# endclass
+
+
+class IterJsonArrayTests(SimpleTestCase):
+    """
+    Reading universities.json one item at a time.
+    """
+
+    def read(self, text: str, chunk_size: int = 3) -> list:
+        # small chunks so items get split across reads
+        return list(iter_json_array(io.StringIO(text), chunk_size=chunk_size))
+    # enddef
+
+    def test_items_split_across_chunks(self):
+        items = [{"name": "Alpha, \"the\" [first]", "courses": [{"name": "Art"}]}, 12, "]", [], None, -2.5e-3, 7]
+        text = json.dumps(items, indent=2)
+        for chunk_size in list(range(1, 9)) + [len(text)]:
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.read(text, chunk_size), items)
+            # endwith
+        # endfor
+    # enddef
+
+    def test_numbers_split_across_chunks(self):
+        # a chunk ending after the "1" or "1." of a number must not give the shorter number
+        for chunk_size in range(1, 9):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.read("[1.5e3, -12.25E+2 ,7]", chunk_size), [1500.0, -1225.0, 7])
+            # endwith
+        # endfor
+    # enddef
+
+    def test_empty_array(self):
+        self.assertEqual(self.read(" [ ] "), [])
+        self.assertEqual(self.read("[]"), [])
+    # enddef
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            self.read('{"name": "Alpha"}')
+        # endwith
+    # enddef
+
+    def test_array_not_closed(self):
+        with self.assertRaises(ValueError):
+            self.read('[{"name": "Alpha"}, ')
+        # endwith
+        with self.assertRaises(ValueError):
+            self.read('[{"name": "Alpha"')
+        # endwith
+    # enddef
+# endclass
+
+
+def scraped_course(name: str, min_points: int = None, grades: str = "") -> dict:
+    """
+    Builds a course the way the scraper writes it to universities.json.
+
+    :param name: Course name
+    :param min_points: Optional minimum UCAS points (no requirements if not given)
+    :param grades: Optional display grades
+    :return: Course dictionary
+    """
+    course = {"name": name, "course_type": "BSc (Hons)", "duration": "3 years", "mode": "Full time"}
+    if min_points is not None:
+        course["requirements"] = [{"min_ucas_points": min_points, "display_grades": grades}]
+    # endif
+    return course
+
+
+# enddef
+
+
+def scraped_catalog() -> list:
+    """
+    Builds a small universities.json catalog (4 universities, 6 courses).
+
+    :return: List of university dictionaries
+    """
+    return [
+        {"name": "Alpha University", "location": "London", "courses": [
+            scraped_course("Computer Science", 120, "BBB"),
+            scraped_course("History", 112, "BBC"),
+        ]},
+        {"name": "Beta University", "location": "Leeds", "courses": [
+            scraped_course("Physics", 128, "ABB"),
+            scraped_course("Chemistry"),
+        ]},
+        {"name": "Gamma University", "location": "Bristol", "courses": [scraped_course("Law", 136)]},
+        {"name": "Delta University", "location": "Cardiff", "courses": [scraped_course("Art", 96)]},
+    ]
+
+
+# enddef
+
+
+class ImportCatalogTests(TestCase):
+    """
+    Re-importing the catalog only writes what changed.
+    """
+
+    def setUp(self):
+        self.catalog = scraped_catalog()
+    # enddef
+
+    def import_catalog(self, **kwargs):
+        # through iter_json_array, like the import_courses command
+        return import_catalog(iter_json_array(io.StringIO(json.dumps(self.catalog))), **kwargs)
+    # enddef
+
+    def counts(self, counter) -> dict:
+        return {kind: count for kind, count in counter.items() if count}
+    # enddef
+
+    def test_first_import(self):
+        stats = self.import_catalog()
+        self.assertEqual(self.counts(stats.added), {"universities": 4, "courses": 6})
+        self.assertEqual(stats.records, 10)
+
+        course = Course.objects.get(name="Computer Science")
+        self.assertEqual(course.region, "London & South East")
+        self.assertEqual(course.qualification, "bsc-hons")
+        self.assertEqual(course.requirements_display, "BBB")
+        self.assertEqual(course.entryrequirement.min_ucas_points, 120)
+        self.assertFalse(EntryRequirement.objects.filter(course__name="Chemistry").exists())
+    # enddef
+
+    def test_reimporting_the_same_catalog_changes_nothing(self):
+        self.import_catalog()
+        version = get_catalog_version()
+
+        stats = self.import_catalog()
+        self.assertFalse(stats.has_changes)
+        self.assertEqual(self.counts(stats.unchanged), {"universities": 4, "courses": 6})
+        self.assertEqual(get_catalog_version(), version)
+    # enddef
+
+    def test_reimport_counts_only_the_differences(self):
+        self.import_catalog()
+        version = get_catalog_version()
+
+        alpha, beta, _, delta = self.catalog
+        alpha["courses"][0] = scraped_course("Computer Science", 128, "ABB")
+        alpha["courses"].append(scraped_course("Mathematics", 136, "AAB"))
+        beta["courses"] = [scraped_course("Physics")]
+        self.catalog = [alpha, beta, delta]
+
+        # a third of the courses go, more than COURSEFINDER_IMPORT_MAX_REMOVED_FRACTION allows
+        stats = self.import_catalog(max_removed_fraction=0.5)
+        self.assertEqual(self.counts(stats.added), {"courses": 1})
+        self.assertEqual(self.counts(stats.changed), {"universities": 2, "courses": 2})
+        # Chemistry, and Law with Gamma University
+        self.assertEqual(self.counts(stats.removed), {"universities": 1, "courses": 2})
+        self.assertEqual(self.counts(stats.unchanged), {"universities": 1, "courses": 2})
+        self.assertGreater(get_catalog_version(), version)
+
+        self.assertEqual(
+            sorted(Course.objects.values_list("name", flat=True)),
+            ["Art", "Computer Science", "History", "Mathematics", "Physics"]
+        )
+        self.assertEqual(Course.objects.get(name="Computer Science").requirements_display, "ABB")
+        self.assertEqual(EntryRequirement.objects.get(course__name="Computer Science").min_ucas_points, 128)
+        # Physics has no requirements now
+        self.assertEqual(Course.objects.get(name="Physics").requirements_display, NO_REQUIREMENTS_TEXT)
+        self.assertFalse(EntryRequirement.objects.filter(course__name="Physics").exists())
+    # enddef
+
+    def test_partial_catalog_keeps_missing_universities(self):
+        self.import_catalog()
+
+        self.catalog = self.catalog[:1]
+        stats = self.import_catalog(delete_missing=False)
+        self.assertFalse(stats.has_changes)
+        self.assertEqual(University.objects.count(), 4)
+    # enddef
+
+    def test_removing_too_much_of_the_catalog(self):
+        self.import_catalog()
+        version = get_catalog_version()
+
+        # Alpha only, so 4 of the 6 courses would go
+        self.catalog = self.catalog[:1]
+        self.catalog[0]["courses"].append(scraped_course("Mathematics", 136, "AAB"))
+        with self.assertRaisesMessage(CatalogValidationError, "would remove 4 of 6 courses"):
+            self.import_catalog(max_removed_fraction=0.5)
+        # endwith
+        # nothing was written, not even the new course
+        self.assertEqual(Course.objects.count(), 6)
+        self.assertEqual(get_catalog_version(), version)
+
+        # courses dropped from a university in the file count too
+        self.catalog = scraped_catalog()
+        self.catalog[0]["courses"] = []
+        self.catalog[1]["courses"] = []
+        with self.assertRaisesMessage(CatalogValidationError, "would remove 4 of 6 courses"):
+            self.import_catalog(max_removed_fraction=0.5)
+        # endwith
+
+        # fine when the missing universities are kept, or with a higher limit
+        self.catalog = scraped_catalog()[:1]
+        self.assertFalse(self.import_catalog(delete_missing=False, max_removed_fraction=0.5).has_changes)
+        self.assertEqual(self.import_catalog(max_removed_fraction=0.7).removed["courses"], 4)
+    # enddef
+
+    def test_small_batches(self):
+        stats = self.import_catalog(batch_size=1)
+        self.assertEqual(self.counts(stats.added), {"universities": 4, "courses": 6})
+        self.assertEqual(Course.objects.count(), 6)
+    # enddef
+# endclass
+
+
+class ImportCoursesCommandTests(TestCase):
+    """
+    import_courses command with the ORM import, which runs on every database.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+    # enddef
+
+    def import_courses(self, catalog: list, *args) -> str:
+        path = os.path.join(self.directory, "universities.json")
+        with open(path, "w", encoding="utf-8") as stream:
+            json.dump(catalog, stream)
+        # endwith
+        out = io.StringIO()
+        call_command("import_courses", path, "--orm", *args, stdout=out)
+        return out.getvalue()
+    # enddef
+
+    def test_import(self):
+        out = self.import_courses(scraped_catalog(), "--batch-size", "1")
+        self.assertIn("Universities: 4 added, 0 changed, 0 removed, 0 unchanged", out)
+        self.assertIn("Courses: 6 added, 0 changed, 0 removed, 0 unchanged", out)
+        self.assertIn("Read 10 records", out)
+        self.assertEqual(Course.objects.count(), 6)
+
+        out = self.import_courses(scraped_catalog())
+        self.assertIn("Nothing changed, catalog version left alone", out)
+    # enddef
+
+    @override_settings(COURSEFINDER_IMPORT_MAX_REMOVED_FRACTION=0.5)
+    def test_removing_too_much_of_the_catalog(self):
+        self.import_courses(scraped_catalog())
+        # Alpha only, so 4 of the 6 courses would go
+        catalog = scraped_catalog()[:1]
+        with self.assertRaisesMessage(CommandError, "would remove 4 of 6 courses"):
+            self.import_courses(catalog)
+        # endwith
+        self.assertEqual(Course.objects.count(), 6)
+
+        out = self.import_courses(catalog, "--keep-missing")
+        self.assertIn("Courses: 0 added, 0 changed, 0 removed, 2 unchanged", out)
+        self.assertEqual(Course.objects.count(), 6)
+
+        self.assertIn("Courses: 0 added, 0 changed, 4 removed, 2 unchanged", self.import_courses(catalog, "--force"))
+        self.assertEqual(Course.objects.count(), 2)
+    # enddef
+
+    def test_bad_input(self):
+        with self.assertRaisesMessage(CommandError, "--batch-size must be at least 1"):
+            self.import_courses(scraped_catalog(), "--batch-size", "0")
+        # endwith
+        with self.assertRaisesMessage(CommandError, "Could not import"):
+            call_command("import_courses", os.path.join(self.directory, "missing.json"), stdout=io.StringIO())
+        # endwith
+        with self.assertRaisesMessage(CommandError, "Could not import"):
+            self.import_courses({"name": "Alpha University"})
+        # endwith
+        self.assertFalse(University.objects.exists())
+    # enddef
+# endclass
+
+
+class StagingHelperTests(SimpleTestCase):
+    """
+    The parts of the staged import that don't need Postgres.
+    """
+
+    def test_build_rows(self):
+        universities, courses, requirements = build_rows(list(enumerate(scraped_catalog()[:2])))
+        self.assertEqual(len(universities), 2)
+        self.assertEqual(len(courses), 4)
+        # Chemistry has no requirements
+        self.assertEqual(len(requirements), 3)
+
+        university = dict(zip(STAGED_UNIVERSITY_COLUMNS, universities[1]))
+        self.assertEqual((university["position"], university["name"]), (1, "Beta University"))
+        self.assertEqual(university["region"], "North East & Yorkshire")
+
+        course = dict(zip(STAGED_COURSE_COLUMNS, courses[0]))
+        self.assertEqual((course["university_name"], course["name"]), ("Alpha University", "Computer Science"))
+        self.assertEqual((course["duration_years"], course["qualification"]), (3, "bsc-hons"))
+        self.assertEqual(course["requirements_display"], "BBB")
+
+        requirement = dict(zip(STAGED_REQUIREMENT_COLUMNS, requirements[0]))
+        self.assertEqual((requirement["course_name"], requirement["min_ucas_points"]), ("Computer Science", 120))
+    # enddef
+
+    def test_chunked(self):
+        self.assertEqual(list(chunked(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(chunked([], 2)), [])
+    # enddef
+
+    def test_map_in_order_reads_ahead_a_little(self):
+        read = []
+
+        def chunks():
+            for number in range(10):
+                read.append(number)
+                yield number
+            # endfor
+        # enddef
+
+        with ThreadPoolExecutor(2) as pool:
+            results = map_in_order(pool, lambda number: number * 2, chunks(), max_pending=3)
+            self.assertEqual(next(results), 0)
+            self.assertEqual(len(read), 3)
+            self.assertEqual(list(results), [number * 2 for number in range(1, 10)])
+        # endwith
+    # enddef
+# endclass
+
+
+@skipUnless(connection.vendor == "postgresql", "The staged import needs Postgres")
+class StagedImportTests(TestCase):
+    """
+    Checks bulk_load_catalog makes on the staged rows before merging them.
+    """
+
+    def setUp(self):
+        import_catalog(scraped_catalog())
+    # enddef
+
+    def bulk_load(self, catalog: list, **kwargs):
+        return bulk_load_catalog(catalog, workers=1, **kwargs)
+    # enddef
+
+    def assertCatalogUnchanged(self):
+        self.assertEqual(University.objects.count(), 4)
+        self.assertEqual(Course.objects.count(), 6)
+        # the temporary tables are gone too
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('import_university')")
+            self.assertIsNone(cursor.fetchone()[0])
+        # endwith
+    # enddef
+
+    def test_valid_catalog_is_merged(self):
+        catalog = scraped_catalog()
+        catalog[0]["courses"].append(scraped_course("Mathematics", 136, "AAB"))
+
+        stats = self.bulk_load(catalog)
+        self.assertEqual(stats.added["courses"], 1)
+        self.assertEqual(stats.unchanged["courses"], 6)
+        self.assertEqual(Course.objects.get(name="Mathematics").requirements_display, "AAB")
+    # enddef
+
+    def test_empty_file(self):
+        with self.assertRaisesMessage(CatalogValidationError, "no universities"):
+            self.bulk_load([])
+        # endwith
+        self.assertCatalogUnchanged()
+    # enddef
+
+    def test_values_the_catalog_cannot_hold(self):
+        catalog = scraped_catalog()
+        catalog[0]["courses"].append(scraped_course("x" * 300))
+        with self.assertRaisesMessage(CatalogValidationError, "1 rows in import_course with length(name) > 255"):
+            self.bulk_load(catalog)
+        # endwith
+        self.assertCatalogUnchanged()
+
+        catalog = scraped_catalog()
+        catalog[1]["name"] = ""
+        with self.assertRaisesMessage(CatalogValidationError, "1 rows in import_university with name = ''"):
+            self.bulk_load(catalog)
+        # endwith
+        self.assertCatalogUnchanged()
+    # enddef
+
+    def test_removing_too_much_of_the_catalog(self):
+        # Alpha only, so 4 of the 6 courses would go
+        catalog = scraped_catalog()[:1]
+        with self.assertRaisesMessage(CatalogValidationError, "would remove 4 of 6 courses"):
+            self.bulk_load(catalog, max_removed_fraction=0.5)
+        # endwith
+        self.assertCatalogUnchanged()
+
+        # fine when the missing universities are kept
+        self.assertFalse(self.bulk_load(catalog, delete_missing=False, max_removed_fraction=0.5).has_changes)
+
+        stats = self.bulk_load(catalog, max_removed_fraction=0.7)
+        self.assertEqual(stats.removed["courses"], 4)
+        self.assertEqual(Course.objects.count(), 2)
+    # enddef
+# endclass
+
+
+@override_settings(COURSEFINDER_SEARCH_ENGINE="database")
+class SearchViewTests(TestCase):
+    """
+    Searches only use the flattened course view while it's as new as the catalog.
+    """
+
+    def setUp(self):
+        forget_catalog_caches()
+        # imports refresh the view at the end
+        import_catalog(scraped_catalog())
+    # enddef
+
+    def search(self, query: str) -> list:
+        return [match.course for match in run_university_search(query, {}, fuzzy=False)]
+    # enddef
+
+    def test_catalog_changes_make_the_view_stale(self):
+        with mock.patch("mysite.apps.coursefinder.search_view.is_postgres", return_value=True):
+            CatalogVersion.objects.filter(pk=CATALOG_VERSION_ID).update(search_view_version=get_catalog_version())
+            self.assertTrue(search_view_is_current())
+
+            bump_catalog_version()
+            self.assertFalse(search_view_is_current())
+        # endwith
+    # enddef
+
+    @skipUnless(connection.vendor == "postgresql", "The search view needs Postgres")
+    def test_current_view_is_searched(self):
+        self.assertTrue(search_view_is_current())
+        # not through save(), so the catalog version stays the same and only the tables have the new name
+        Course.objects.filter(name="History").update(name="Modern History")
+        self.assertEqual(self.search("history"), ["History"])
+    # enddef
+
+    @skipUnless(connection.vendor == "postgresql", "The search view needs Postgres")
+    def test_stale_view_falls_back_to_the_tables(self):
+        Course.objects.filter(name="History").update(name="Modern History")
+        bump_catalog_version()
+        self.assertFalse(search_view_is_current())
+        self.assertEqual(self.search("history"), ["Modern History"])
+    # enddef
+# endclass
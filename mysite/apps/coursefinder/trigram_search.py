@@ -0,0 +1,91 @@
+"""
+Typo-tolerant course search using pg_trgm trigram similarity
+"""
+from contextlib import contextmanager
+from typing import List
+
+from django.conf import settings
+from django.contrib.postgres.search import TrigramWordSimilarity
+from django.db import connection, transaction
+from django.db.models import Q, QuerySet
+from django.db.models.functions import Greatest
+
+# the text columns that have a gin_trgm_ops index
+TRIGRAM_FIELDS = ["name", "university__name", "university__location"]
+
+
+def get_similarity_threshold() -> float:
+    """
+    Gets the minimum word similarity a match needs, from settings.
+
+    :return: Threshold between 0 and 1
+    """
+    return getattr(settings, "COURSEFINDER_TRIGRAM_THRESHOLD", 0.3)
+
+
+# enddef
+
+
+@contextmanager
+def similarity_threshold(threshold: float = None):
+    """
+    Sets the word similarity threshold used by the %> operator, for one transaction.
+
+    The operator (and so the trigram index) always uses the pg_trgm setting,
+    so the threshold can't go in the WHERE clause. It's set with SET LOCAL
+    semantics inside transaction.atomic(), so it's gone once the block ends
+    and can't leak into other queries on a pooled or persistent connection.
+    Queries from trigram_filter have to run inside the block.
+
+    Usage:
+        with similarity_threshold():
+            course_ids = list(trigram_filter(...).values_list('id', flat=True))
+
+    :param threshold: Optional minimum word similarity, defaults to COURSEFINDER_TRIGRAM_THRESHOLD
+    """
+    if threshold is None:
+        threshold = get_similarity_threshold()
+    # endif
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)",
+                [str(threshold)]
+            )
+        # endwith
+        yield
+    # endwith
+
+
+# enddef
+
+
+def trigram_filter(courses: QuerySet, terms: List[str]) -> QuerySet:
+    """
+    Filters courses whose name, university name or location is similar to any term.
+
+    Each course is annotated with "similarity" (the best word similarity across
+    all terms and fields) so results can be ordered by how close they are.
+    The queryset has to be evaluated inside similarity_threshold().
+
+    :param courses: Course queryset to filter
+    :param terms: List of search terms (already expanded with synonyms)
+    :return: Filtered queryset annotated with similarity
+    """
+    if not terms:
+        return courses.none()
+    # endif
+
+    match_query = Q()
+    similarities = []
+    for term in terms:
+        for field in TRIGRAM_FIELDS:
+            # field %> term uses the gin_trgm_ops index on that column
+            match_query |= Q(**{f"{field}__trigram_word_similar": term})
+            similarities.append(TrigramWordSimilarity(term, field))
+        # endfor
+    # endfor
+
+    return courses.filter(match_query).annotate(similarity=Greatest(*similarities))
+# enddef
@@ -1,5 +1,10 @@
 class UniMatchResult:
-    def __init__(self, university, course, course_type, duration, requirements, course_link, is_saved=False):
+    # fixed attributes instead of a __dict__ per row, so big result pages stay small
+    __slots__ = ("university", "course", "course_type", "duration", "requirements", "course_link", "is_saved",
+                 "course_id")
+
+    def __init__(self, university, course, course_type, duration, requirements, course_link, is_saved=False,
+                 course_id=None):
         self.university = university
         self.course = course
         self.course_type = course_type
@@ -7,5 +12,6 @@ class UniMatchResult:
         self.requirements = requirements
         self.course_link = course_link
         self.is_saved = is_saved
+        self.course_id = course_id  # None for results not loaded from the database
     # enddef
 # endclass
@@ -0,0 +1,159 @@
+"""
+In-memory lookup of university names and locations for classifying search queries
+
+Working out whether a query names a university or a location used to take
+three queries (location icontains, name iexact, name icontains) before the
+real search even started. The university table is small and only changes
+with the catalog, so a copy of the names and locations is kept here and
+rebuilt when the catalog version changes, like the search index.
+
+"contains" matches use a sorted list of every suffix of every name, so a
+substring search is a binary search for the suffixes starting with it.
+"""
+import threading
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+from .catalog import get_catalog_version
+from .models import University
+
+_lookup = None
+_lookup_lock = threading.Lock()
+
+
+def build_suffixes(values: List[Tuple[str, int]]) -> Tuple[List[str], List[int]]:
+    """
+    Builds the sorted suffix list used for substring matching.
+
+    :param values: List of (lowercase text, university id)
+    :return: Tuple of (sorted suffixes, university id of each suffix)
+    """
+    entries = sorted(
+        (text[start:], university_id)
+        for text, university_id in values
+        for start in range(len(text))
+    )
+    return [suffix for suffix, _ in entries], [university_id for _, university_id in entries]
+
+
+# enddef
+
+
+class UniversityLookup:
+    """
+    Exact, lowercase and substring lookups over university names and locations.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.exact_names: Dict[str, int] = {}  # name as stored -> id
+        self.lower_names: Dict[str, List[int]] = {}  # lowercase name -> ids
+        self.name_suffixes: List[str] = []
+        self.name_suffix_ids: List[int] = []
+        self.location_suffixes: List[str] = []
+    # enddef
+
+    @classmethod
+    def build(cls, version: int = None) -> "UniversityLookup":
+        """
+        Builds the lookup from the universities in the database.
+
+        :param version: Catalog version read before building, used to spot when it goes stale
+        :return: New UniversityLookup
+        """
+        lookup = cls()
+        lookup.version = version
+
+        names = []
+        locations = []
+        for university_id, name, location in University.objects.values_list('id', 'name', 'location'):
+            name_lower = name.lower()
+            lookup.exact_names[name] = university_id
+            lookup.lower_names.setdefault(name_lower, []).append(university_id)
+            names.append((name_lower, university_id))
+            if location:
+                locations.append((location.lower(), university_id))
+            # endif
+        # endfor
+
+        lookup.name_suffixes, lookup.name_suffix_ids = build_suffixes(names)
+        lookup.location_suffixes, _ = build_suffixes(locations)
+        return lookup
+    # enddef
+
+    def names_exactly(self, text: str) -> List[int]:
+        """
+        Finds universities whose name is the text, ignoring case.
+
+        :param text: Text to look up (already stripped)
+        :return: List of university ids
+        """
+        university_id = self.exact_names.get(text)
+        if university_id is not None:
+            return [university_id]
+        # endif
+        return list(self.lower_names.get(text.lower(), []))
+    # enddef
+
+    def names_containing(self, text: str, limit: int = None) -> List[int]:
+        """
+        Finds universities with the text anywhere in their name, ignoring case.
+
+        :param text: Text to look up (already stripped)
+        :param limit: Optional most ids to return
+        :return: List of university ids
+        """
+        text = text.lower()
+        university_ids = []
+        position = bisect_left(self.name_suffixes, text)
+        while position < len(self.name_suffixes) and self.name_suffixes[position].startswith(text):
+            university_id = self.name_suffix_ids[position]
+            # a name can contain the text more than once
+            if university_id not in university_ids:
+                university_ids.append(university_id)
+                if limit is not None and len(university_ids) >= limit:
+                    break
+                # endif
+            # endif
+            position += 1
+        # endwhile
+        return university_ids
+    # enddef
+
+    def has_location_containing(self, text: str) -> bool:
+        """
+        Checks if any university's location has the text in it, ignoring case.
+
+        :param text: Text to look up (already stripped)
+        :return: True if a location contains it
+        """
+        text = text.lower()
+        position = bisect_left(self.location_suffixes, text)
+        return position < len(self.location_suffixes) and self.location_suffixes[position].startswith(text)
+    # enddef
+# endclass
+
+
+def get_university_lookup() -> UniversityLookup:
+    """
+    Gets the shared lookup, building it the first time it's needed and
+    rebuilding it when the catalog version changes.
+
+    :return: UniversityLookup for the current catalog
+    """
+    global _lookup
+
+    version = get_catalog_version()
+    lookup = _lookup
+    if lookup is None or lookup.version != version:
+        with _lookup_lock:
+            # another thread might have built it while we waited
+            if _lookup is None or _lookup.version != version:
+                _lookup = UniversityLookup.build(version)
+            # endif
+            lookup = _lookup
+        # endwith
+    # endif
+
+    return lookup
+# enddef
@@ -1,19 +1,40 @@
 """
 University search service for general text-based searching
 """
-from typing import List
-from django.db.models import Q
-from .models import University, Course
-from .types import UniMatchResult
-from ..nlp.synonyms import SYNONYMS
+from typing import List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.db.models import F, Q, QuerySet, Window
+from django.db.models.functions import RowNumber
+from .full_text_search import full_text_filter, is_postgres
+from .models import Course, CourseSearchRow
+from .normalize import duration_filter_range, parse_study_mode, qualification_filter_codes, study_modes_with
+from .regions import LOCATION_REGIONS, is_known_city
+from .results import CourseIdResults, QueryResults, SearchResults
+from .search_cache import CachedResults, build_cache_key
+from .search_index import get_search_engine, get_search_index
+from .search_view import SEARCH_ROW_FIELDS, filter_search_rows, search_view_is_current
+from .synonym_matcher import get_synonym_matcher
+from .trigram_search import similarity_threshold, trigram_filter
+from .university_lookup import get_university_lookup
+
+# most universities to show when grouping courses by university
+MAX_GROUPED_UNIVERSITIES = 200
+
+# how many courses to show per university when grouping (can be changed per search)
+DEFAULT_COURSES_PER_UNIVERSITY = 1
 
 
 def expand_query_with_synonyms(query: str) -> List[str]:
     """
-    Converts query to main subject name if it's a synonym.
+    Converts query to main subject names for any synonyms it contains.
+
+    If the whole query is a synonym only the main subject is returned. If
+    synonyms appear inside a longer query (like "I like comp sci and maths")
+    their subjects are added after the original query.
 
     :param query: Search query string from user
-    :return: List containing main subject name or original query in lowercase
+    :return: List of search terms, all in lowercase
     """
     if not query:
         return []
@@ -21,98 +42,260 @@ def expand_query_with_synonyms(query: str) -> List[str]:
 
     query_lower = query.strip().lower()
 
-    # get course synonyms
-    courses = SYNONYMS.get('courses', {})
+    matcher = get_synonym_matcher()
 
-    # see if query matches any synonym
-    for subject, synonym_list in courses.items():
-        for synonym in synonym_list:
-            if synonym.lower() == query_lower:
-                # found a match so return the main subject
-                return [subject.lower()]
-            # endif
-        # endfor
+    # the whole query is a synonym so return the main subject
+    subject = matcher.reverse_lookup.get(query_lower)
+    if subject is not None:
+        return [subject]
+    # endif
+
+    # keep the original query and add any subjects mentioned inside it
+    search_terms = [query_lower]
+    for subject in matcher.find_subjects(query_lower):
+        if subject not in search_terms:
+            search_terms.append(subject)
+        # endif
     # endfor
 
-    # no synonym found so just return original query
-    return [query_lower]
+    return search_terms
+
+
+# enddef
+
+
+def classify_query(query: str) -> Tuple[Optional[List[int]], bool]:
+    """
+    Works out whether the query names a university or a location.
+
+    A location (like "London") shows one course per university, while a
+    university name shows every course at that university.
+
+    :param query: Search string from user
+    :return: Tuple of (ids of the university the query names or None, whether to show all courses)
+    """
+    query_for_match = query.strip()
+    if not query_for_match:
+        return None, True
+    # endif
+
+    # answered from the in-memory copy of the universities, see university_lookup.py
+    lookup = get_university_lookup()
+    is_location_query = is_known_city(query_for_match) or lookup.has_location_containing(query_for_match)
+
+    exact_unis = lookup.names_exactly(query_for_match)
+    if exact_unis:
+        return exact_unis, True
+    # endif
+
+    matching_unis = lookup.names_containing(query_for_match, limit=2)
+    if len(matching_unis) == 1:
+        return matching_unis, True
+    # endif
+
+    return None, not is_location_query
+
+
+# enddef
+
+
+def top_courses_per_university(courses: QuerySet, ordering: Sequence[str], per_university: int,
+                               limit: Optional[int] = None) -> List[int]:
+    """
+    Picks the first few courses at each university in a single query.
+
+    Every course is numbered within its university in the order the results
+    are shown (ROW_NUMBER() OVER (PARTITION BY university_id ...)) and only
+    the first per_university are kept, so the database does the grouping and
+    only the rows that get shown come back.
+
+    :param courses: Course (or CourseSearchRow) queryset with the search and filters applied
+    :param ordering: Order the results are shown in (also decides which courses are first at each university)
+    :param per_university: Most courses to keep at each university
+    :param limit: Optional most course ids to return
+    :return: List of course ids in display order
+    """
+    ranked = courses.annotate(
+        university_position=Window(RowNumber(), partition_by=F('university_id'), order_by=list(ordering))
+    ).filter(university_position__lte=per_university).order_by(*ordering)
+
+    course_ids = ranked.values_list('id', flat=True)
+    if limit is not None:
+        course_ids = course_ids[:limit]
+    # endif
+    return list(course_ids)
+
+
+# enddef
+
+
+def search_view_rows(query: str, rows: QuerySet, filters: dict, per_university: int) -> SearchResults:
+    """
+    Finishes a full-text search against the flattened course search view.
+
+    :param query: Search string from user
+    :param rows: CourseSearchRow queryset already matched and ranked by full_text_filter
+    :param filters: Dictionary containing filter options (course_type, duration, mode, location)
+    :param per_university: How many courses to show per university when the query is a location
+    :return: Lazily loaded SearchResults of UniMatchResult objects
+    """
+    rows = filter_search_rows(rows, filters)
+
+    university_ids, show_all_courses = classify_query(query)
+    if university_ids is not None:
+        rows = rows.filter(university_id__in=university_ids)
+    # endif
+
+    # best matches first, then the precomputed display order
+    ordering = ["-rank", "sort_key"]
+    if show_all_courses:
+        return QueryResults(rows.order_by(*ordering), SEARCH_ROW_FIELDS)
+    # endif
+
+    limit = MAX_GROUPED_UNIVERSITIES * per_university
+    return CourseIdResults(top_courses_per_university(rows, ordering, per_university, limit))
 
 
 # enddef
 
 
-def search_universities(query: str, filters: dict = None) -> List:
+def search_universities(query: str, filters: dict = None, fuzzy: Optional[bool] = None,
+                        threshold: Optional[float] = None,
+                        per_university: int = DEFAULT_COURSES_PER_UNIVERSITY) -> SearchResults:
     """
     Searches for universities and courses based on general text query.
 
+    Repeated searches are answered from the search cache, the real search
+    only runs for whatever isn't cached yet (see run_university_search).
+
     :param query: Search string (university name, location, or course name)
     :param filters: Optional dictionary containing filter options (course_type, duration, mode, location)
-    :return: List of UniMatchResult objects containing matching courses
+    :param fuzzy: True to always use similarity matching, False to never use it, None to use it as a fallback
+    :param threshold: Optional minimum similarity for fuzzy matches, defaults to COURSEFINDER_TRIGRAM_THRESHOLD
+    :param per_university: How many courses to show per university when the query is a location
+    :return: Lazily loaded SearchResults of UniMatchResult objects (only the page sliced out gets formatted)
     """
 
     if not query:
-        return []
+        return CourseIdResults([])
     # endif
 
     if filters is None:
         filters = {}
     # endif
 
+    cache_key = build_cache_key("universities", query, filters, fuzzy, threshold, per_university)
+    return CachedResults(cache_key, lambda: run_university_search(query, filters, fuzzy, threshold, per_university))
+
+
+# enddef
+
+
+def run_university_search(query: str, filters: dict, fuzzy: Optional[bool] = None,
+                          threshold: Optional[float] = None,
+                          per_university: int = DEFAULT_COURSES_PER_UNIVERSITY) -> SearchResults:
+    """
+    Runs a general text search against the catalog (without the cache).
+
+    On Postgres the query goes through the full-text index first. If that finds
+    nothing (or fuzzy=True) it switches to trigram similarity so typos like
+    "manchster" still find something, keeping only the closest matches.
+
+    :param query: Search string (university name, location, or course name)
+    :param filters: Optional dictionary containing filter options (course_type, duration, mode, location)
+    :param fuzzy: True to always use similarity matching, False to never use it, None to use it as a fallback
+    :param threshold: Optional minimum similarity for fuzzy matches, defaults to COURSEFINDER_TRIGRAM_THRESHOLD
+    :param per_university: How many courses to show per university when the query is a location
+    :return: Lazily loaded SearchResults of UniMatchResult objects (only the page sliced out gets formatted)
+    """
+
     # get search terms with synonyms
     search_terms = expand_query_with_synonyms(query)
 
-    results = []
+    if get_search_engine() == "memory":
+        # answer from the in-memory index and only load the page that gets shown
+        university_ids, show_all_courses = classify_query(query)
+        course_ids = get_search_index().search(
+            search_terms,
+            filters,
+            university_ids=university_ids,
+            per_university=None if show_all_courses else per_university,
+            limit=None if show_all_courses else MAX_GROUPED_UNIVERSITIES * per_university
+        )
+        return CourseIdResults(course_ids)
+    # endif
+
+    # on Postgres the flattened search view answers without any joins (see search_view.py)
+    if not fuzzy and search_view_is_current():
+        rows = full_text_filter(CourseSearchRow.objects.all(), search_terms)
+        if fuzzy is False or rows.exists():
+            return search_view_rows(query, rows, filters, per_university)
+        # endif
 
-    # build the search query
-    course_query = Q()
-    for term in search_terms:
-        # search in course name, uni name, and location
-        term_query = Q(name__icontains=term) | Q(university__name__icontains=term) | Q(
-            university__location__icontains=term)
-        course_query |= term_query
-    # endfor
+        # nothing matched the words exactly, so the similarity search below takes over
+        fuzzy = True
+    # endif
+
+    all_courses = Course.objects.select_related('university')
 
-    courses = Course.objects.select_related('university', 'entryrequirement').filter(course_query)
+    # postgres can use the indexed search document, otherwise fall back to icontains
+    use_full_text = is_postgres()
+    use_fuzzy = False
+    if use_full_text:
+        courses = full_text_filter(all_courses, search_terms)
 
-    # filter by course type if selected
+        # nothing matched the words exactly so try similar spellings instead
+        if fuzzy or (fuzzy is None and not courses.exists()):
+            courses = trigram_filter(all_courses, search_terms)
+            use_full_text = False
+            use_fuzzy = True
+        # endif
+    else:
+        # build the search query
+        course_query = Q()
+        for term in search_terms:
+            # search in course name, uni name, and location
+            term_query = Q(name__icontains=term) | Q(university__name__icontains=term) | Q(
+                university__location__icontains=term)
+            course_query |= term_query
+        # endfor
+
+        courses = all_courses.filter(course_query)
+    # endif
+
+    # filter by course type if selected (course type, duration and mode use the normalized, indexed columns)
     if filters.get('course_type'):
-        selected_type = filters['course_type']
-        # matches "BA (Hons)" in both short and long forms
-        courses = courses.filter(course_type__icontains=selected_type)
+        codes = qualification_filter_codes(filters['course_type'])
+        if codes:
+            courses = courses.filter(qualification__in=codes)
+        # endif
     # endif
 
     # filter by duration
     if filters.get('duration'):
-        val = filters['duration']
-        if "5+" in val:
-            # match courses with 5, 6, or 7 years
-            courses = courses.filter(
-                Q(duration__icontains="5 year") | Q(duration__icontains="6 year") | Q(duration__icontains="7 year"))
-        else:
-            # extract the number and match with the word "year" to avoid matching months
-            years = val.split(' ')[0]
-            courses = courses.filter(duration__icontains=years + " year")
+        years = duration_filter_range(filters['duration'])
+        if years:
+            min_years, max_years = years
+            if max_years is None:
+                # "5+" means 5 or more years
+                courses = courses.filter(duration_years__gte=min_years)
+            else:
+                courses = courses.filter(duration_years=min_years)
+            # endif
         # endif
     # endif
 
     # filter by mode
     if filters.get('mode'):
-        courses = courses.filter(mode__icontains=filters['mode'])
+        mode_flag = parse_study_mode(filters['mode'])
+        if mode_flag:
+            courses = courses.filter(study_mode__in=study_modes_with(mode_flag))
+        # endif
     # endif
 
-    # filter by location/region
-    if filters.get('location'):
-        region = filters['location']
-        region_map = filters.get('region_mapping', {})
-        cities = region_map.get(region, [])
-
-        if cities:
-            loc_q = Q()
-            for city in cities:
-                loc_q |= Q(university__location__icontains=city) | Q(location__icontains=city)
-            # endfor
-            courses = courses.filter(loc_q)
-        # endif
+    # filter by location/region (worked out for each course when it's saved, see regions.py)
+    if filters.get('location') in LOCATION_REGIONS:
+        courses = courses.filter(region=filters['location'])
     # endif
 
     # filter by ucas points
@@ -149,112 +332,46 @@ def search_universities(query: str, filters: dict = None) -> List:
             entryrequirement__has_requirements=False
         ).distinct()
     # endif
-    # If the query is a location, show one course per university
+    # If the query is a location, show a few courses per university
     # Otherwise, show all matching courses
-    query_for_match = query.strip()
-    show_all_courses = True
-    is_location_query = False
-
-    if query_for_match:
-        if University.objects.filter(location__icontains=query_for_match).exists():
-            is_location_query = True
-        # endif
-
-        region_map = filters.get('region_mapping', {})
-        for cities in region_map.values():
-            for city in cities:
-                if query_for_match.lower() == city.lower():
-                    is_location_query = True
-                    break
-                # endif
-            # endfor
-            if is_location_query:
-                break
-            # endif
-        # endfor
+    university_ids, show_all_courses = classify_query(query)
+    if university_ids is not None:
+        courses = courses.filter(university__in=university_ids)
     # endif
 
-    if is_location_query:
-        show_all_courses = False
+    if use_fuzzy:
+        ordering = ["-similarity", "university__name", "name"]
+    elif use_full_text:
+        # best matches first
+        ordering = ["-rank", "university__name", "name"]
+    else:
+        ordering = ["university__name", "name"]
     # endif
 
-    if query_for_match:
-        exact_unis = University.objects.filter(name__iexact=query_for_match)
-        if exact_unis.exists():
-            courses = courses.filter(university__in=exact_unis)
-            show_all_courses = True
-        else:
-            matching_unis = University.objects.filter(name__icontains=query_for_match)
-            if matching_unis.count() == 1:
-                courses = courses.filter(university__in=matching_unis)
-                show_all_courses = True
+    if use_fuzzy:
+        # only keep the closest fuzzy matches rather than everything above the threshold
+        fuzzy_limit = getattr(settings, 'COURSEFINDER_FUZZY_RESULT_LIMIT', 50)
+
+        # the threshold only lasts for one transaction, so read those few ids now
+        with similarity_threshold(threshold):
+            if show_all_courses:
+                course_ids = list(courses.order_by(*ordering)[:fuzzy_limit].values_list('id', flat=True))
+            else:
+                course_ids = top_courses_per_university(
+                    courses, ordering, per_university, min(MAX_GROUPED_UNIVERSITIES * per_university, fuzzy_limit)
+                )
             # endif
-        # endif
+        # endwith
+        return CourseIdResults(course_ids)
     # endif
 
-    courses = courses.order_by("university__name", "name")
-
-    # pick one representative course per university to keep layout consistent
     if show_all_courses:
-        selected_courses = courses
-    else:
-        selected_courses = []
-        seen_universities = set()
-        for course in courses:
-            uni_id = course.university_id
-            if uni_id in seen_universities:
-                continue
-            # endif
-            seen_universities.add(uni_id)
-            selected_courses.append(course)
-            if len(selected_courses) >= 200:
-                break
-            # endif
-        # endfor
+        # the view counts and slices out one page, so nothing is loaded here
+        return QueryResults(courses.order_by(*ordering))
     # endif
 
-    # format everything for display (one row per university)
-    for course in selected_courses:
-        try:
-            req = course.entryrequirement
-            # decide what to show for requirements
-            if req.has_requirements:
-                # course has requirements so show them
-                if req.display_grades and req.display_grades.strip():
-                    requirements_str = req.display_grades
-                elif req.min_ucas_points > 0:
-                    requirements_str = f"{req.min_ucas_points} UCAS points"
-                else:
-                    requirements_str = "No specific requirements"
-                # endif
-
-                # add btec grades if they exist
-                if req.btec_grades:
-                    requirements_str += f" / {req.btec_grades}"
-                # endif
-            else:
-                # no requirements for this course
-                requirements_str = "No specific requirements"
-            # endif
-        except:
-            requirements_str = "No specific requirements"
-        # endtry
-
-        link = course.link
-        if not link:
-            link = "#"
-        # endif
-
-        match = UniMatchResult(
-            university=course.university.name,
-            course=course.name,
-            course_type=course.course_type,
-            duration=course.duration,
-            requirements=requirements_str,
-            course_link=link
-        )
-        results.append(match)
-    # endfor
-
-    return results
+    # keep the first few courses at each university to keep the layout consistent,
+    # picked by the database so only the ids that get shown are read
+    return CourseIdResults(top_courses_per_university(courses, ordering, per_university,
+                                                      MAX_GROUPED_UNIVERSITIES * per_university))
 # enddef
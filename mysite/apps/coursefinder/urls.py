@@ -7,5 +7,6 @@ urlpatterns = [
     path('', views.coursefinder_view, name='coursefinder'),
     path('guest/', views.guest_coursefinder_view, name='guest_coursefinder'),
     path('search/', views.coursefinder_view, name='course_search'),
+    path('export/', views.export_courses_view, name='export_courses'),
     path('resources/', views.resources_view, name='resources'),
 ]
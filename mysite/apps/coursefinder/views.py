@@ -1,13 +1,19 @@
-from django.http import JsonResponse
+import json
+
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.http import JsonResponse, StreamingHttpResponse
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.shortcuts import render
 from django.template.loader import render_to_string
 from django.utils.html import escape
 
+from .regions import LOCATION_REGIONS
 from .search_service import search_courses
+from .results import SearchResults
 from .types import UniMatchResult
 from .university_search import search_universities
-from ..accounts.models import SavedMatch
+from ..accounts.saved_matches import get_saved_courses
 
 # Create your views here.
 
@@ -39,18 +45,6 @@ MODE_OPTIONS = [
     "Distance Learning"
 ]
 
-LOCATION_REGIONS = {
-    "London & South East": ["London", "Brighton", "Oxford", "Reading", "Southampton", "Surrey", "Kent", "Sussex"],
-    "South West": ["Bristol", "Bath", "Exeter", "Plymouth", "Bournemouth", "Falmouth"],
-    "West Midlands": ["Birmingham", "Coventry", "Warwick", "Wolverhampton", "Aston"],
-    "East Midlands": ["Nottingham", "Leicester", "Loughborough", "Derby", "Lincoln"],
-    "North West": ["Manchester", "Liverpool", "Lancaster", "Chester", "Salford"],
-    "North East & Yorkshire": ["Leeds", "Sheffield", "York", "Newcastle", "Durham", "Hull", "Bradford"],
-    "Scotland": ["Edinburgh", "Glasgow", "Aberdeen", "St Andrews", "Dundee", "Stirling"],
-    "Wales": ["Cardiff", "Swansea", "Bangor", "Aberystwyth"],
-    "Northern Ireland": ["Belfast", "Ulster"],
-}
-
 LOCATION_OPTIONS = list(LOCATION_REGIONS.keys())
 
 COURSE_TYPE_OPTIONS = [
@@ -136,23 +130,12 @@ def mark_saved_matches(results, user):
         return results
     # endif
 
-    # Get all the courses this user has saved
-    saved_matches = SavedMatch.objects.filter(user=user)
+    # ids of every course this user has saved (cached between requests)
+    saved = get_saved_courses(user)
 
     # Go through each course result and check if it's been saved
     for result in results:
-        result.is_saved = False  # Start by assuming it's not saved
-
-        # Check if this result matches any of the saved courses
-        for saved_match in saved_matches:
-            # We check university name, course name, and link to see if they match
-            if (result.university == saved_match.university and
-                    result.course == saved_match.course and
-                    result.course_link == saved_match.course_link):
-                result.is_saved = True
-                break  # We found it, so stop looking
-            # endif
-        # endfor
+        result.is_saved = saved.contains(result.course_id, (result.university, result.course, result.course_link))
     # endfor
 
     return results
@@ -160,6 +143,86 @@ def mark_saved_matches(results, user):
 
 # enddef
 
+def get_search_filters(params) -> dict:
+    """
+    Reads the search filters from the submitted form (or query string).
+
+    :param params: request.POST or request.GET
+    :return: Dictionary containing filter options (course_type, duration, mode, location, etc.)
+    """
+    return {
+        'course_type': params.get('course_type', ''),
+        'duration': params.get('duration', ''),
+        'mode': params.get('mode', ''),
+        'location': params.get('location', ''),
+        'only_grades': params.get('only_grades', '') == 'on',
+        'no_requirements': params.get('no_requirements', '') == 'on',
+        'ucas_range': params.get('ucas_range', '')
+    }
+
+
+# enddef
+
+
+def stream_ndjson(results: SearchResults, chunk_size: int):
+    """
+    Turns search results into NDJSON lines, one course per line.
+
+    Results are read a chunk at a time, so memory stays the same however many courses match.
+
+    :param results: Search results to write out
+    :param chunk_size: How many courses to read from the database at a time
+    :return: Generator of strings, one per chunk
+    """
+    for chunk in results.iter_chunks(chunk_size):
+        yield "".join(
+            json.dumps({
+                "course_id": result.course_id,
+                "university": result.university,
+                "course": result.course,
+                "course_type": result.course_type,
+                "duration": result.duration,
+                "requirements": result.requirements,
+                "link": result.course_link,
+            }) + "\n"
+            for result in chunk
+        )
+    # endfor
+
+
+# enddef
+
+
+@login_required
+def export_courses_view(request):
+    """
+    Streams every course matching a query as NDJSON (for big exports like a
+    counsellor pulling everything for a grade profile).
+
+    Takes the same query and filters as the matches tab, as GET parameters,
+    and skips the paging so the search only runs once.
+
+    :param request: Django HTTP request object
+    :return: Streaming NDJSON response, or a JSON error if there's no query
+    """
+    query = request.GET.get('query', '').strip()
+    if not query:
+        return JsonResponse({'status': 'error', 'message': 'No query given'}, status=400)
+    # endif
+
+    results = search_courses(query, get_search_filters(request.GET))["matching_courses"]
+    chunk_size = getattr(settings, "COURSEFINDER_EXPORT_CHUNK_SIZE", 2000)
+
+    response = StreamingHttpResponse(stream_ndjson(results, chunk_size), content_type="application/x-ndjson")
+    response['Content-Disposition'] = 'attachment; filename="courses.ndjson"'
+    # stop proxies like nginx holding on to the rows until the whole export is done
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# enddef
+
+
 def coursefinder_view(request):
     """
     Main view for course finder page that handles both matches and search tabs.
@@ -183,17 +246,7 @@ def coursefinder_view(request):
         query = request.POST.get('query', '')
         # print(f"DEBUG: Query received: '{query}'")
 
-        filters = {
-            'course_type': request.POST.get('course_type', ''),
-            'duration': request.POST.get('duration', ''),
-            'mode': request.POST.get('mode', ''),
-            'location': request.POST.get('location', ''),
-            'only_grades': request.POST.get('only_grades', '') == 'on',
-            'no_requirements': request.POST.get('no_requirements', '') == 'on',
-            'ucas_range': request.POST.get('ucas_range', '')
-        }
-
-        filters['region_mapping'] = LOCATION_REGIONS
+        filters = get_search_filters(request.POST)
 
         if tab == 'matches':
             # this tab uses the nlp parser to work out what grades they have
@@ -201,7 +254,9 @@ def coursefinder_view(request):
                 # run the search with nlp parsing
                 search_result = search_courses(query, filters)
                 results = search_result["matching_courses"]
+                # COUNT(*) in the database (capped for very broad searches)
                 total_results_count = len(results)
+                total_text = f"{total_results_count}+" if results.is_capped else str(total_results_count)
                 # print(f"DEBUG: Found {len(results)} results from search_courses")
 
                 # make a message showing what we understood from their input
@@ -234,14 +289,14 @@ def coursefinder_view(request):
                     shown_count = page_obj.end_index()
 
                     if grades_text and interests_text:
-                        parsed_input = f"Showing {shown_count} of {total_results_count} courses accepting: {grades_text} • Interests: {interests_text}"
+                        parsed_input = f"Showing {shown_count} of {total_text} courses accepting: {grades_text} • Interests: {interests_text}"
                     elif grades_text:
                         ucas = search_result.get("ucas_points", 0)
-                        parsed_input = f"Showing {shown_count} of {total_results_count} courses accepting: {grades_text} ({ucas} UCAS points)"
+                        parsed_input = f"Showing {shown_count} of {total_text} courses accepting: {grades_text} ({ucas} UCAS points)"
                     elif interests_text:
-                        parsed_input = f"Showing {shown_count} of {total_results_count} courses in: {interests_text}"
+                        parsed_input = f"Showing {shown_count} of {total_text} courses in: {interests_text}"
                     else:
-                        parsed_input = f"Showing {shown_count} of {total_results_count} courses"
+                        parsed_input = f"Showing {shown_count} of {total_text} courses"
                     # endif
                 else:
                     if grades_text and interests_text:
@@ -260,7 +315,9 @@ def coursefinder_view(request):
             # this tab is just basic search without nlp
             if query:
                 results = search_universities(query, filters)
+                # COUNT(*) in the database (capped for very broad searches)
                 total_results_count = len(results)
+                total_text = f"{total_results_count}+" if results.is_capped else str(total_results_count)
                 # print(f"DEBUG: Found {len(results)} results from search_universities")
                 if total_results_count:
                     paginator = Paginator(results, page_size)
@@ -274,7 +331,7 @@ def coursefinder_view(request):
 
                     results = mark_saved_matches(list(page_obj.object_list), request.user)
                     shown_count = page_obj.end_index()
-                    parsed_input = f"Showing {shown_count} of {total_results_count} results for '{query}'"
+                    parsed_input = f"Showing {shown_count} of {total_text} results for '{query}'"
                 else:
                     parsed_input = f"No universities or courses found for '{query}'"
                 # endif
@@ -0,0 +1,38 @@
+"""
+Optional warm-up that loads the search NLP pieces when a worker starts
+
+Without it the first search in each worker pays for importing the NLP
+modules, creating the GradeParser and compiling the synonym matcher.
+Turn it on with COURSEFINDER_WARM_UP (off by default so management
+commands and workers that never search don't pay for it).
+"""
+import time
+from typing import Dict
+
+from .query_parsing import get_grade_parser, parse_query
+from .synonym_matcher import get_synonym_matcher
+
+
+def warm_up_search() -> Dict[str, float]:
+    """
+    Loads the grade parser, interest parser and synonym matcher.
+
+    :return: Dictionary of how long each step took in ms
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    get_grade_parser()
+    timings["grade_parser"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    get_synonym_matcher()
+    timings["synonyms"] = (time.perf_counter() - start) * 1000
+
+    # runs both parsers once so the interest parser is imported too
+    start = time.perf_counter()
+    parse_query("warm up")
+    timings["first_parse"] = (time.perf_counter() - start) * 1000
+
+    return timings
+# enddef
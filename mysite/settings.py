@@ -43,6 +43,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "mysite.apps.accounts",
     "mysite.apps.coursefinder",
     "mysite.apps.nlp",
@@ -148,3 +149,54 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 LOGIN_URL = "accounts:login"
 LOGIN_REDIRECT_URL = reverse_lazy('coursefinder:coursefinder')
 LOGOUT_REDIRECT_URL = '/coursefinder/guest/'
+
+# Caches
+# "search" holds search results: LocMemCache evicts the least recently used entries past MAX_ENTRIES
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "search": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "coursefinder-search",
+        "TIMEOUT": 300,
+        "OPTIONS": {
+            "MAX_ENTRIES": 5000,
+        },
+    },
+}
+
+# Course search
+# "database" searches with the ORM, "memory" uses the in-memory index in coursefinder/search_index.py
+COURSEFINDER_SEARCH_ENGINE = os.environ.get("COURSEFINDER_SEARCH_ENGINE", "database")
+
+# Stop counting results past this many and show "10000+" instead
+COURSEFINDER_RESULT_COUNT_CAP = 10000
+
+# Minimum pg_trgm word similarity for fuzzy matches, and how many of the closest matches to show
+COURSEFINDER_TRIGRAM_THRESHOLD = float(os.environ.get("COURSEFINDER_TRIGRAM_THRESHOLD", "0.3"))
+COURSEFINDER_FUZZY_RESULT_LIMIT = 50
+
+# How long search results stay cached (seconds), empty results for less time,
+# and how long other requests wait for one that's already running the same search
+COURSEFINDER_SEARCH_CACHE = "search"
+COURSEFINDER_SEARCH_CACHE_TIMEOUT = 300
+COURSEFINDER_SEARCH_CACHE_EMPTY_TIMEOUT = 60
+COURSEFINDER_SEARCH_CACHE_LOCK_TIMEOUT = 10
+
+# How many courses the NDJSON export reads from the database at a time
+COURSEFINDER_EXPORT_CHUNK_SIZE = 2000
+
+# How many parsed queries (grades and interests) to keep in memory per process
+COURSEFINDER_PARSE_CACHE_SIZE = 1024
+
+# Load the NLP parsers and synonym tables when a worker starts instead of on its first search
+COURSEFINDER_WARM_UP = os.environ.get("COURSEFINDER_WARM_UP", "").lower() in ("1", "true", "yes")
+
+# Refuse an import (staged or --orm) that would delete more than this fraction of the courses
+# (e.g. from a broken scrape), unless import_courses is run with --force or --keep-missing
+COURSEFINDER_IMPORT_MAX_REMOVED_FRACTION = 0.25
+
+# Cache holding each user's saved course keys (should be shared between workers in production)
+ACCOUNTS_SAVED_MATCH_CACHE = "default"
+ACCOUNTS_SAVED_MATCH_CACHE_TIMEOUT = 300